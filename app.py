@@ -1,6 +1,7 @@
-from flask import Flask, render_template, send_from_directory, Response, abort, request
+from flask import Flask, render_template, send_from_directory, send_file, Response, abort, request, has_request_context
 import os
 import logging
+import logging.handlers
 import subprocess
 import shutil
 import time
@@ -8,63 +9,1098 @@ import re
 import sys
 import traceback
 import threading
+import collections
+import concurrent.futures
+import json
+import sqlite3
+import argparse
+import hmac
+import ipaddress
+import io
+import http.client
+import socket
+import urllib.parse
+import hashlib
+import math
+import bisect
+import queue
+import select
+import selectors
+import struct
+import fcntl
+import ctypes
+import ctypes.util
+import uuid
+import atexit
+import base64
+import mimetypes
+import stat as stat_module
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
+from werkzeug.wsgi import wrap_file
 import psutil  # You might need to install this: pip install psutil
 
 app = Flask(__name__)
 VIDEO_FOLDER = 'videos'
 CONVERTED_FOLDER = 'converted_videos'
-# Store active streaming processes to manage them properly
-ACTIVE_STREAMS = {}
+CACHE_FOLDER = 'cache'
+# Encode budget: FFmpeg sessions reserve cores from it; live streams take priority over batch work
+TRANSCODE_BUDGET_CORES = psutil.cpu_count(logical=True) or 2
+STREAM_THREADS = 2  # -threads for each live transcode
+CONVERT_THREADS = 2  # -threads for each batch conversion
+CONVERT_VIDEO_ARGS = ['-c:v', 'libx264', '-pix_fmt', 'yuv420p', '-threads', str(CONVERT_THREADS)]
+REMUX_COST_CORES = 0.25  # stream copy barely uses CPU
+AUDIO_TRANSCODE_COST_CORES = 0.5
+LIVE_ADMISSION_TIMEOUT = 5  # seconds a new live session may wait for room
+ADMISSION_RETRY_AFTER = 10  # seconds, sent with 503 responses
+BATCH_NICE = 10
+# Static file serving for /videos/ and /converted/
+FILE_CHUNK_SIZE = 256 * 1024
+MAX_RANGES_PER_REQUEST = 16
+SENDFILE_OFFLOAD = None  # None, 'x-accel' (nginx) or 'x-sendfile' (Apache/lighttpd) behind a reverse proxy
+X_ACCEL_PREFIX = '/protected'  # nginx internal location aliasing the app directory
+# Per-device read scheduling: a spinning disk seeking between many sequential readers is slower than one reader
+IO_ROTATIONAL_READERS = 2  # heavy readers at once on a spinning disk
+IO_SOLID_STATE_READERS = 0  # 0 = no limit; SSDs don't slow down with parallel readers
+IO_DEVICE_READERS = {}  # device name -> limit, overriding the defaults above (e.g. {'md0': 4})
+IO_INTERACTIVE_WAIT = 2  # seconds a viewer's read waits for a slot before going over the limit
+IO_HEAVY_READ_BYTES = 8 * 1024 * 1024  # /videos/ responses smaller than this don't take a slot
+# Seconds a large /videos/ response counts against its disk's limit. Players fill their buffer in that time and
+# are then paced by playback, so an open-ended range held for a whole film doesn't shut out batch work
+IO_SERVE_SLOT_SECONDS = 10
+IO_READAHEAD_BYTES = 32 * 1024 * 1024  # WILLNEED window kept ahead of a live stream's read position
+IO_SERVE_READAHEAD_BYTES = 4 * 1024 * 1024  # WILLNEED at the start of each /videos/ range; scrubbing abandons most of them
+DEVICE_IO_SAMPLES = {}  # device name -> {'read_bytes', 'read_bytes_per_second', 'busy_percent'}
+_block_devices = {}  # st_dev -> (device name, rotational)
+_device_io_counters = {}  # device name -> (sampled at, psutil counters)
+_readahead_queue = queue.Queue(maxsize=256)
+_readahead_thread = None
+_readahead_lock = threading.Lock()
+# ffprobe results keyed by path + size + mtime, so files are only probed when they change
+METADATA_DB = os.path.join(CACHE_FOLDER, 'metadata.db')
+_metadata_conn = None
+_metadata_lock = threading.Lock()
+_ffmpeg_caps = None
+FFMPEG_RECHECK_INTERVAL = 60  # seconds before re-checking a missing FFmpeg
+# Keyframe timestamps per file, so seeks can start exactly on a GOP boundary
+_keyframe_cache = {}  # (path, size, mtime) -> sorted keyframe times
+_keyframe_pending = set()
+_keyframe_queue = queue.Queue()
+_keyframe_thread = None
+_keyframe_lock = threading.Lock()
+# Streams in these formats play in browsers as-is, so they are copied instead of re-encoded
+BROWSER_VIDEO_CODECS = ('h264',)
+BROWSER_PIXEL_FORMATS = ('yuv420p', 'yuvj420p')
+BROWSER_AUDIO_CODECS = ('aac', 'mp3')
+TRANSCODE_PLAN = {'video': 'transcode', 'audio': 'transcode', 'mode': 'transcode'}
+REMUX_PLAN = {'video': 'copy', 'audio': 'copy', 'mode': 'remux'}
+# In-memory catalog of the library, maintained by the background scanner thread
+MEDIA_EXTENSIONS = ('.mkv', '.mp4')
+LIBRARY_POLL_INTERVAL = 30  # seconds, used when inotify is unavailable
+LIBRARY_CATALOG = {}  # (folder, relative path) -> entry
+_catalog_view = ()
+_catalog_version = 0  # bumped whenever the catalog or an entry changes; part of /api/videos ETags
+_catalog_queries = {}  # (sort, filters) -> (keys, entries) for the current catalog version
+_catalog_lock = threading.Lock()
+_catalog_ready = threading.Event()
+_scanner_thread = None
+CATALOG_PAGE_SIZE = 50
+CATALOG_MAX_PAGE_SIZE = 200
+CATALOG_QUERY_CACHE_SIZE = 32  # distinct sort/filter combinations kept per catalog version
+CATALOG_READY_WAIT = 2  # seconds a page waits for the first scan before rendering what it has so far
+CATALOG_PUBLISH_INTERVAL = 1  # seconds between catalog updates published during the first scan
+# Viewer sessions on /stream/ (ACTIVE_STREAMS, a StreamSessionManager, is created below the class)
+MAX_STREAM_SESSIONS = 64  # across all clients
+MAX_SESSIONS_PER_CLIENT = 4  # opening another evicts that client's most idle session
+# Seconds without a successful write before a session is torn down. Closed tabs are caught by the
+# disconnect path right away; this only backstops half-open sockets, so a paused viewer keeps its stream
+STREAM_IDLE_TIMEOUT = 4 * 3600
+STREAM_REAP_INTERVAL = 5  # seconds between idle session checks
+# Live transcodes shared between viewers, keyed by (input file, start offset, settings profile)
+BROADCASTS = {}
+BROADCAST_RING_SIZE = 64  # fMP4 fragments kept for viewers who attach later
+BROADCAST_LAG_TIMEOUT = 30  # seconds the encoder waits for a lagging viewer
+_broadcast_lock = threading.Lock()
+# Broadcast output is read straight into pooled buffers, in reads sized from the measured output rate
+RELAY_MIN_READ = 16 * 1024
+RELAY_MAX_READ = 1024 * 1024
+RELAY_READ_INTERVAL = 0.05  # seconds of encoder output each read aims to pick up
+RELAY_RATE_WINDOW = 1.0  # seconds over which the output rate is measured
+RELAY_POOL_MAX_BYTES = 64 * 1024 * 1024  # idle buffers kept for the next broadcast
+STREAM_FIRST_FRAGMENT = 0.5  # seconds of video in the first fragment, so playback starts sooner
+STREAM_KEYFRAME_INTERVAL = 2  # seconds between keyframes (and fragments) in live transcodes
+# Segmented (HLS) streaming: segments are encoded on demand and kept in a size-bounded LRU cache
+HLS_SEGMENT_DURATION = 6  # seconds
+HLS_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'hls')
+HLS_CACHE_MAX_BYTES = 5 * 1024 * 1024 * 1024
+HLS_LOOKAHEAD = 3  # segments encoded ahead of the player
+HLS_SEGMENT_TIMEOUT = 120  # seconds
+_hls_inflight = {}  # segment path -> Event set once its encode finishes
+_hls_cache_bytes = None
+_hls_lookahead_queue = queue.Queue(maxsize=HLS_LOOKAHEAD * 4)
+_hls_lookahead_thread = None
+_hls_lock = threading.Lock()
+# Adaptive bitrate: one decode feeding an encode per rung, output as a multi-variant HLS playlist
+ABR_ENABLED = False  # offer /abr/ to the player instead of single-rendition /hls/
+ABR_LADDER = [
+    {'name': '1080p', 'height': 1080, 'video_bitrate': '6M', 'audio_bitrate': '128k'},
+    {'name': '720p', 'height': 720, 'video_bitrate': '3M', 'audio_bitrate': '128k'},
+    {'name': '480p', 'height': 480, 'video_bitrate': '1200k', 'audio_bitrate': '96k'},
+]
+ABR_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'abr')
+ABR_COMPLETE_MARKER = '.complete'
+ABR_IDLE_TIMEOUT = 120  # seconds without requests before the encoder is stopped
+ABR_START_TIMEOUT = 30  # seconds to wait for the encoder to produce a requested file
+ABR_SESSIONS = {}  # output directory -> AbrSession
+_abr_lock = threading.Lock()
+# Poster frames and scrubbing thumbnail sprites, generated in the background
+THUMBNAIL_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'thumbnails')
+THUMBNAIL_INTERVAL = 10  # seconds of video per sprite tile
+THUMBNAIL_WIDTH = 160
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10  # tiles beyond COLUMNS x ROWS continue on the next sprite sheet
+POSTER_WIDTH = 480
+POSTER_POSITION = 0.1  # fraction of the duration, past opening logos and black frames
+THUMBNAIL_COST_CORES = 1  # one single-threaded FFmpeg at a time
+THUMBNAIL_BATCH_DELAY = 5  # seconds to let more new files arrive before starting a batch
+THUMBNAIL_TIMEOUT = 1800  # seconds per file
+_thumbnail_queue = queue.Queue()
+_thumbnail_pending = set()
+_thumbnail_thread = None
+_thumbnail_lock = threading.Lock()
+mimetypes.add_type('text/vtt', '.vtt')
+# Text subtitle tracks, converted to WebVTT on first request
+SUBTITLE_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'subtitles')
+TEXT_SUBTITLE_CODECS = ('subrip', 'srt', 'ass', 'ssa', 'webvtt', 'mov_text', 'text')  # bitmap subtitles can't become WebVTT
+SUBTITLE_TIMEOUT = 300  # seconds; extraction reads through the whole file
+_subtitle_inflight = {}  # output path -> Event set once its extraction finishes
+_subtitle_lock = threading.Lock()
+# Pre-transcoded renditions of the most watched files, encoded while the server is idle
+RENDITION_CACHE_FOLDER = os.path.join(CACHE_FOLDER, 'renditions')
+RENDITION_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+RENDITION_CHECK_INTERVAL = 300  # seconds between idle checks
+RENDITION_IDLE_CPU_PERCENT = 25  # system CPU usage below which the server counts as idle
+RENDITION_MIN_SESSIONS = 2  # a file must have been streamed this often to be worth pre-encoding
+RENDITION_CANDIDATES = 10  # most watched files considered per pass
+_pretranscoder_thread = None
+_rendition_lock = threading.Lock()
+# Per-file encoder tuning: short sample encodes pick the cheapest settings that keep up on this machine
+TUNE_PRESETS = ('veryfast', 'superfast', 'ultrafast')  # best compression first
+TUNE_CRFS = (21, 23, 26)  # best quality first; the profile bitrate still caps the output
+TUNE_THREADS = tuple(t for t in (1, 2, 4, 8) if t <= TRANSCODE_BUDGET_CORES) or (1,)
+TUNE_SCALES = ('1920:-2', '1280:-2')  # tried in turn when nothing keeps up at the source size
+TUNE_MIN_SPEED = 1.2  # realtime factor a live transcode has to sustain
+TUNE_SAMPLE_SECONDS = 10
+TUNE_SAMPLE_POSITION = 0.3  # fraction of the duration where the sample starts
+TUNE_IDLE_WAIT = 60  # seconds between idle checks while files wait to be tuned
+_tune_queue = queue.Queue()
+_tune_pending = set()
+_tune_thread = None
+_tune_lock = threading.Lock()
+# Offloading encodes to worker nodes (other machines running `python app.py --worker`)
+WORKER_NODES = []  # worker base URLs, e.g. 'http://10.0.0.5:5001'; empty encodes everything here
+WORKER_TOKEN = os.environ.get('LETSWATCH_WORKER_TOKEN')  # shared secret, sent as X-Worker-Token
+WORKER_SOURCE_URL = None  # base URL workers fetch /videos/ from; None uses the host the viewer requested
+WORKER_MODE = False  # set by --worker; the /worker/ endpoints answer 404 otherwise
+WORKER_HEALTH_INTERVAL = 5  # seconds between health checks
+WORKER_CONNECT_TIMEOUT = 5  # seconds
+WORKER_READ_TIMEOUT = 30  # seconds a worker may go without sending output
+WORKER_MAX_FAILURES = 2  # failed health checks before a worker is taken out of rotation
+WORKER_FRAGMENT_SECONDS = 2  # fragment length of remote conversions, which progress is estimated from
+WORKER_LOOPBACK_BASE_PORT = 5101
+WORKER_STATUS = {}  # url -> {'healthy', 'stats', 'failures', 'assigned', 'checked_at'}
+_worker_lock = threading.Lock()
+_worker_health_thread = None
+_loopback_workers = []
+# Background sampling of FFmpeg process CPU/RSS for /metrics and /stream-stats
+METRICS_SAMPLE_INTERVAL = 5  # seconds
+PROCESS_SAMPLES = {}  # pid -> {'cpu_percent', 'rss'}
+_sampled_processes = {}  # pid -> psutil.Process, kept so cpu_percent measures between samples
+_system_cpu_percent = 0.0
+_sampler_thread = None
+_sampler_lock = threading.Lock()
+_cleanup_thread = None
+_cleanup_lock = threading.Lock()
+# Background conversion jobs
+JOBS_FILE = os.path.join(CACHE_FOLDER, 'jobs.json')
+JOB_PRIORITIES = {'high': 0, 'normal': 1, 'low': 2}
+# Each libx264 encode already spreads over several cores, so run a fraction of the CPU count at once
+CONVERSION_WORKERS = max(1, (os.cpu_count() or 1) // 4)
+MAX_FINISHED_JOBS = 200  # finished jobs kept in the history
+# Long transcodes are split at keyframes and the chunks encoded by several FFmpeg processes at once
+CHUNKED_CONVERT_MIN_DURATION = 600  # seconds; shorter files convert in one process
+CHUNK_MIN_SECONDS = 30
+CHUNKS_PER_PROCESS = 4  # more chunks than processes, so one slow chunk doesn't leave the others idle
+MAX_CHUNK_PROCESSES = max(1, TRANSCODE_BUDGET_CORES // CONVERT_THREADS)
+CHUNK_WORK_FOLDER = os.path.join(CACHE_FOLDER, 'chunks')
+CONVERSION_JOBS = {}
+_job_queue = queue.PriorityQueue()
+_jobs_lock = threading.Lock()
+_conversion_workers_started = False
 
 # Enhanced logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout),
-        logging.FileHandler('video_server.log')
-    ]
-)
+LOG_FILE = 'video_server.log'
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+
+def setup_logging():
+    """Log through a queue so request threads never block on stdout or the log file.
+
+    A QueueListener thread formats and writes records to stdout and a size-rotated
+    log file.
+    """
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT)
+    for handler in (stream_handler, file_handler):
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))  # The listener's handlers add the rest
+    logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Flush queued records on shutdown
+    return listener
+
+_log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
-def check_ffmpeg():
-    """Check if FFmpeg is installed on the system and return version info"""
+class MetricsRegistry:
+    """Counters, gauges and histograms rendered in the Prometheus text exposition format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._meta = {}  # name -> (type, help, buckets)
+        self._values = {}  # (name, labels) -> float, or [bucket counts, sum, count] for histograms
+
+    def describe(self, name, metric_type, help_text, buckets=None):
+        self._meta[name] = (metric_type, help_text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        buckets = self._meta[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._values.setdefault(key, [[0] * len(buckets), 0.0, 0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def get(self, name, **labels):
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def remove(self, name, **labels):
+        with self._lock:
+            self._values.pop((name, tuple(sorted(labels.items()))), None)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+    def render(self, extra_samples=()):
+        """Render all series, plus (name, labels dict, value) samples computed at scrape time"""
+        with self._lock:
+            values = dict(self._values)
+        for name, labels, value in extra_samples:
+            values[(name, tuple(sorted(labels.items())))] = value
+
+        lines = []
+        for name in sorted({name for name, _ in values}):
+            metric_type, help_text, buckets = self._meta.get(name, ('untyped', '', None))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {metric_type}')
+            for (series_name, labels), value in sorted(values.items(), key=lambda item: str(item[0])):
+                if series_name != name:
+                    continue
+                if metric_type == 'histogram':
+                    counts, total, count = value
+                    for bound, bucket_count in zip(buckets, counts):
+                        lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {bucket_count}')
+                    lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {total}')
+                    lines.append(f'{name}_count{self._labels(labels)} {count}')
+                else:
+                    lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry()
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+METRICS.describe('letswatch_stream_ttfb_seconds', 'histogram', 'Time from /stream/ request to first byte sent', LATENCY_BUCKETS)
+METRICS.describe('letswatch_stream_bytes_sent_total', 'counter', 'Bytes sent to /stream/ viewers')
+METRICS.describe('letswatch_stream_sessions_total', 'counter', 'Viewer sessions started on /stream/')
+METRICS.describe('letswatch_ffprobe_calls_total', 'counter', 'ffprobe invocations')
+METRICS.describe('letswatch_ffprobe_duration_seconds', 'histogram', 'ffprobe latency', LATENCY_BUCKETS)
+METRICS.describe('letswatch_cache_requests_total', 'counter', 'Cache lookups by cache and result (hit/miss)')
+METRICS.describe('letswatch_admission_rejections_total', 'counter', 'Sessions rejected with 503 for lack of encode capacity')
+METRICS.describe('letswatch_stream_sessions_reaped_total', 'counter', 'Viewer sessions torn down by the server, by reason')
+METRICS.describe('letswatch_active_sessions', 'gauge', 'Viewer sessions currently attached to /stream/')
+METRICS.describe('letswatch_active_broadcasts', 'gauge', 'FFmpeg live transcodes currently running')
+METRICS.describe('letswatch_session_bytes_sent', 'gauge', 'Bytes sent so far per viewer session')
+METRICS.describe('letswatch_session_throughput_bytes_per_second', 'gauge', 'Average throughput per viewer session')
+METRICS.describe('letswatch_ffmpeg_speed', 'gauge', 'FFmpeg encode speed as a realtime factor, per broadcast')
+METRICS.describe('letswatch_ffmpeg_fps', 'gauge', 'FFmpeg encode frames per second, per broadcast')
+METRICS.describe('letswatch_ffmpeg_cpu_percent', 'gauge', 'Sampled CPU usage per FFmpeg process')
+METRICS.describe('letswatch_ffmpeg_rss_bytes', 'gauge', 'Sampled resident memory per FFmpeg process')
+METRICS.describe('letswatch_system_cpu_percent', 'gauge', 'Sampled system-wide CPU usage')
+METRICS.describe('letswatch_conversion_jobs', 'gauge', 'Conversion jobs by status')
+METRICS.describe('letswatch_scheduler_cores', 'gauge', 'Encode budget usage in cores by kind')
+METRICS.describe('letswatch_encoder_tune_trials_total', 'counter', 'Encoder tuning sample encodes, by result')
+METRICS.describe('letswatch_worker_healthy', 'gauge', 'Whether a worker node passed its last health check')
+METRICS.describe('letswatch_worker_dispatches_total', 'counter', 'Encodes sent to worker nodes, by worker and result')
+METRICS.describe('letswatch_relay_buffers_total', 'counter', 'Relay buffers handed out by the pool, by result (reused/allocated)')
+METRICS.describe('letswatch_device_io_wait_seconds', 'histogram', 'Time heavy readers waited for a slot on their device', LATENCY_BUCKETS)
+METRICS.describe('letswatch_device_io_overflows_total', 'counter', 'Viewer reads that went over their device limit after waiting')
+METRICS.describe('letswatch_device_readers', 'gauge', 'Heavy readers holding a slot, by device and kind')
+METRICS.describe('letswatch_device_queued_readers', 'gauge', 'Heavy readers waiting for a slot, by device and kind')
+METRICS.describe('letswatch_device_read_bytes_total', 'counter', 'Bytes read from each block device (all processes, from the kernel)')
+METRICS.describe('letswatch_device_read_bytes_per_second', 'gauge', 'Read throughput per block device over the last sample interval')
+METRICS.describe('letswatch_device_busy_percent', 'gauge', 'Time each block device spent servicing I/O over the last sample interval')
+
+def get_ffmpeg_capabilities():
+    """Detect FFmpeg and its encoders once, instead of spawning it on every request.
+
+    A missing FFmpeg is re-checked after FFMPEG_RECHECK_INTERVAL seconds so installing
+    it doesn't require a restart.
+    """
+    global _ffmpeg_caps
+    caps = _ffmpeg_caps
+    if caps and (caps['available'] or time.time() - caps['checked_at'] < FFMPEG_RECHECK_INTERVAL):
+        return caps
+    
+    caps = {'available': False, 'version': None, 'encoders': set(), 'checked_at': time.time()}
     try:
-        result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
-        logger.info(f"FFmpeg found: {result.stdout.splitlines()[0]}")
-        return True
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True)
+        caps['encoders'] = {line.split()[1] for line in result.stdout.splitlines()
+                            if len(line.split()) > 1 and re.match(r'^ [VAS][.A-Z]{5} ', line)}
+        version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
+        caps['version'] = version.stdout.splitlines()[0]
+        caps['available'] = True
+        logger.info(f"FFmpeg found: {caps['version']}")
     except FileNotFoundError:
         logger.warning("FFmpeg not found. Video conversion and streaming will not be available.")
-        return False
+    _ffmpeg_caps = caps
+    return caps
+
+def check_ffmpeg():
+    """Check if FFmpeg is installed on the system (cached)"""
+    return get_ffmpeg_capabilities()['available']
 
 def create_directories():
     """Create necessary directories"""
-    for directory in [VIDEO_FOLDER, CONVERTED_FOLDER, 'static', 'temp']:
+    for directory in [VIDEO_FOLDER, CONVERTED_FOLDER, CACHE_FOLDER, RENDITION_CACHE_FOLDER, 'static', 'temp']:
         if not os.path.exists(directory):
             os.makedirs(directory)
             logger.info(f"Created directory: {directory}")
 
-def convert_video(input_file, output_file):
-    """Convert video to MP4 format using FFmpeg"""
-    try:
-        # Use FFmpeg to convert the video to MP4 format
-        cmd = [
-            'ffmpeg', '-i', input_file, 
-            '-c:v', 'libx264', '-c:a', 'aac', 
-            '-strict', 'experimental', 
-            '-b:a', '192k', '-f', 'mp4',
-            '-y',  # Overwrite output files without asking
-            output_file
-        ]
-        logger.info(f"Running conversion command: {' '.join(cmd)}")
+class AdmissionError(Exception):
+    """Raised when the transcode budget has no room for a new session"""
+
+class TranscodeTicket:
+    """A slice of the encode budget held by one live session or batch job"""
+
+    def __init__(self, kind, cost, label):
+        self.kind = kind  # 'live' or 'batch'
+        self.cost = cost  # in cores
+        self.label = label
+        self.processes = []
+        self.paused = False
+        self.pauses = 0  # times the ticket was suspended, so timing-sensitive work can tell
+        self.released = False
+
+class TranscodeScheduler:
+    """Global encode budget, measured in cores, shared by live streams and batch work.
+
+    Live sessions only compete with other live sessions: batch processes are reniced
+    and suspended (SIGSTOP via psutil) whenever live demand leaves them no room, and
+    resumed once it drops. New live sessions that don't fit wait briefly and are then
+    rejected with AdmissionError; batch work simply waits for room.
+    """
+
+    def __init__(self, budget_cores):
+        self.budget = budget_cores
+        self.live = []
+        self.batch = []  # in admission order; earlier jobs keep running first
+        self.cond = threading.Condition()
+
+    def _cores(self, tickets, running_only=False):
+        return sum(t.cost for t in tickets if not (running_only and t.paused))
+
+    def _has_room(self, kind, cost):
+        live_cores = self._cores(self.live)
+        if kind == 'live':
+            # Always admit one session, even if it alone is bigger than the budget
+            return not self.live or live_cores + cost <= self.budget
+        if not self.live and not self.batch:
+            return True
+        return live_cores + self._cores(self.batch, running_only=True) + cost <= self.budget
+
+    def acquire(self, kind, cost, label='', timeout=None):
+        """Reserve cores for a session, waiting up to timeout seconds (None waits forever)"""
+        deadline = None if timeout is None else time.time() + timeout
+        with self.cond:
+            while not self._has_room(kind, cost):
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise AdmissionError(f"No encode capacity for {label or kind} "
+                                         f"({self._cores(self.live)}/{self.budget} cores used by live streams)")
+                self.cond.wait(remaining)
+            ticket = TranscodeTicket(kind, cost, label)
+            (self.live if kind == 'live' else self.batch).append(ticket)
+            self._rebalance()
+        return ticket
+
+    def attach_process(self, ticket, process):
+        """Register an FFmpeg process started under a ticket"""
+        with self.cond:
+            ticket.processes.append(process)
+            if ticket.kind == 'batch':
+                try:
+                    psutil.Process(process.pid).nice(BATCH_NICE)
+                except (psutil.Error, OSError) as e:
+                    logger.debug(f"Couldn't renice {ticket.label}: {e}")
+                if ticket.paused:
+                    self._signal(ticket, pause=True)
+
+    def resize(self, ticket, cost):
+        with self.cond:
+            ticket.cost = cost
+            self._rebalance()
+
+    def expand(self, ticket, cost):
+        """Grow a running batch ticket towards cost using only spare cores; returns its new cost"""
+        with self.cond:
+            if not ticket.paused:
+                spare = self.budget - self._cores(self.live) - self._cores(self.batch, running_only=True)
+                ticket.cost = max(ticket.cost, min(cost, ticket.cost + spare))
+                self._rebalance()
+            return ticket.cost
+
+    def release(self, ticket):
+        """Return a ticket's cores to the budget (safe to call more than once)"""
+        with self.cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.paused:
+                self._signal(ticket, pause=False)  # A stopped process can't act on SIGTERM
+                ticket.paused = False
+            (self.live if ticket.kind == 'live' else self.batch).remove(ticket)
+            self._rebalance()
+            self.cond.notify_all()
+
+    def _rebalance(self):
+        """Suspend or resume batch processes to fit whatever live streams leave free"""
+        available = self.budget - self._cores(self.live)
+        used = 0
+        for ticket in self.batch:
+            fits = used + ticket.cost <= available or (used == 0 and not self.live)
+            if fits:
+                used += ticket.cost
+            if ticket.paused == fits:  # paused but fits, or running but doesn't
+                ticket.paused = not fits
+                ticket.pauses += ticket.paused
+                self._signal(ticket, pause=ticket.paused)
+                logger.info(f"{'Paused' if ticket.paused else 'Resumed'} batch job {ticket.label} "
+                            f"({self._cores(self.live)} live cores in use)")
+        self.cond.notify_all()
+
+    def _signal(self, ticket, pause):
+        for process in ticket.processes:
+            try:
+                if process.poll() is None:
+                    proc = psutil.Process(process.pid)
+                    proc.suspend() if pause else proc.resume()
+            except (psutil.Error, OSError) as e:
+                logger.debug(f"Couldn't {'pause' if pause else 'resume'} {ticket.label}: {e}")
+
+    def status(self):
+        with self.cond:
+            return {
+                'budget_cores': self.budget,
+                'live_cores': self._cores(self.live),
+                'batch_cores': self._cores(self.batch, running_only=True),
+                'live_sessions': len(self.live),
+                'batch_running': sum(1 for t in self.batch if not t.paused),
+                'batch_paused': sum(1 for t in self.batch if t.paused)
+            }
+
+SCHEDULER = TranscodeScheduler(TRANSCODE_BUDGET_CORES)
+
+def get_live_cost(plan, settings=None):
+    """Cores a live session is expected to use for a given transcode plan and settings"""
+    if plan['mode'] == 'remux':
+        return REMUX_COST_CORES
+    if plan['mode'] == 'copy-video':
+        return AUDIO_TRANSCODE_COST_CORES
+    return (settings or {}).get('threads', STREAM_THREADS)
+
+def _lookup_block_device(st_dev):
+    sys_path = os.path.realpath(f"/sys/dev/block/{os.major(st_dev)}:{os.minor(st_dev)}")
+    if not os.path.isdir(sys_path):
+        return None, False
+    if os.path.exists(os.path.join(sys_path, 'partition')):
+        sys_path = os.path.dirname(sys_path)  # Seeks and kernel counters belong to the whole disk
+    try:
+        with open(os.path.join(sys_path, 'queue', 'rotational')) as f:
+            rotational = f.read().strip() == '1'
+    except OSError:
+        rotational = False
+    return os.path.basename(sys_path), rotational
+
+def get_block_device(path):
+    """(name, rotational) of the disk holding path, e.g. ('sda', True).
+
+    (None, False) for files without one: tmpfs, network mounts and btrfs, whose
+    st_dev is an anonymous device.
+    """
+    try:
+        st_dev = os.stat(path).st_dev
+    except OSError:
+        return None, False
+    device = _block_devices.get(st_dev)
+    if device is None:
+        device = _block_devices[st_dev] = _lookup_block_device(st_dev)
+    return device
+
+def get_device_reader_limit(device, rotational):
+    """Heavy readers a device takes at once; 0 means no limit"""
+    if device is None:
+        return 0
+    return IO_DEVICE_READERS.get(device, IO_ROTATIONAL_READERS if rotational else IO_SOLID_STATE_READERS)
+
+def readahead_worker():
+    """Issue WILLNEED hints off the request and relay threads, since the call blocks while the device queue is full"""
+    while True:
+        path, offset, length = _readahead_queue.get()
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            logger.debug(f"Read-ahead of {path} failed: {e}")
+
+def request_readahead(path, offset, length):
+    """Have the kernel read part of a file into the page cache in large requests, ahead of its reader"""
+    global _readahead_thread
+    if not hasattr(os, 'posix_fadvise') or length <= 0:
+        return
+    with _readahead_lock:
+        if _readahead_thread is None:
+            _readahead_thread = threading.Thread(target=readahead_worker, daemon=True)
+            _readahead_thread.start()
+    try:
+        _readahead_queue.put_nowait((path, offset, length))
+    except queue.Full:
+        pass  # Only a hint; the reader still gets the data, in smaller requests
+
+def advise_sequential(fd, offset=0):
+    """Tell the kernel a file will be read front to back, which doubles its read-ahead window"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+def drop_page_cache(path, flush=False):
+    """Evict a file from the page cache (POSIX_FADV_DONTNEED).
+
+    Dirty pages can't be dropped, so flush=True writes a freshly written file out first.
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if flush:
+                os.fdatasync(fd)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+    except OSError as e:
+        logger.debug(f"Couldn't drop {path} from the page cache: {e}")
+
+class IoSlot:
+    """One heavy reader's place on a block device, which also paces read-ahead of its file"""
+
+    def __init__(self, path, device, kind, label):
+        self.path = os.path.abspath(path)
+        self.device = device
+        self.kind = kind  # 'live' (viewers) or 'batch'
+        self.label = label
+        self.over_limit = False
+        self.released = False
+        self.expires = None  # once past, the slot is held but no longer counts against the limit
+        self._bytes_per_second = 0
+        self._start_offset = 0
+        self._prefetched = 0  # end of the last read-ahead window
+
+    def counts(self, now):
+        """Whether the slot still counts against its device's limit"""
+        return self.expires is None or now < self.expires
+
+    def follow(self, start_seconds, duration):
+        """Keep IO_READAHEAD_BYTES ahead of a reader going through the file from start_seconds.
+
+        The byte position is estimated from the average bitrate, so the window is generous.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return
+        if duration <= 0:
+            return
+        self._bytes_per_second = size / duration
+        self._start_offset = self._prefetched = int(start_seconds * self._bytes_per_second)
+        self.advance(0)
+
+    def advance(self, seconds):
+        """The reader has got `seconds` of media past its start; top up the read-ahead every half window"""
+        if not self._bytes_per_second:
+            return
+        position = self._start_offset + int(seconds * self._bytes_per_second)
+        if position + IO_READAHEAD_BYTES // 2 < self._prefetched:
+            return
+        start = max(position, self._prefetched)
+        self._prefetched = position + IO_READAHEAD_BYTES
+        request_readahead(self.path, start, self._prefetched - start)
+
+class DeviceIoScheduler:
+    """Caps the heavy readers of media files (live transcodes, large /videos/ responses,
+    conversions) on each block device.
+
+    A spinning disk serving several sequential readers spends its time seeking between
+    them, so each device admits a limited number at once. Viewers ('live') are only
+    counted against each other and never fail: one that waits IO_INTERACTIVE_WAIT
+    without a slot reads anyway, over the limit. Batch readers wait until the device
+    has room and no viewer is queued for it. Slots taken with a window (file responses,
+    which players read at the playback rate once buffered) stop counting after it.
+    """
+
+    def __init__(self):
+        self.readers = {}  # device -> [IoSlot]
+        self.queued = collections.Counter()  # (device, kind) -> readers waiting
+        self.limits = {}  # device -> limit, as last looked up
+        self.cond = threading.Condition()
+
+    def _has_room(self, device, kind, limit):
+        now = time.time()
+        readers = [slot for slot in self.readers.get(device, ()) if slot.counts(now)]
+        if kind == 'live':
+            return sum(1 for slot in readers if slot.kind == 'live') < limit
+        return len(readers) < limit and not self.queued[(device, 'live')]
+
+    def _next_expiry(self, device):
+        now = time.time()
+        return min((slot.expires for slot in self.readers.get(device, ())
+                    if slot.expires is not None and slot.expires > now), default=None)
+
+    def acquire(self, path, kind, label='', window=None):
+        """Take a slot on path's device, waiting for room (viewers wait at most IO_INTERACTIVE_WAIT).
+
+        With a window, the slot only counts against the limit for that many seconds after it is granted.
+        """
+        device, rotational = get_block_device(path)
+        limit = get_device_reader_limit(device, rotational)
+        slot = IoSlot(path, device, kind, label)
+        started = time.time()
+        with self.cond:
+            self.limits[device] = limit
+            if limit:
+                deadline = started + IO_INTERACTIVE_WAIT if kind == 'live' else None
+                self.queued[(device, kind)] += 1
+                try:
+                    while not self._has_room(device, kind, limit):
+                        remaining = None if deadline is None else deadline - time.time()
+                        if remaining is not None and remaining <= 0:
+                            slot.over_limit = True
+                            break
+                        # Nobody notifies when a slot's window runs out, so wake up for it
+                        expiry = self._next_expiry(device)
+                        if expiry is not None and (remaining is None or expiry - time.time() < remaining):
+                            remaining = expiry - time.time()
+                        self.cond.wait(remaining)
+                finally:
+                    self.queued[(device, kind)] -= 1
+            if window:
+                slot.expires = time.time() + window
+            self.readers.setdefault(device, []).append(slot)
+        if limit:
+            METRICS.observe('letswatch_device_io_wait_seconds', time.time() - started, device=device, kind=kind)
+        if slot.over_limit:
+            METRICS.inc('letswatch_device_io_overflows_total', device=device)
+            logger.info(f"{label or kind} is reading from {device} over its limit of {limit} readers")
+        return slot
+
+    def release(self, slot):
+        """Give a slot back (safe to call more than once)"""
+        with self.cond:
+            if slot.released:
+                return
+            slot.released = True
+            self.readers[slot.device].remove(slot)
+            self.cond.notify_all()
+
+    def is_reading(self, path, kind=None):
+        """Whether a reader of that kind (any, by default) holds a slot for path"""
+        path = os.path.abspath(path)
+        with self.cond:
+            return any(slot.path == path and kind in (None, slot.kind)
+                       for readers in self.readers.values() for slot in readers)
+
+    def status(self):
+        """device -> readers holding and waiting for a slot, by kind"""
+        with self.cond:
+            devices = {device for device in self.readers if device} | {device for device, _ in self.queued if device}
+            return {device: {
+                'limit': self.limits.get(device, 0),
+                'live': sum(1 for slot in self.readers.get(device, ()) if slot.kind == 'live'),
+                'batch': sum(1 for slot in self.readers.get(device, ()) if slot.kind == 'batch'),
+                'queued_live': self.queued[(device, 'live')],
+                'queued_batch': self.queued[(device, 'batch')]
+            } for device in devices}
+
+DEVICE_IO = DeviceIoScheduler()
+
+def acquire_stream_source(input_path, start_time, filename):
+    """Live slot on the device of a file about to be streamed from start_time, with read-ahead"""
+    slot = DEVICE_IO.acquire(input_path, 'live', f"stream:{filename}")
+    slot.follow(float(start_time), get_video_duration(input_path))
+    return slot
+
+def end_batch_read(slot, *outputs):
+    """Release a batch reader's slot and drop the source and outputs it pulled into the page cache.
+
+    The source stays cached while a viewer is reading it.
+    """
+    DEVICE_IO.release(slot)
+    if not DEVICE_IO.is_reading(slot.path):
+        drop_page_cache(slot.path)
+    for output in outputs:
+        if os.path.exists(output):
+            drop_page_cache(output, flush=True)
+
+class SessionLimitError(AdmissionError):
+    """Raised when the global cap on viewer sessions is reached"""
+
+class StreamSessionManager:
+    """Thread-safe registry of /stream/ viewer sessions.
+
+    Each session records its last successful write. Disconnected clients are torn
+    down by their response; the reaper only ends sessions idle for longer than
+    idle_timeout (a half-open socket that never errors), so it must stay well above
+    how long a viewer may keep playback paused. Opening a session
+    past the per-client cap evicts that client's most idle session; past the global
+    cap, it raises SessionLimitError.
+    """
+
+    def __init__(self, max_sessions, max_per_client, idle_timeout):
+        self.max_sessions = max_sessions
+        self.max_per_client = max_per_client
+        self.idle_timeout = idle_timeout
+        self._sessions = {}  # session_id -> info dict
+        self._lock = threading.Lock()
+
+    def open(self, session_id, client, **info):
+        """Register a session and return the ids of sessions the caller must clean up to make room"""
+        now = time.time()
+        with self._lock:
+            own = sorted((s['last_write'], sid) for sid, s in self._sessions.items() if s['client'] == client)
+            evicted = [sid for _, sid in own[:max(0, len(own) - self.max_per_client + 1)]]
+            if len(self._sessions) - len(evicted) >= self.max_sessions:
+                raise SessionLimitError(f"Session limit reached ({self.max_sessions} streams)")
+            info.update(client=client, started_at=now, last_write=now, bytes_sent=0)
+            self._sessions[session_id] = info
+        return evicted
+
+    def update(self, session_id, **changes):
+        with self._lock:
+            if session_id in self._sessions:
+                self._sessions[session_id].update(changes)
+
+    def touch(self, session_id, bytes_written):
+        """Record a successful write to the client"""
+        with self._lock:
+            info = self._sessions.get(session_id)
+            if info is not None:
+                info['bytes_sent'] += bytes_written
+                info['last_write'] = time.time()
+
+    def close(self, session_id):
+        """Remove a session, returning its info (None if it was already closed)"""
+        with self._lock:
+            info = self._sessions.pop(session_id, None)
+        if info is not None and info['bytes_sent'] > 0:
+            record_watch(os.path.join(VIDEO_FOLDER, info['filename']), info['last_write'] - info['started_at'])
+        return info
+
+    def get(self, session_id):
+        with self._lock:
+            info = self._sessions.get(session_id)
+            return dict(info) if info is not None else None
+
+    def items(self):
+        """Snapshot of (session_id, info) pairs, safe to iterate while sessions come and go"""
+        with self._lock:
+            return [(session_id, dict(info)) for session_id, info in self._sessions.items()]
+
+    def idle(self, now=None):
+        """Ids of sessions without a successful write for longer than idle_timeout"""
+        now = now or time.time()
+        with self._lock:
+            return [session_id for session_id, info in self._sessions.items()
+                    if now - info['last_write'] > self.idle_timeout]
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+ACTIVE_STREAMS = StreamSessionManager(MAX_STREAM_SESSIONS, MAX_SESSIONS_PER_CLIENT, STREAM_IDLE_TIMEOUT)
+
+def open_stream_session(session_id, client, **info):
+    """Register a viewer session, tearing down the client's sessions it displaces"""
+    for evicted in ACTIVE_STREAMS.open(session_id, client, **info):
+        logger.info(f"[Session {evicted[:8]}] Evicted: {client} opened more than "
+                    f"{MAX_SESSIONS_PER_CLIENT} streams")
+        METRICS.inc('letswatch_stream_sessions_reaped_total', reason='evicted')
+        cleanup_stream(evicted)
+
+def admission_rejected_response(error):
+    """503 telling the client when to try again"""
+    logger.warning(f"Rejecting session: {error}")
+    METRICS.inc('letswatch_admission_rejections_total')
+    return Response(
+        str(error), status=503, mimetype='text/plain',
+        headers={'Retry-After': str(ADMISSION_RETRY_AFTER)}
+    )
+
+def get_convert_audio_args(plan):
+    if plan['audio'] == 'copy':
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac', '-strict', 'experimental', '-b:a', '192k']
+
+def build_convert_command(input_file, output_file, plan, fragmented=False):
+    """Build the FFmpeg conversion command, copying streams the plan marks as compatible.
+
+    fragmented writes fragmented MP4 without progress output, for a worker streaming
+    the result back to a front-end node.
+    """
+    cmd = ['ffmpeg', '-loglevel', 'warning', '-i', input_file]
+    if plan['video'] == 'copy':
+        cmd.extend(['-c:v', 'copy'])
+    else:
+        cmd.extend(CONVERT_VIDEO_ARGS)
+    cmd.extend(get_convert_audio_args(plan))
+    if fragmented:
+        cmd.extend(['-nostats', '-movflags', 'empty_moov+default_base_moof',
+                    '-frag_duration', str(WORKER_FRAGMENT_SECONDS * 1000000)])
+    else:
+        cmd.extend(['-progress', 'pipe:1', '-nostats'])  # Machine-readable progress on stdout
+    cmd.extend([
+        '-f', 'mp4',
+        '-y',  # Overwrite output files without asking
+        output_file
+    ])
+    return cmd
+
+def run_ffmpeg_with_progress(cmd, duration, progress_callback=None, ticket=None, processes=None):
+    """Run an FFmpeg command that writes -progress output to stdout, reporting a 0-1 fraction.
+
+    The process is appended to processes, if given, so a caller running several at
+    once can stop the rest when one fails.
+    """
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if processes is not None:
+        processes.append(process)
+    if ticket:
+        SCHEDULER.attach_process(ticket, process)
+    stderr_tail = collections.deque(maxlen=50)
+    stderr_closed = threading.Event()
+    STDERR_READER.register(process.stderr, stderr_tail.append, stderr_closed.set)
+
+    for line in process.stdout:
+        key, _, value = line.strip().partition('=')
+        if key == 'out_time_us' and progress_callback and duration > 0:
+            try:
+                progress_callback(min(int(value) / 1000000 / duration, 1.0))
+            except ValueError:
+                pass  # "N/A" before the first frame is written
+
+    returncode = process.wait()
+    stderr_closed.wait(timeout=5)
+    if returncode != 0:
+        stderr = '\n'.join(line.decode('utf-8', errors='replace') for line in stderr_tail)
+        raise subprocess.CalledProcessError(returncode, cmd, stderr=stderr)
+
+def run_ffmpeg_parallel(commands, durations, workers, progress_callback=None, ticket=None):
+    """Run FFmpeg -progress commands, workers at a time, reporting their combined 0-1 fraction.
+
+    The first failure kills the processes still running and is raised.
+    """
+    done = [0.0] * len(commands)
+    total = sum(durations) or 1
+    processes = []
+    failed = threading.Event()
+
+    def run(index):
+        if failed.is_set():
+            return
+        def report(fraction):
+            done[index] = fraction * durations[index]
+            if progress_callback:
+                progress_callback(min(sum(done) / total, 1.0))
+        run_ffmpeg_with_progress(commands[index], durations[index], report, ticket, processes)
+
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix='chunk-encode') as executor:
+        futures = [executor.submit(run, i) for i in range(len(commands))]
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            failed.set()
+            for future in futures:
+                future.cancel()
+            # A chunk may have been starting while this one failed, so kill until every thread is done
+            while not all(future.done() for future in futures):
+                for process in processes:
+                    if process.poll() is None:
+                        process.kill()
+                time.sleep(0.1)
+            raise
+
+def get_chunk_boundaries(keyframes, duration, chunk_seconds):
+    """Pick keyframe times that split a file into chunks of at least chunk_seconds"""
+    boundaries = []
+    last = 0.0
+    for t in keyframes:
+        # Don't leave a short tail chunk behind the last boundary
+        if t - last >= chunk_seconds and duration - t >= chunk_seconds / 2:
+            boundaries.append(t)
+            last = t
+    return boundaries
+
+def convert_video_chunked(input_file, output_file, plan, duration, progress_callback=None, ticket=None):
+    """Transcode the video in keyframe-aligned chunks, several FFmpeg processes at a time.
+
+    The video stream is cut with the segment muxer (stream copy, so exactly at the
+    probed keyframes), every chunk is encoded with the same settings, and the
+    encoded chunks are joined with the concat demuxer without re-encoding. Audio is
+    converted once, from the source, while joining. Returns False without writing
+    anything when there are no spare cores or too few keyframes to split on.
+    """
+    workers = MAX_CHUNK_PROCESSES
+    original_cost = ticket.cost if ticket else None
+    if ticket:
+        workers = max(1, int(SCHEDULER.expand(ticket, MAX_CHUNK_PROCESSES * CONVERT_THREADS) // CONVERT_THREADS))
+    work_dir = os.path.join(CHUNK_WORK_FOLDER, uuid.uuid4().hex)
+    try:
+        if workers < 2:
+            return False
+        keyframes = get_keyframe_index(input_file)
+        if keyframes is None:
+            keyframes = build_keyframe_index(input_file)
+        chunk_seconds = max(CHUNK_MIN_SECONDS, duration / (workers * CHUNKS_PER_PROCESS))
+        boundaries = get_chunk_boundaries(keyframes, duration, chunk_seconds)
+        if not boundaries:
+            return False
+
+        os.makedirs(work_dir)
+        subprocess.run([
+            'ffmpeg', '-nostdin', '-loglevel', 'error', '-i', input_file,
+            '-map', '0:V:0', '-c', 'copy', '-f', 'segment', '-reset_timestamps', '1',
+            # The segment muxer cuts at the first keyframe at or after each time
+            '-segment_times', ','.join(f"{t - 0.001:.3f}" for t in boundaries),
+            os.path.join(work_dir, 'source%04d.mkv')
+        ], capture_output=True, text=True, check=True)
+        sources = sorted(name for name in os.listdir(work_dir) if name.startswith('source'))
+        edges = [0.0] + boundaries + [duration]
+        durations = [end - start for start, end in zip(edges, edges[1:])]
+        if len(durations) != len(sources):
+            durations = [duration / len(sources)] * len(sources)  # only used for progress
+
+        chunks, commands = [], []
+        for name in sources:
+            chunk = os.path.join(work_dir, name.replace('source', 'encoded').replace('.mkv', '.mp4'))
+            chunks.append(chunk)
+            commands.append(['ffmpeg', '-nostdin', '-loglevel', 'warning', '-i', os.path.join(work_dir, name),
+                             *CONVERT_VIDEO_ARGS, '-progress', 'pipe:1', '-nostats', '-f', 'mp4', '-y', chunk])
+        logger.info(f"Encoding {input_file} as {len(chunks)} chunks on {workers} processes")
+        run_ffmpeg_parallel(commands, durations, workers, progress_callback, ticket)
+        if ticket:
+            SCHEDULER.resize(ticket, original_cost)
+
+        list_file = os.path.join(work_dir, 'chunks.txt')
+        with open(list_file, 'w') as f:
+            f.writelines(f"file '{os.path.basename(chunk)}'\n" for chunk in chunks)
+        subprocess.run([
+            'ffmpeg', '-nostdin', '-loglevel', 'warning',
+            '-f', 'concat', '-safe', '0', '-i', list_file, '-i', input_file,
+            '-map', '0:v:0', '-map', '1:a:0?', '-c:v', 'copy', *get_convert_audio_args(plan),
+            '-movflags', '+faststart', '-f', 'mp4', '-y', output_file
+        ], capture_output=True, text=True, check=True)
+        return True
+    finally:
+        if ticket and ticket.cost != original_cost:
+            SCHEDULER.resize(ticket, original_cost)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def convert_video(input_file, output_file, progress_callback=None, ticket=None):
+    """Convert video to MP4 format using FFmpeg, remuxing instead of re-encoding where possible.
+
+    The output is written to a temporary file and renamed into place, so a partial
+    file never shows up in CONVERTED_FOLDER.
+    """
+    plan = get_transcode_plan(get_media_metadata(input_file))
+    duration = get_video_duration(input_file)
+    temp_file = f"{output_file}.part"
+    try:
+        if plan['video'] == 'transcode' and duration >= CHUNKED_CONVERT_MIN_DURATION:
+            try:
+                chunked = convert_video_chunked(input_file, temp_file, plan, duration, progress_callback, ticket)
+            except subprocess.CalledProcessError as e:
+                chunked = False
+                logger.warning(f"Chunked conversion failed for {input_file}, converting in one process: {e.stderr}")
+            if chunked:
+                os.replace(temp_file, output_file)
+                logger.info(f"Successfully converted {input_file} to {output_file} in chunks")
+                return True
+
+        cmd = build_convert_command(input_file, temp_file, plan)
+        logger.info(f"Running conversion command ({plan['mode']}): {' '.join(cmd)}")
         
-        process = subprocess.run(
-            cmd, 
-            capture_output=True, 
-            text=True,
-            check=True
-        )
+        try:
+            run_ffmpeg_with_progress(cmd, duration, progress_callback, ticket)
+        except subprocess.CalledProcessError as e:
+            if plan['mode'] == 'transcode':
+                raise
+            # The copy path failed (odd bitstream, unsupported in MP4...): fall back to a full encode
+            logger.warning(f"{plan['mode']} conversion failed for {input_file}, falling back to transcode: {e.stderr}")
+            cmd = build_convert_command(input_file, temp_file, TRANSCODE_PLAN)
+            run_ffmpeg_with_progress(cmd, duration, progress_callback, ticket)
         
+        os.replace(temp_file, output_file)
         logger.info(f"Successfully converted {input_file} to {output_file}")
         return True
     except subprocess.CalledProcessError as e:
@@ -75,58 +1111,278 @@ def convert_video(input_file, output_file):
         logger.error(f"Unexpected error in convert_video: {e}")
         logger.error(traceback.format_exc())
         return False
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
 
-def get_video_duration(filename):
-    """Get the duration of a video file using FFmpeg"""
+def get_metadata_db():
+    """Open the SQLite database backing the media metadata index (caller holds _metadata_lock)"""
+    global _metadata_conn
+    if _metadata_conn is None:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        _metadata_conn = sqlite3.connect(METADATA_DB, check_same_thread=False)
+        _metadata_conn.execute(
+            'CREATE TABLE IF NOT EXISTS media ('
+            'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+            'probe TEXT NOT NULL, probed_at REAL NOT NULL)'
+        )
+        _metadata_conn.execute(
+            'CREATE TABLE IF NOT EXISTS keyframes ('
+            'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, times TEXT NOT NULL)'
+        )
+        _metadata_conn.execute(
+            'CREATE TABLE IF NOT EXISTS watch_history ('
+            'path TEXT PRIMARY KEY, sessions INTEGER NOT NULL, seconds REAL NOT NULL, last_watched REAL NOT NULL)'
+        )
+        _metadata_conn.execute(
+            'CREATE TABLE IF NOT EXISTS renditions ('
+            'path TEXT PRIMARY KEY, source TEXT NOT NULL, size INTEGER NOT NULL, '
+            'created REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL)'
+        )
+        _metadata_conn.execute(
+            'CREATE TABLE IF NOT EXISTS encoder_profiles ('
+            'path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime REAL NOT NULL, '
+            'profile TEXT NOT NULL, trials TEXT NOT NULL, tuned_at REAL NOT NULL)'
+        )
+        _metadata_conn.commit()
+    return _metadata_conn
+
+def probe_media(file_path):
+    """Run a single ffprobe over a file and return format and stream data as a dict"""
+    started = time.time()
+    METRICS.inc('letswatch_ffprobe_calls_total')
     try:
         result = subprocess.run([
-            'ffprobe', '-v', 'error', '-show_entries',
-            'format=duration', '-of', 'default=noprint_wrappers=1:nokey=1',
-            filename
+            'ffprobe', '-v', 'error', '-show_format', '-show_streams',
+            '-of', 'json', file_path
         ], capture_output=True, text=True, check=True)
-        return float(result.stdout.strip())
+        METRICS.observe('letswatch_ffprobe_duration_seconds', time.time() - started)
+        return json.loads(result.stdout or '{}')
     except subprocess.CalledProcessError as e:
-        logger.warning(f"Couldn't determine duration for {filename}: {e}")
-        return 0
+        logger.warning(f"Couldn't probe {file_path}: {e}")
     except Exception as e:
-        logger.warning(f"Error getting video duration: {e}")
+        logger.warning(f"Error probing {file_path}: {e}")
+    return {}
+
+def get_media_metadata(file_path):
+    """Return cached ffprobe data for a file, probing again only if its size or mtime changed"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+
+    key = os.path.abspath(file_path)
+    with _metadata_lock:
+        row = get_metadata_db().execute(
+            'SELECT size, mtime, probe FROM media WHERE path = ?', (key,)
+        ).fetchone()
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime:
+        METRICS.inc('letswatch_cache_requests_total', cache='metadata', result='hit')
+        return json.loads(row[2])
+    METRICS.inc('letswatch_cache_requests_total', cache='metadata', result='miss')
+
+    # Failed probes are stored too, so a broken file isn't re-probed on every page load
+    probe = probe_media(file_path)
+    with _metadata_lock:
+        db = get_metadata_db()
+        db.execute(
+            'INSERT OR REPLACE INTO media (path, size, mtime, probe, probed_at) VALUES (?, ?, ?, ?, ?)',
+            (key, stat.st_size, stat.st_mtime, json.dumps(probe), time.time())
+        )
+        db.commit()
+    return probe
+
+def forget_media_metadata(file_path):
+    """Drop the cached metadata for a file that was removed"""
+    with _metadata_lock:
+        db = get_metadata_db()
+        db.execute('DELETE FROM media WHERE path = ?', (os.path.abspath(file_path),))
+        db.commit()
+
+def build_keyframe_index(file_path):
+    """List the keyframe timestamps of the first video stream (decodes keyframes only)"""
+    started = time.time()
+    METRICS.inc('letswatch_ffprobe_calls_total')
+    result = subprocess.run([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+        '-show_entries', 'frame=pts_time', '-of', 'csv=p=0', file_path
+    ], capture_output=True, text=True, check=True)
+    METRICS.observe('letswatch_ffprobe_duration_seconds', time.time() - started)
+    times = []
+    for line in result.stdout.splitlines():
+        try:
+            times.append(float(line.split(',')[0]))
+        except ValueError:
+            continue  # "N/A" for frames without a timestamp
+    return sorted(times)
+
+def get_keyframe_index(file_path):
+    """Return the cached keyframe times for a file, or None if they haven't been indexed yet"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    key = (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+    with _keyframe_lock:
+        if key in _keyframe_cache:
+            return _keyframe_cache[key]
+    
+    with _metadata_lock:
+        row = get_metadata_db().execute(
+            'SELECT times FROM keyframes WHERE path = ? AND size = ? AND mtime = ?', key
+        ).fetchone()
+    if not row:
+        return None
+    times = json.loads(row[0])
+    with _keyframe_lock:
+        _keyframe_cache[key] = times
+    return times
+
+def keyframe_indexer():
+    """Build keyframe indexes in the background as files are first streamed"""
+    while True:
+        file_path = _keyframe_queue.get()
+        try:
+            stat = os.stat(file_path)
+            times = build_keyframe_index(file_path)
+            with _metadata_lock:
+                db = get_metadata_db()
+                db.execute(
+                    'INSERT OR REPLACE INTO keyframes (path, size, mtime, times) VALUES (?, ?, ?, ?)',
+                    (os.path.abspath(file_path), stat.st_size, stat.st_mtime, json.dumps(times))
+                )
+                db.commit()
+            logger.info(f"Indexed {len(times)} keyframes in {file_path}")
+        except Exception as e:
+            logger.warning(f"Error building keyframe index for {file_path}: {e}")
+        finally:
+            with _keyframe_lock:
+                _keyframe_pending.discard(file_path)
+
+def request_keyframe_index(file_path):
+    """Queue a file for keyframe indexing unless it is already indexed or queued"""
+    global _keyframe_thread
+    if get_keyframe_index(file_path) is not None:
+        return
+    with _keyframe_lock:
+        if file_path in _keyframe_pending:
+            return
+        _keyframe_pending.add(file_path)
+        if _keyframe_thread is None:
+            _keyframe_thread = threading.Thread(target=keyframe_indexer, daemon=True)
+            _keyframe_thread.start()
+    _keyframe_queue.put(file_path)
+
+def snap_to_keyframe(file_path, start_time):
+    """Move a seek position back to the keyframe that starts its GOP.
+
+    Starting on a keyframe means FFmpeg doesn't decode and discard frames up to the
+    exact position, and nearby seeks share the same broadcast key.
+    """
+    keyframes = get_keyframe_index(file_path)
+    if keyframes is None:
+        request_keyframe_index(file_path)
+        return start_time
+    position = float(start_time)
+    index = bisect.bisect_right(keyframes, position) - 1
+    if index < 0:
+        return start_time
+    return f"{keyframes[index]:.3f}"
+
+def get_stream_of_type(metadata, codec_type):
+    """Return the first stream of the given type ('video', 'audio', ...) from probe data"""
+    for stream in (metadata or {}).get('streams', []):
+        if stream.get('codec_type') == codec_type:
+            return stream
+    return None
+
+def get_media_tracks(metadata):
+    """Audio and subtitle tracks from probe data, numbered per type as -map 0:a:N and 0:s:N count them"""
+    audio, subtitles = [], []
+    for stream in (metadata or {}).get('streams', []):
+        tags = stream.get('tags') or {}
+        disposition = stream.get('disposition') or {}
+        track = {
+            'codec': stream.get('codec_name'),
+            'language': tags.get('language') or tags.get('LANGUAGE'),
+            'title': tags.get('title') or tags.get('TITLE'),
+            'default': bool(disposition.get('default'))
+        }
+        if stream.get('codec_type') == 'audio':
+            audio.append(dict(track, index=len(audio), channels=stream.get('channels')))
+        elif stream.get('codec_type') == 'subtitle':
+            subtitles.append(dict(track, index=len(subtitles), forced=bool(disposition.get('forced')),
+                                  text=stream.get('codec_name') in TEXT_SUBTITLE_CODECS))
+    return audio, subtitles
+
+def get_transcode_plan(metadata, audio_track=None):
+    """Decide per stream whether FFmpeg can copy it into MP4 or has to re-encode it.
+
+    audio_track picks an audio stream by its position among the audio streams; the
+    plan then carries it, so the command maps that stream instead of FFmpeg's default.
+    """
+    video = get_stream_of_type(metadata, 'video')
+    if audio_track is None:
+        audio = get_stream_of_type(metadata, 'audio')
+    else:
+        audio = [s for s in (metadata or {}).get('streams', []) if s.get('codec_type') == 'audio'][audio_track]
+
+    video_copy = bool(
+        video
+        and video.get('codec_name') in BROWSER_VIDEO_CODECS
+        and video.get('pix_fmt') in BROWSER_PIXEL_FORMATS
+    )
+    if audio is None:
+        audio_mode = 'none'
+    elif audio.get('codec_name') in BROWSER_AUDIO_CODECS and int(audio.get('channels') or 2) <= 2:
+        audio_mode = 'copy'
+    else:
+        audio_mode = 'transcode'
+
+    if video_copy and audio_mode != 'transcode':
+        mode = 'remux'
+    elif video_copy:
+        mode = 'copy-video'
+    elif audio_mode == 'copy':
+        mode = 'copy-audio'
+    else:
+        mode = 'transcode'
+    plan = {'video': 'copy' if video_copy else 'transcode', 'audio': audio_mode, 'mode': mode}
+    if audio_track is not None:
+        plan['audio_track'] = audio_track
+    return plan
+
+def get_video_duration(filename):
+    """Get the duration of a video file from the metadata index"""
+    metadata = get_media_metadata(filename)
+    try:
+        return float(metadata['format']['duration'])
+    except (KeyError, TypeError, ValueError):
+        logger.warning(f"Couldn't determine duration for {filename}")
         return 0
 
 def get_video_codec(filename):
-    """Get video codec information using FFprobe"""
-    try:
-        result = subprocess.run([
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0', 
-            '-show_entries', 'stream=codec_name',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            filename
-        ], capture_output=True, text=True, check=True)
-        return result.stdout.strip()
-    except Exception as e:
-        logger.warning(f"Error getting video codec: {e}")
-        return "unknown"
+    """Get video codec information from the metadata index"""
+    stream = get_stream_of_type(get_media_metadata(filename), 'video')
+    if stream and stream.get('codec_name'):
+        return stream['codec_name']
+    return "unknown"
 
 def get_video_bitrate(filename):
-    """Get video bitrate information using FFprobe"""
-    try:
-        result = subprocess.run([
-            'ffprobe', '-v', 'error', '-select_streams', 'v:0',
-            '-show_entries', 'stream=bit_rate',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            filename
-        ], capture_output=True, text=True, check=True)
-        bitrate = result.stdout.strip()
-        # If bitrate is empty or "N/A", estimate based on file size and duration
-        if not bitrate or bitrate == "N/A":
+    """Get video bitrate information from the metadata index"""
+    stream = get_stream_of_type(get_media_metadata(filename), 'video')
+    bitrate = (stream or {}).get('bit_rate', '')
+    # If bitrate is empty or "N/A", estimate based on file size and duration
+    if not bitrate or bitrate == "N/A":
+        try:
             filesize = os.path.getsize(filename)  # in bytes
-            duration = get_video_duration(filename)  # in seconds
-            if duration > 0:
-                # Estimate bitrate in bits per second
-                bitrate = str(int((filesize * 8) / duration))
-        return bitrate
-    except Exception as e:
-        logger.warning(f"Error getting video bitrate: {e}")
-        return "0"
+        except OSError:
+            return "0"
+        duration = get_video_duration(filename)  # in seconds
+        if duration > 0:
+            # Estimate bitrate in bits per second
+            bitrate = str(int((filesize * 8) / duration))
+    return bitrate
 
 def get_video_info(filename):
     """Get detailed information about the video file"""
@@ -158,108 +1414,632 @@ def get_video_info(filename):
         'is_large': size > 1000  # Consider files > 1GB as large
     }
 
+class InotifyWatcher:
+    """Minimal ctypes binding to Linux inotify, used to watch the library folders"""
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}  # watch descriptor -> (library folder, directory path)
+
+    def add_watch(self, folder, directory):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {directory}')
+        self.watches[wd] = (folder, directory)
+
+    def add_tree(self, folder, directory):
+        for root, _, _ in os.walk(directory):
+            self.add_watch(folder, root)
+
+    def read_events(self, timeout=None):
+        """Block until events arrive and return them as (wd, mask, name) tuples"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+def _catalog_relpath(folder, file_path):
+    return os.path.relpath(file_path, folder).replace(os.sep, '/')
+
+def _rebuild_catalog_view():
+    """Swap in a sorted snapshot of the catalog (caller holds _catalog_lock)"""
+    global _catalog_view
+    _catalog_view = tuple(sorted(LIBRARY_CATALOG.values(), key=lambda e: (e['folder'], e['filename'].lower())))
+    _bump_catalog_version()
+
+def _bump_catalog_version():
+    """Invalidate cached API queries and ETags (caller holds _catalog_lock)"""
+    global _catalog_version
+    _catalog_version += 1
+    _catalog_queries.clear()
+
+def get_catalog_title(folder, filename, ext, info):
+    """Display title for a catalog entry, formatted once when the entry is built"""
+    title = os.path.splitext(filename)[0]
+    if folder == CONVERTED_FOLDER and title.endswith('_converted'):
+        return title[:-10]
+    if ext != '.mkv' or not info:
+        return title
+    duration_str = time.strftime('%H:%M:%S', time.gmtime(info['duration']))
+    size_str = f"{info['size']:.1f} MB"
+    # Add large file indicator if appropriate
+    size_indicator = f"{size_str} - LARGE FILE" if info['is_large'] else size_str
+    codec_info = f"({info['codec']})" if info['codec'] != "unknown" else ""
+    return f"{title} (MKV - {duration_str}, {size_indicator} {codec_info})"
+
+def _build_catalog_entry(folder, file_path, stat):
+    filename = _catalog_relpath(folder, file_path)
+    entry = {
+        'folder': folder,
+        'filename': filename,
+        'ext': os.path.splitext(filename)[1].lower(),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'info': None,
+        'thumbnails': request_thumbnails(folder, file_path),
+        # Probing happens here, on the scanner thread, never while a page is rendering
+        'codec': get_video_codec(file_path),
+        'duration': get_video_duration(file_path)
+    }
+    entry['audio_tracks'], entry['subtitle_tracks'] = get_media_tracks(get_media_metadata(file_path))
+    if folder == VIDEO_FOLDER and entry['ext'] == '.mkv':
+        entry['info'] = get_video_info(filename)
+        request_encoder_tuning(file_path)
+    entry['title'] = get_catalog_title(folder, filename, entry['ext'], entry['info'])
+    return entry
+
+def update_catalog_path(folder, file_path, rebuild=True):
+    """Add, refresh or remove a single file in the catalog"""
+    if not file_path.lower().endswith(MEDIA_EXTENSIONS):
+        return
+    key = (folder, _catalog_relpath(folder, file_path))
+    with _catalog_lock:
+        existing = LIBRARY_CATALOG.get(key)
+
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        if existing:
+            forget_media_metadata(file_path)
+            forget_thumbnails(file_path)
+            with _catalog_lock:
+                LIBRARY_CATALOG.pop(key, None)
+                if rebuild:
+                    _rebuild_catalog_view()
+            logger.info(f"Removed from catalog: {folder}/{key[1]}")
+        return
+
+    if existing and existing['size'] == stat.st_size and existing['mtime'] == stat.st_mtime:
+        return
+    entry = _build_catalog_entry(folder, file_path, stat)
+    with _catalog_lock:
+        LIBRARY_CATALOG[key] = entry
+        if rebuild:
+            _rebuild_catalog_view()
+    logger.info(f"Added to catalog: {folder}/{key[1]}")
+
+def remove_catalog_tree(folder, directory):
+    """Drop every catalog entry below a directory that was removed or moved away"""
+    prefix = _catalog_relpath(folder, directory) + '/'
+    with _catalog_lock:
+        for key in [k for k in LIBRARY_CATALOG if k[0] == folder and k[1].startswith(prefix)]:
+            del LIBRARY_CATALOG[key]
+        _rebuild_catalog_view()
+
+def scan_library():
+    """Walk both library folders (including subdirectories) and sync the catalog"""
+    seen = set()
+    published = time.time()
+    for folder in (VIDEO_FOLDER, CONVERTED_FOLDER):
+        if not os.path.exists(folder):
+            continue
+        for root, _, files in os.walk(folder):
+            for file in files:
+                if file.lower().endswith(MEDIA_EXTENSIONS):
+                    file_path = os.path.join(root, file)
+                    seen.add((folder, _catalog_relpath(folder, file_path)))
+                    update_catalog_path(folder, file_path, rebuild=False)
+                    # Pages don't wait for the first scan, so let them see files as they are probed
+                    if not _catalog_ready.is_set() and time.time() - published >= CATALOG_PUBLISH_INTERVAL:
+                        with _catalog_lock:
+                            _rebuild_catalog_view()
+                        published = time.time()
+
+    with _catalog_lock:
+        for key in [k for k in LIBRARY_CATALOG if k not in seen]:
+            del LIBRARY_CATALOG[key]
+        _rebuild_catalog_view()
+    _catalog_ready.set()
+
+def get_catalog_snapshot():
+    """Return the current catalog as an immutable, sorted tuple of entries"""
+    return _catalog_view
+
+def _handle_library_event(watcher, wd, mask, name):
+    if mask & InotifyWatcher.IN_IGNORED:
+        watcher.watches.pop(wd, None)
+        return
+    if wd not in watcher.watches:
+        return
+    folder, directory = watcher.watches[wd]
+    path = os.path.join(directory, name)
+
+    if mask & InotifyWatcher.IN_ISDIR:
+        if mask & (InotifyWatcher.IN_CREATE | InotifyWatcher.IN_MOVED_TO):
+            watcher.add_tree(folder, path)
+            for root, _, files in os.walk(path):
+                for file in files:
+                    update_catalog_path(folder, os.path.join(root, file))
+        elif mask & (InotifyWatcher.IN_DELETE | InotifyWatcher.IN_MOVED_FROM):
+            remove_catalog_tree(folder, path)
+    elif mask & (InotifyWatcher.IN_CLOSE_WRITE | InotifyWatcher.IN_MOVED_TO |
+                 InotifyWatcher.IN_DELETE | InotifyWatcher.IN_MOVED_FROM):
+        # IN_CREATE alone is ignored for files: wait until the writer closes them
+        update_catalog_path(folder, path)
+
+def library_scanner():
+    """Scan the library once, then apply filesystem changes incrementally"""
+    rescan = False
+    try:
+        scan_library()
+        logger.info(f"Library scan complete: {len(get_catalog_snapshot())} files")
+    except Exception as e:
+        logger.error(f"Error in initial library scan: {e}")
+        rescan = True
+    finally:
+        # Pages stop waiting either way and show what was found
+        _catalog_ready.set()
+
+    watcher = None
+    try:
+        watcher = InotifyWatcher()
+        for folder in (VIDEO_FOLDER, CONVERTED_FOLDER):
+            if os.path.exists(folder):
+                watcher.add_tree(folder, folder)
+    except (OSError, AttributeError) as e:
+        logger.warning(f"inotify unavailable ({e}), polling library every {LIBRARY_POLL_INTERVAL}s")
+        watcher = None
+
+    while True:
+        try:
+            if rescan:
+                scan_library()
+                rescan = False
+            if watcher is None:
+                time.sleep(LIBRARY_POLL_INTERVAL)
+                scan_library()
+                continue
+            for wd, mask, name in watcher.read_events():
+                if mask & InotifyWatcher.IN_Q_OVERFLOW:
+                    logger.warning("inotify queue overflowed, rescanning library")
+                    scan_library()
+                    break
+                _handle_library_event(watcher, wd, mask, name)
+        except Exception as e:
+            logger.error(f"Error in library scanner: {e}")
+            time.sleep(5)
+
+def start_library_scanner():
+    """Start the background library scanner thread (once per process)"""
+    global _scanner_thread
+    with _catalog_lock:
+        if _scanner_thread is not None:
+            return
+        _scanner_thread = threading.Thread(target=library_scanner, daemon=True)
+    _scanner_thread.start()
+
+def _playlist_group(entry):
+    """Playlist order: MP4s from the library, then converted videos, then streamable MKVs"""
+    if entry['folder'] == CONVERTED_FOLDER:
+        return 1
+    return 2 if entry['ext'] == '.mkv' else 0
+
+# Sort keys for /api/videos; (folder, filename) is appended to make every key unique
+CATALOG_SORTS = {
+    'playlist': lambda e: (_playlist_group(e), e['filename'].lower()),
+    'name': lambda e: (e['title'].lower(),),
+    'size': lambda e: (e['size'],),
+    'duration': lambda e: (e['duration'],),
+    'mtime': lambda e: (e['mtime'],),
+}
+# Types of each sort key's fields, checked when a cursor comes back
+CATALOG_SORT_TYPES = {
+    'playlist': (int, str),
+    'name': (str,),
+    'size': (int,),
+    'duration': ((int, float),),
+    'mtime': ((int, float),),
+}
+CATALOG_FILTERS = ('codec', 'container')
+
+def is_listed(entry):
+    """Whether a catalog entry shows up in the playlist"""
+    if entry['folder'] == CONVERTED_FOLDER:
+        return entry['ext'] == '.mp4'
+    return entry['ext'] == '.mp4' or bool(entry['info'])
+
+def _matches_filters(entry, filters):
+    for name, values in filters:
+        value = entry['codec'] if name == 'codec' else entry['ext'].lstrip('.')
+        if value.lower() not in values:
+            return False
+    return True
+
+def get_catalog_query(sort, filters):
+    """Sorted (keys, entries) for a sort and filter combination, cached until the catalog changes"""
+    cache_key = (sort, filters)
+    with _catalog_lock:
+        cached = _catalog_queries.get(cache_key)
+        if cached:
+            return cached
+        view, version = _catalog_view, _catalog_version
+    
+    sort_key = CATALOG_SORTS[sort]
+    rows = sorted(
+        ((*sort_key(entry), entry['folder'], entry['filename']), entry)
+        for entry in view if is_listed(entry) and _matches_filters(entry, filters)
+    )
+    result = ([key for key, _ in rows], [entry for _, entry in rows])
+    with _catalog_lock:
+        if version == _catalog_version and len(_catalog_queries) < CATALOG_QUERY_CACHE_SIZE:
+            _catalog_queries[cache_key] = result
+    return result
+
+def encode_catalog_cursor(sort, key):
+    cursor = {'sort': sort, 'key': key}
+    return base64.urlsafe_b64encode(json.dumps(cursor).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_catalog_cursor(cursor, sort):
+    """Sort key of the last entry on the previous page.
+
+    Raises ValueError for a malformed cursor, or one made for a different sort, since
+    its key wouldn't compare with this sort's keys.
+    """
+    try:
+        cursor = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {e}")
+    if not isinstance(cursor, dict) or not isinstance(cursor.get('key'), list):
+        raise ValueError("Invalid cursor")
+    if cursor.get('sort') != sort:
+        raise ValueError(f"Cursor is for sort '{cursor.get('sort')}', not '{sort}'")
+    key = cursor['key']
+    types = CATALOG_SORT_TYPES[sort] + (str, str)  # (folder, filename) make every key unique
+    if len(key) != len(types) or not all(
+            isinstance(value, expected) and not isinstance(value, bool) for value, expected in zip(key, types)):
+        raise ValueError("Invalid cursor")
+    return tuple(key)
+
+def get_catalog_page(sort='playlist', descending=False, filters=(), cursor=None, limit=CATALOG_PAGE_SIZE):
+    """One page of listed entries after the cursor; returns (entries, next_cursor, total).
+
+    Cursors hold the sort key of the last entry sent (keyset pagination), so pages stay
+    consistent while files are added or removed between requests.
+    """
+    keys, entries = get_catalog_query(sort, filters)
+    if descending:
+        end = len(keys) if cursor is None else bisect.bisect_left(keys, decode_catalog_cursor(cursor, sort))
+        start = max(0, end - limit)
+        page = entries[start:end][::-1]
+        last_key = keys[start] if start < end else None
+        has_more = start > 0
+    else:
+        start = 0 if cursor is None else bisect.bisect_right(keys, decode_catalog_cursor(cursor, sort))
+        end = min(len(keys), start + limit)
+        page = entries[start:end]
+        last_key = keys[end - 1] if start < end else None
+        has_more = end < len(keys)
+    next_cursor = encode_catalog_cursor(sort, last_key) if has_more else None
+    return page, next_cursor, len(keys)
+
+def catalog_entry_to_video(entry, has_ffmpeg):
+    """The playlist item for a catalog entry, as rendered by index.html and sent by /api/videos"""
+    file = entry['filename']
+    poster, thumbnails = get_thumbnail_urls(entry)
+    video = {
+        'title': entry['title'],
+        'filename': file,
+        'folder': 'converted' if entry['folder'] == CONVERTED_FOLDER else 'videos',
+        'container': entry['ext'].lstrip('.'),
+        'codec': entry['codec'],
+        'size': entry['size'],
+        'mtime': entry['mtime'],
+        'duration': entry['duration'],
+        'poster': poster,
+        'thumbnails': thumbnails,
+        'audio_tracks': entry['audio_tracks'],
+        'subtitles': [
+            dict(track, url=f"/subtitles/{file}/{track['index']}.vtt"
+                 if track['text'] and entry['folder'] == VIDEO_FOLDER else None)
+            for track in entry['subtitle_tracks']
+        ]
+    }
+    if entry['folder'] == CONVERTED_FOLDER:
+        video.update(src=f'/converted/{file}', type='mp4')
+    elif entry['ext'] == '.mp4':
+        video.update(src=f'/videos/{file}', type='mp4')
+    elif not has_ffmpeg:
+        # Without FFmpeg an MKV can't be streamed or converted
+        video.update(title=f"{os.path.splitext(file)[0]} (MKV - not supported)", src=f'/videos/{file}', type='mkv',
+                     poster=None, thumbnails=None)
+    else:
+        info = entry['info']
+        optimized = '?optimized=1' if info['is_large'] else ''
+        video.update(
+            src=f'/stream/{file}{optimized}',
+            hls=f'/hls/{file}/index.m3u8{optimized}' if info['duration'] > 0 else None,
+            abr=f'/abr/{file}/master.m3u8' if ABR_ENABLED else None,
+            type='mkv',
+            streamable=True
+        )
+    return video
+
 @app.route('/')
 def index():
-    # Scan for video files
-    all_videos = []
-    mkv_files = []
-    mp4_files = []
+    # Read the catalog maintained by the background scanner; only the first page is
+    # rendered, the playlist fetches the rest from /api/videos as it scrolls
+    start_library_scanner()
+    _catalog_ready.wait(CATALOG_READY_WAIT)
     
     # Check if FFmpeg is available
     has_ffmpeg = check_ffmpeg()
-    
-    if os.path.exists(VIDEO_FOLDER):
-        # First find all MKV and MP4 files
-        for file in os.listdir(VIDEO_FOLDER):
-            file_path = os.path.join(VIDEO_FOLDER, file)
-            if file.lower().endswith('.mkv'):
-                info = get_video_info(file)
-                if info:
-                    if has_ffmpeg:
-                        mkv_files.append(info)
-                    else:
-                        # If FFmpeg is not available, mark MKV files as needing conversion
-                        # but we won't be able to convert them
-                        all_videos.append({
-                            'title': f"{os.path.splitext(file)[0]} (MKV - not supported)",
-                            'src': f'/videos/{file}',
-                            'type': 'mkv'
-                        })
-            elif file.lower().endswith('.mp4'):
-                mp4_files.append(file)
-    
-    # Check converted videos
-    converted_videos = []
-    if os.path.exists(CONVERTED_FOLDER):
-        for file in os.listdir(CONVERTED_FOLDER):
-            if file.lower().endswith('.mp4'):
-                converted_videos.append(file)
-    
-    # Build the video list with both original MP4s and converted videos
-    for file in mp4_files:
-        title = os.path.splitext(file)[0]
-        all_videos.append({
-            'title': title,
-            'src': f'/videos/{file}',
-            'type': 'mp4'
-        })
-    
-    for file in converted_videos:
-        title = os.path.splitext(file)[0]
-        # Remove the "_converted" suffix if present
-        if title.endswith("_converted"):
-            title = title[:-10]
-        all_videos.append({
-            'title': f"{title}",
-            'src': f'/converted/{file}',
-            'type': 'mp4'
-        })
-    
-    # Add MKV files that can be streamed
-    if has_ffmpeg:
-        for info in mkv_files:
-            file = info['filename']
-            title = os.path.splitext(file)[0]
-            duration_str = time.strftime('%H:%M:%S', time.gmtime(info['duration']))
-            size_str = f"{info['size']:.1f} MB"
-            
-            # Add large file indicator if appropriate
-            size_indicator = f"{size_str} - LARGE FILE" if info['is_large'] else size_str
-            codec_info = f"({info['codec']})" if info['codec'] != "unknown" else ""
-            
-            all_videos.append({
-                'title': f"{title} (MKV - {duration_str}, {size_indicator} {codec_info})",
-                'src': f'/stream/{file}{"?optimized=1" if info["is_large"] else ""}',
-                'type': 'mkv',
-                'streamable': True
-            })
+    entries, next_cursor, total = get_catalog_page()
+    videos = [catalog_entry_to_video(entry, has_ffmpeg) for entry in entries]
     
     # Log found videos
-    if not all_videos:
+    if not total:
         logger.warning(f"No video files found in {VIDEO_FOLDER}.")
         
-    return render_template('index.html', videos=all_videos, has_ffmpeg=has_ffmpeg)
-
-@app.route('/videos/<path:filename>')
-def stream_video(filename):
-    """Stream original videos"""
-    file_path = os.path.join(VIDEO_FOLDER, filename)
-    if not os.path.exists(file_path):
-        logger.error(f"File not found: {file_path}")
-        abort(404)
-    return send_from_directory(VIDEO_FOLDER, filename)
+    return render_template('index.html', videos=videos, has_ffmpeg=has_ffmpeg, next_cursor=next_cursor)
 
-@app.route('/converted/<path:filename>')
-def stream_converted_video(filename):
-    """Stream converted videos"""
-    file_path = os.path.join(CONVERTED_FOLDER, filename)
-    if not os.path.exists(file_path):
-        logger.error(f"Converted file not found: {file_path}")
-        abort(404)
-    return send_from_directory(CONVERTED_FOLDER, filename)
+@app.route('/api/videos')
+def api_videos():
+    """Page through the catalog as JSON.
 
-def get_optimal_streaming_settings(file_path, is_large=False):
-    """Calculate optimal streaming settings based on file characteristics"""
+    Query parameters: sort (playlist, name, size, duration, mtime), order (asc, desc),
+    codec and container (comma-separated, e.g. codec=h264,hevc), limit and cursor
+    (the next_cursor of the previous page). Responses carry an ETag that changes with
+    the catalog, so unchanged pages are answered with 304.
+    """
+    start_library_scanner()
+    _catalog_ready.wait(CATALOG_READY_WAIT)
+    
+    sort = request.args.get('sort', 'playlist')
+    if sort not in CATALOG_SORTS:
+        return {'error': f"Unknown sort '{sort}'"}, 400
+    order = request.args.get('order', 'asc')
+    if order not in ('asc', 'desc'):
+        return {'error': f"Unknown order '{order}'"}, 400
+    try:
+        limit = min(max(int(request.args.get('limit', CATALOG_PAGE_SIZE)), 1), CATALOG_MAX_PAGE_SIZE)
+    except ValueError:
+        return {'error': 'limit must be an integer'}, 400
+    filters = tuple(
+        (name, frozenset(v.strip().lower() for v in request.args[name].split(',') if v.strip()))
+        for name in CATALOG_FILTERS if request.args.get(name)
+    )
+    has_ffmpeg = check_ffmpeg()
+    
+    # Validators first, so a revalidation skips building the page
+    etag = hashlib.sha1(f"{_catalog_version}:{has_ffmpeg}:{request.query_string.decode('latin-1')}"
+                        .encode('utf-8')).hexdigest()[:20]
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    
+    try:
+        entries, next_cursor, total = get_catalog_page(sort, order == 'desc', filters,
+                                                       request.args.get('cursor'), limit)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    response = app.response_class(json.dumps({
+        'videos': [catalog_entry_to_video(entry, has_ffmpeg) for entry in entries],
+        'next_cursor': next_cursor,
+        'total': total
+    }), mimetype='application/json')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # Always revalidate; the 304 is cheap
+    return response
+
+def get_file_etag(stat):
+    """Stable strong ETag derived from inode, size and modification time"""
+    return f'"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"'
+
+def _resolve_ranges(byte_ranges, size):
+    """Turn parsed Range header ranges into absolute (start, end) pairs, end exclusive"""
+    resolved = []
+    for begin, end in byte_ranges:
+        if begin < 0:  # Suffix range: the last -begin bytes
+            begin, end = max(size + begin, 0), size
+        else:
+            end = size if end is None else min(end, size)
+        if begin < end:
+            resolved.append((begin, end))
+    return resolved
+
+def _if_range_matches(if_range, etag, stat):
+    """Whether a Range request may be honoured given its If-Range precondition"""
+    if if_range.etag is None and if_range.date is None:
+        return True
+    if if_range.etag:
+        return if_range.etag == etag.strip('"')
+    return if_range.date is not None and int(stat.st_mtime) <= if_range.date.timestamp()
+
+def _read_file_range(path, start, end, chunk_size=FILE_CHUNK_SIZE):
+    with open(path, 'rb') as f:
+        advise_sequential(f.fileno(), start)
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+class ServedFile(io.BufferedReader):
+    """A file opened for a response, which gives back its reader's disk slot when the server closes it"""
+
+    def __init__(self, path, io_slot=None):
+        super().__init__(io.FileIO(path, 'rb'), FILE_CHUNK_SIZE)
+        self.io_slot = io_slot
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            if self.io_slot:
+                DEVICE_IO.release(self.io_slot)
+
+class ClosingBody:
+    """Response iterable that calls on_close when the server closes it, even if it never started"""
+
+    def __init__(self, body, on_close):
+        self._body = body
+        self._on_close = on_close
+
+    def __iter__(self):
+        return iter(self._body)
+
+    def close(self):
+        try:
+            if hasattr(self._body, 'close'):
+                self._body.close()
+        finally:
+            self._on_close()
+
+def _multipart_ranges(path, ranges, size, mimetype, boundary):
+    for start, end in ranges:
+        yield (f'\r\n--{boundary}\r\n'
+               f'Content-Type: {mimetype}\r\n'
+               f'Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n').encode('latin-1')
+        yield from _read_file_range(path, start, end)
+    yield f'\r\n--{boundary}--\r\n'.encode('latin-1')
+
+def serve_media_file(folder, filename):
+    """Serve a library file with ETag/conditional caching and single or multi-range support.
+
+    Whole files and open-ended ranges ("bytes=N-", what players send while scrubbing)
+    go through the server's wsgi.file_wrapper. Only WSGI servers that implement it with
+    sendfile() (gunicorn, for one) make that zero-copy; app.run and asgi.py read the file
+    in FILE_CHUNK_SIZE chunks. With SENDFILE_OFFLOAD set, the transfer is handed to a
+    reverse proxy via X-Accel-Redirect (nginx) or X-Sendfile (Apache/lighttpd) instead.
+    """
+    file_path = safe_join(folder, filename)
+    try:
+        stat = os.stat(file_path) if file_path else None
+    except OSError:
+        stat = None
+    if stat is None or not stat_module.S_ISREG(stat.st_mode):
+        logger.error(f"File not found: {os.path.join(folder, filename)}")
+        abort(404)
+    
+    size = stat.st_size
+    etag = get_file_etag(stat)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': 'no-cache'  # Always revalidate; a 304 is cheap
+    }
+    
+    # Conditional GET: If-None-Match takes precedence over If-Modified-Since
+    if request.headers.get('If-None-Match'):
+        if request.if_none_match.contains_weak(etag.strip('"')) or request.if_none_match.star_tag:
+            return Response(status=304, headers=headers)
+    elif request.if_modified_since and int(stat.st_mtime) <= request.if_modified_since.timestamp():
+        return Response(status=304, headers=headers)
+    
+    if SENDFILE_OFFLOAD == 'x-accel':
+        # nginx serves the bytes (including ranges) from its internal location
+        # nginx decodes the header as a URI, so %, ? and # in names must be escaped
+        headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX}/{folder}/{urllib.parse.quote(filename)}"
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    if SENDFILE_OFFLOAD == 'x-sendfile':
+        headers['X-Sendfile'] = os.path.abspath(file_path)
+        return Response(status=200, headers=headers, mimetype=mimetype)
+    
+    ranges = None
+    if request.range and request.range.units == 'bytes' and _if_range_matches(request.if_range, etag, stat):
+        ranges = _resolve_ranges(request.range.ranges, size)
+        if not ranges:
+            headers['Content-Range'] = f'bytes */{size}'
+            return Response(status=416, headers=headers)
+        if len(ranges) > MAX_RANGES_PER_REQUEST:
+            ranges = None  # Too fragmented to be worth it; send the whole file
+    
+    # Large reads queue for their disk like transcodes do, and count as heavy readers while the player buffers
+    io_slot = None
+    if request.method != 'HEAD':
+        for start, end in ranges or [(0, size)]:
+            request_readahead(file_path, start, min(end - start, IO_SERVE_READAHEAD_BYTES))
+        if sum(end - start for start, end in ranges or [(0, size)]) >= IO_HEAVY_READ_BYTES:
+            io_slot = DEVICE_IO.acquire(file_path, 'live', f"serve:{filename}", window=IO_SERVE_SLOT_SECONDS)
+    
+    if ranges and len(ranges) > 1:
+        boundary = uuid.uuid4().hex
+        body = _multipart_ranges(file_path, ranges, size, mimetype, boundary)
+        if io_slot:
+            body = ClosingBody(body, lambda: DEVICE_IO.release(io_slot))
+        return Response(body, status=206, headers=headers,
+                        mimetype=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+    
+    start, end = ranges[0] if ranges else (0, size)
+    headers['Content-Length'] = str(end - start)
+    if ranges:
+        headers['Content-Range'] = f'bytes {start}-{end - 1}/{size}'
+    
+    if end == size:
+        # Runs to EOF, so the server's file wrapper can send it as-is (sendfile under gunicorn, not app.run or asgi.py)
+        f = ServedFile(file_path, io_slot)
+        advise_sequential(f.fileno(), start)
+        f.seek(start)
+        body = wrap_file(request.environ, f, FILE_CHUNK_SIZE)
+    else:
+        body = _read_file_range(file_path, start, end)
+        if io_slot:
+            body = ClosingBody(body, lambda: DEVICE_IO.release(io_slot))
+    return Response(body, status=206 if ranges else 200, headers=headers,
+                    mimetype=mimetype, direct_passthrough=True)
+
+@app.route('/videos/<path:filename>')
+def stream_video(filename):
+    """Stream original videos"""
+    return serve_media_file(VIDEO_FOLDER, filename)
+
+@app.route('/converted/<path:filename>')
+def stream_converted_video(filename):
+    """Stream converted videos"""
+    return serve_media_file(CONVERTED_FOLDER, filename)
+
+def get_default_streaming_settings(file_path, is_large=False):
+    """Calculate streaming settings from file size and system memory, before any tuning"""
     # Get system information
     system_memory = psutil.virtual_memory().total / (1024 * 1024 * 1024)  # in GB
     cpu_count = psutil.cpu_count(logical=False) or 2  # Physical CPU cores, minimum 2
@@ -319,15 +2099,817 @@ def get_optimal_streaming_settings(file_path, is_large=False):
             'scale': None
         }
 
+def get_optimal_streaming_settings(file_path, is_large=False):
+    """Default streaming settings, with the file's tuned encoder profile applied once it has one"""
+    settings = get_default_streaming_settings(file_path, is_large)
+    profile = get_encoder_profile(os.path.join(VIDEO_FOLDER, file_path))
+    if profile:
+        settings.update(profile)
+    return settings
+
+def get_source_streaming_settings(input_path):
+    """get_optimal_streaming_settings() for a library file given by path, as /stream/ names it"""
+    return get_optimal_streaming_settings(os.path.relpath(input_path, VIDEO_FOLDER))
+
+def get_video_rate_args(settings):
+    """libx264 rate control: constant quality capped at the profile bitrate once tuned, else a plain bitrate"""
+    if settings.get('crf') is None:
+        return ['-b:v', settings['video_bitrate']]
+    return ['-crf', str(settings['crf']), '-maxrate', settings['video_bitrate'], '-bufsize', settings['video_bitrate']]
+
+def build_stream_command(input_path, start_time, settings, plan=TRANSCODE_PLAN):
+    """Build the FFmpeg command that writes a file as fragmented MP4 to stdout"""
+    cmd = ['ffmpeg']
+    
+    # Warnings and errors only, plus machine-readable progress blocks, on stderr
+    cmd.extend(['-loglevel', 'warning', '-nostats', '-progress', 'pipe:2'])
+    
+    # Input options
+    cmd.extend([
+        '-nostdin',          # Don't expect input from stdin to prevent freezes
+        '-ss', start_time,   # Start time for seeking
+    ])
+    
+    # Add input file path
+    cmd.extend(['-i', input_path])
+    
+    # Video from a rendition with the audio track remuxed in from the source file
+    audio_input = plan.get('audio_input')
+    if audio_input:
+        cmd.extend(['-ss', start_time, '-i', audio_input])
+    
+    # A chosen audio track replaces FFmpeg's default stream selection
+    if plan.get('audio_track') is not None:
+        cmd.extend(['-map', '0:V:0', '-map', f"{1 if audio_input else 0}:a:{plan['audio_track']}"])
+    
+    # Video options
+    if plan['video'] == 'copy':
+        cmd.extend(['-c:v', 'copy'])  # Already browser-compatible, just remux
+    else:
+        cmd.extend([
+            '-c:v', 'libx264',        # Video codec
+            '-preset', settings['preset'],
+            '-tune', 'zerolatency',   # Minimize latency
+            *get_video_rate_args(settings),
+            '-threads', str(settings.get('threads', STREAM_THREADS)),
+            # A keyframe shortly after the start keeps the first fragment small, then regular GOPs
+            '-force_key_frames',
+            f'expr:gte(t,if(eq(n_forced,0),{STREAM_FIRST_FRAGMENT},n_forced*{STREAM_KEYFRAME_INTERVAL}))',
+        ])
+        
+        # Optionally scale down for large files
+        if settings['scale']:
+            cmd.extend(['-vf', f'scale={settings["scale"]}'])
+    
+    # Audio options
+    if plan['audio'] == 'copy':
+        cmd.extend(['-c:a', 'copy'])
+    else:
+        cmd.extend([
+            '-c:a', 'aac',            # Audio codec
+            '-b:a', settings['audio_bitrate'],  # Audio bitrate
+        ])
+    
+    # Output options
+    cmd.extend([
+        '-sn',                    # Subtitles are served as WebVTT by /subtitles/
+        '-f', 'mp4',              # Output format
+        '-movflags', 'frag_keyframe+empty_moov+default_base_moof',  # Fragment at every keyframe
+        '-max_muxing_queue_size', '1024',  # Increase muxing queue for complex files
+    ])
+    
+    # Output to pipe
+    cmd.append('-')
+    
+    return cmd
+
 def create_stream_session_id():
     """Generate a unique session ID for a stream"""
     import uuid
     return str(uuid.uuid4())
 
+class BufferPool:
+    """Free lists of bytearrays in power-of-two size classes, reused instead of reallocated.
+
+    At most max_bytes of idle buffers are kept. A buffer must not be touched after release().
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._free = collections.defaultdict(list)  # size -> idle buffers
+        self._idle_bytes = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, size):
+        size = 1 << max(0, size - 1).bit_length()
+        with self._lock:
+            if self._free[size]:
+                self._idle_bytes -= size
+                METRICS.inc('letswatch_relay_buffers_total', result='reused')
+                return self._free[size].pop()
+        METRICS.inc('letswatch_relay_buffers_total', result='allocated')
+        return bytearray(size)
+
+    def release(self, buffer):
+        with self._lock:
+            if self._idle_bytes + len(buffer) <= self.max_bytes:
+                self._free[len(buffer)].append(buffer)
+                self._idle_bytes += len(buffer)
+
+RELAY_BUFFERS = BufferPool(RELAY_POOL_MAX_BYTES)
+
+class Mp4FragmentSplitter:
+    """Incrementally split fragmented MP4 output into its init segment and moof+mdat fragments.
+
+    Output is assembled in one buffer from RELAY_BUFFERS: readers either readinto() the
+    view returned by writable() and commit() the byte count, or feed() bytes they already
+    have. Each init segment or fragment is copied out once, into the bytes object all
+    viewers share. close() hands the buffer back to the pool.
+    """
+
+    def __init__(self):
+        self.init_segment = None
+        self._buffer = RELAY_BUFFERS.acquire(RELAY_MIN_READ)
+        self._end = 0  # bytes received of the init segment or fragment being assembled
+        self._scan = 0  # offset of the next box header
+
+    def writable(self, size):
+        """View of the next size bytes of free space; fill it, then pass the count to commit()"""
+        if self._end + size > len(self._buffer):
+            larger = RELAY_BUFFERS.acquire(self._end + size)
+            larger[:self._end] = memoryview(self._buffer)[:self._end]
+            RELAY_BUFFERS.release(self._buffer)
+            self._buffer = larger
+        return memoryview(self._buffer)[self._end:self._end + size]
+
+    def commit(self, count):
+        """Account for count bytes written into writable() and return the fragments they completed"""
+        self._end += count
+        fragments = []
+        start = 0
+        with memoryview(self._buffer) as view:
+            while self._end - self._scan >= 8:
+                size, box_type = struct.unpack_from('>I4s', view, self._scan)
+                if size == 1:
+                    if self._end - self._scan < 16:
+                        break
+                    size = struct.unpack_from('>Q', view, self._scan + 8)[0]
+                if size < 8 or self._end - self._scan < size:
+                    break  # Incomplete box (size 0 "to end of file" never occurs in fragmented output)
+                self._scan += size
+
+                if self.init_segment is None:
+                    if box_type == b'moov':
+                        self.init_segment = bytes(view[start:self._scan])
+                        start = self._scan
+                elif box_type == b'mdat':
+                    fragments.append(bytes(view[start:self._scan]))
+                    start = self._scan
+            tail = bytes(view[start:self._end]) if start else None
+        if tail is not None:
+            # Only the start of the next fragment (less than one read) moves to the front
+            self._buffer[:len(tail)] = tail
+            self._end -= start
+            self._scan -= start
+        return fragments
+
+    def feed(self, data):
+        """Consume a chunk of FFmpeg output and return the fragments it completed"""
+        self.writable(len(data))[:] = data
+        return self.commit(len(data))
+
+    def close(self):
+        if self._buffer is not None:
+            RELAY_BUFFERS.release(self._buffer)
+            self._buffer = None
+
+class RelayReadSizer:
+    """Read size that picks up about RELAY_READ_INTERVAL of output at the measured output rate"""
+
+    def __init__(self, initial_size):
+        self.size = min(max(initial_size, RELAY_MIN_READ), RELAY_MAX_READ)
+        self._started = time.monotonic()
+        self._bytes = 0
+
+    def record(self, count):
+        """Account for one read; returns True when the read size changed"""
+        self._bytes += count
+        elapsed = time.monotonic() - self._started
+        if elapsed < RELAY_RATE_WINDOW:
+            return False
+        target = int(self._bytes / elapsed * RELAY_READ_INTERVAL)
+        size = min(RELAY_MAX_READ, max(RELAY_MIN_READ, 1 << max(0, target - 1).bit_length()))
+        self._started, self._bytes = time.monotonic(), 0
+        changed, self.size = size != self.size, size
+        return changed
+
+def grow_pipe(stream, size):
+    """Let a pipe hold at least size bytes, so that one read can return that much (Linux)"""
+    if not hasattr(fcntl, 'F_SETPIPE_SZ'):
+        return
+    try:
+        fd = stream.fileno()
+        if fcntl.fcntl(fd, fcntl.F_GETPIPE_SZ) < size:
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except (AttributeError, OSError, ValueError):
+        pass  # Not a pipe (a worker's response), or above /proc/sys/fs/pipe-max-size
+
+def split_progress_line(line):
+    """(key, value) for an FFmpeg -progress line such as b'speed=1.5x', or None for a log message"""
+    key, sep, value = line.partition(b'=')
+    if not sep or not key or b' ' in key:
+        return None
+    return key, value
+
+class FfmpegStderrReader:
+    """One selector thread reading the stderr of every FFmpeg process.
+
+    Each registered pipe gets an on_line callback, called with raw bytes lines (split
+    on both '\\n' and '\\r'), and an optional on_close called once the pipe hits EOF.
+    Callbacks run on the reader thread, so they must be quick.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._pending = []  # (pipe, on_line, on_close) waiting to be registered
+        self._wake_r, self._wake_w = os.pipe()
+        self._thread = None
+
+    def register(self, pipe, on_line, on_close=None):
+        with self._lock:
+            self._pending.append((pipe, on_line, on_close))
+            if self._thread is None:
+                self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        os.write(self._wake_w, b'\0')
+
+    def _run(self):
+        while True:
+            for key, _ in self._selector.select():
+                if key.data is None:
+                    os.read(self._wake_r, 4096)
+                    with self._lock:
+                        pending, self._pending = self._pending, []
+                    for pipe, on_line, on_close in pending:
+                        self._selector.register(pipe, selectors.EVENT_READ, {
+                            'on_line': on_line, 'on_close': on_close, 'partial': b''})
+                else:
+                    self._read(key)
+
+    def _read(self, key):
+        state = key.data
+        try:
+            data = os.read(key.fd, 65536)
+        except OSError:
+            data = b''
+        lines = (state['partial'] + data).replace(b'\r', b'\n').split(b'\n')
+        state['partial'] = lines.pop() if data else b''
+        for line in lines:
+            if line:
+                self._call(state['on_line'], line)
+        if not data:
+            self._selector.unregister(key.fileobj)
+            key.fileobj.close()
+            if state['on_close']:
+                self._call(state['on_close'])
+
+    @staticmethod
+    def _call(callback, *args):
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"Error handling FFmpeg stderr: {e}")
+
+STDERR_READER = FfmpegStderrReader()
+
+class TranscodeBroadcast:
+    """A single FFmpeg process whose fMP4 output is shared by all viewers of the same transcode.
+
+    The init segment is kept for the lifetime of the broadcast and the most recent
+    fragments are held in a ring buffer, so viewers who attach later start from the
+    oldest buffered fragment. Slow viewers hold back the encoder (as the pipe did when
+    each viewer had its own process) for at most BROADCAST_LAG_TIMEOUT seconds, after
+    which they skip ahead to the oldest fragment still buffered.
+    """
+
+    def __init__(self, key, cmd, settings, filename, mode='transcode', fallback_cmd=None, ticket=None, io_slot=None):
+        self.key = key
+        self.ticket = ticket  # Share of the encode budget held while FFmpeg runs
+        self.io_slot = io_slot  # Place among the readers of the source's disk, also held while FFmpeg runs
+        self.cmd = cmd
+        self.mode = mode
+        self.fallback_cmd = fallback_cmd  # Full transcode to use if a copy/remux run fails
+        self.settings = settings
+        self.filename = filename
+        self.process = None
+        self.init_segment = None
+        self.fragments = collections.deque()  # (sequence number, bytes)
+        self.next_seq = 0
+        self.viewers = {}  # session_id -> next sequence number to send
+        self.refs = 0
+        self.finished = False
+        self.started_at = time.time()
+        self.encode_fps = 0.0
+        self.encode_speed = 0.0
+        self.encoded_seconds = 0.0  # position reached in the output, from -progress
+        self._progress = {}  # the -progress block being read
+        self.cond = threading.Condition()
+
+    @property
+    def short_id(self):
+        return f"{id(self) & 0xffffffff:08x}"
+
+    def start(self):
+        self._spawn()
+        threading.Thread(target=self._read_output, daemon=True).start()
+
+    def _spawn(self):
+        self.process = subprocess.Popen(
+            self.cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            bufsize=0  # _pump_output reads into its own buffers
+        )
+        if self.ticket:
+            SCHEDULER.attach_process(self.ticket, self.process)
+        logger.info(f"[Broadcast {self.short_id}] Started FFmpeg process ({self.mode}) for {self.filename}")
+        STDERR_READER.register(self.process.stderr, self._handle_log_line)
+
+    def _handle_log_line(self, line):
+        progress = split_progress_line(line.strip())
+        if progress:
+            self._record_progress(*progress)
+        elif line.strip():
+            # With -loglevel warning, anything that isn't progress is a warning or an error
+            logger.warning(f"[Broadcast {self.short_id}] FFmpeg: {line.decode('utf-8', errors='replace').strip()}")
+
+    def _record_progress(self, key, value):
+        """Collect one -progress block and publish it when its closing 'progress=' line arrives"""
+        if key != b'progress':
+            self._progress[key] = value
+            return
+        block, self._progress = self._progress, {}
+        try:
+            self.encode_fps = float(block.get(b'fps', 0))
+            self.encode_speed = float(block.get(b'speed', b'0').rstrip(b'x'))
+        except ValueError:
+            pass  # "N/A" before the first frame is written
+        try:
+            self.encoded_seconds = int(block.get(b'out_time_us', 0)) / 1000000
+        except ValueError:
+            pass
+        if self.io_slot:
+            self.io_slot.advance(self.encoded_seconds)
+
+    def _oldest_seq(self):
+        return self.fragments[0][0] if self.fragments else self.next_seq
+
+    def _read_output(self):
+        try:
+            self._pump_output()
+            if self.init_segment is None and self.fallback_cmd and self.refs > 0:
+                self._fall_back()
+                self._pump_output()
+        except Exception as e:
+            logger.error(f"[Broadcast {self.short_id}] Error reading FFmpeg output: {e}")
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+            # FFmpeg is done; viewers draining the buffer don't need encode capacity or the disk
+            self._release_capacity()
+            logger.info(f"[Broadcast {self.short_id}] FFmpeg output ended for {self.filename}")
+
+    def _fall_back(self):
+        """The copy path produced nothing usable; retry as a full transcode"""
+        logger.warning(f"[Broadcast {self.short_id}] {self.mode} failed for {self.filename} "
+                       f"(exit code {self.process.wait()}), falling back to transcode")
+        self.cmd, self.mode, self.fallback_cmd = self.fallback_cmd, 'transcode', None
+        if self.ticket:
+            SCHEDULER.resize(self.ticket, get_live_cost(TRANSCODE_PLAN, self.settings))
+        self._spawn()
+
+    def _pump_output(self):
+        splitter = Mp4FragmentSplitter()
+        sizer = RelayReadSizer(self.settings['buf_size'])
+        try:
+            while True:
+                # Straight into the splitter's pooled buffer, without a bytes object per read
+                count = self.process.stdout.readinto(splitter.writable(sizer.size))
+                if not count:
+                    break
+                fragments = splitter.commit(count)
+                with self.cond:
+                    if splitter.init_segment is not None and self.init_segment is None:
+                        self.init_segment = splitter.init_segment
+                        self.cond.notify_all()
+                    for fragment in fragments:
+                        self._append_fragment(fragment)
+                if sizer.record(count):
+                    grow_pipe(self.process.stdout, sizer.size)
+        finally:
+            splitter.close()
+
+    def _append_fragment(self, fragment):
+        """Add a fragment to the ring buffer (caller holds self.cond)"""
+        if len(self.fragments) >= BROADCAST_RING_SIZE:
+            # Give lagging viewers a chance to catch up before dropping the oldest fragment
+            deadline = time.time() + BROADCAST_LAG_TIMEOUT
+            while (self.viewers and min(self.viewers.values()) <= self._oldest_seq()
+                   and time.time() < deadline and self.refs > 0):
+                self.cond.wait(timeout=deadline - time.time())
+            self.fragments.popleft()
+        self.fragments.append((self.next_seq, fragment))
+        self.next_seq += 1
+        self.cond.notify_all()
+
+    def subscribe(self, session_id):
+        """Yield the init segment followed by fragments for a single viewer"""
+        with self.cond:
+            while self.init_segment is None and not self.finished:
+                self.cond.wait()
+            if self.init_segment is None:
+                return
+            init_segment = self.init_segment
+            self.viewers[session_id] = self._oldest_seq()
+        yield init_segment
+
+        while True:
+            with self.cond:
+                while True:
+                    if session_id not in self.viewers:
+                        return  # Detached by cleanup_stream
+                    position = max(self.viewers[session_id], self._oldest_seq())
+                    if position < self.next_seq:
+                        fragment = self.fragments[position - self._oldest_seq()][1]
+                        self.viewers[session_id] = position + 1
+                        self.cond.notify_all()
+                        break
+                    if self.finished:
+                        return
+                    self.cond.wait()
+            yield fragment
+
+    def detach(self, session_id):
+        with self.cond:
+            self.viewers.pop(session_id, None)
+            self.cond.notify_all()
+
+    def stop(self):
+        with self.cond:
+            self.refs = 0
+            self.cond.notify_all()
+        try:
+            if self.process and self.process.poll() is None:
+                logger.info(f"[Broadcast {self.short_id}] Last viewer left, stopping FFmpeg")
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    # FFmpeg keeps flushing its encoder on SIGTERM; nobody wants that output
+                    self.process.kill()
+                    self.process.wait(timeout=5)
+        except Exception as e:
+            logger.warning(f"[Broadcast {self.short_id}] Error stopping FFmpeg: {e}")
+        self._release_capacity()
+
+    def _release_capacity(self):
+        if self.ticket:
+            SCHEDULER.release(self.ticket)
+        if self.io_slot:
+            DEVICE_IO.release(self.io_slot)
+
+def get_settings_profile(settings):
+    """Hashable key describing the encoder settings that affect the output"""
+    return tuple(sorted((k, v) for k, v in settings.items() if k != 'buf_size'))
+
+def get_broadcast_key(input_path, start_time, settings, plan):
+    """Viewers whose requests produce the same key can share one FFmpeg process"""
+    return (os.path.abspath(input_path), start_time, plan['mode'], plan.get('audio_track'), get_settings_profile(settings))
+
+def _attach_running_broadcast(key, filename):
+    """Attach to a live broadcast for key, if there is one (caller holds _broadcast_lock)"""
+    broadcast = BROADCASTS.get(key)
+    if broadcast is None or broadcast.finished:
+        return None
+    logger.info(f"[Broadcast {broadcast.short_id}] Reusing running transcode for {filename}")
+    broadcast.refs += 1
+    return broadcast
+
+def acquire_broadcast(input_path, start_time, settings, plan, filename):
+    """Attach to the running transcode for (file, start, profile), starting one if needed.
+
+    Joining a running broadcast is free; starting a new one needs room in the encode
+    budget and raises AdmissionError if none frees up in time.
+    """
+    key = get_broadcast_key(input_path, start_time, settings, plan)
+    with _broadcast_lock:
+        broadcast = _attach_running_broadcast(key, filename)
+        if broadcast:
+            return broadcast
+    
+    if should_offload(plan):
+        broadcast = start_remote_broadcast(key, input_path, start_time, settings, plan, filename)
+        if broadcast:
+            return broadcast
+    
+    # Wait for capacity without holding the registry lock
+    ticket = SCHEDULER.acquire('live', get_live_cost(plan, settings), f"stream:{filename}", LIVE_ADMISSION_TIMEOUT)
+    io_slot = acquire_stream_source(input_path, start_time, filename)  # Never fails, at worst waits briefly
+    with _broadcast_lock:
+        broadcast = _attach_running_broadcast(key, filename)
+        if broadcast:
+            # Someone else started it while we waited
+            SCHEDULER.release(ticket)
+            DEVICE_IO.release(io_slot)
+            return broadcast
+        cmd = build_stream_command(input_path, start_time, settings, plan)
+        fallback_cmd = None
+        if plan['mode'] != 'transcode':
+            # Same inputs and tracks, everything re-encoded
+            fallback_cmd = build_stream_command(input_path, start_time, settings, dict(plan, **TRANSCODE_PLAN))
+        broadcast = TranscodeBroadcast(key, cmd, settings, filename, plan['mode'], fallback_cmd, ticket, io_slot)
+        BROADCASTS[key] = broadcast
+        broadcast.refs += 1
+        try:
+            broadcast.start()
+        except Exception:
+            del BROADCASTS[key]
+            broadcast._release_capacity()
+            raise
+    return broadcast
+
+class WorkerError(Exception):
+    """A worker node couldn't be reached, refused an encode or stopped sending output"""
+
+def get_worker_headers():
+    return {'X-Worker-Token': WORKER_TOKEN} if WORKER_TOKEN else {}
+
+def _worker_connection(url, timeout):
+    parsed = urllib.parse.urlsplit(url)
+    return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+
+class WorkerProcess:
+    """Popen-like handle for an encode running on a worker node.
+
+    stdout is the body of the worker's /worker/transcode response. The worker aborts
+    the (chunked) response if FFmpeg fails, so only a body that ends cleanly counts
+    as exit code 0. There is no local pid to sample, signal or renice.
+    """
+    pid = None
+
+    def __init__(self, worker, payload):
+        self.worker = worker
+        self.returncode = None
+        self.stdout = self
+        self._connection = _worker_connection(worker, WORKER_CONNECT_TIMEOUT)
+        try:
+            headers = {'Content-Type': 'application/json', **get_worker_headers()}
+            self._connection.request('POST', '/worker/transcode', json.dumps(payload), headers)
+            self._connection.sock.settimeout(WORKER_READ_TIMEOUT)  # The worker may queue for admission
+            self._response = self._connection.getresponse()
+            if self._response.status != 200:
+                raise WorkerError(f"{worker} answered {self._response.status}: "
+                                  f"{self._response.read(200).decode('utf-8', errors='replace')}")
+        except (OSError, http.client.HTTPException) as e:
+            self._connection.close()
+            raise WorkerError(f"{worker}: {e}") from e
+        except WorkerError:
+            self._connection.close()
+            raise
+
+    def read1(self, size):
+        try:
+            data = self._response.read1(size)
+        except (OSError, ValueError, http.client.HTTPException) as e:
+            if self.returncode is None:
+                logger.warning(f"Lost the stream from worker {self.worker}: {e}")
+                self.returncode = 1
+            return b''
+        if not data and self.returncode is None:
+            self.returncode = 0
+        return data
+
+    def readinto(self, buffer):
+        data = self.read1(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        return self.returncode
+
+    def terminate(self):
+        """Drop the connection; the worker kills its FFmpeg once it notices"""
+        if self.returncode is None:
+            self.returncode = -15
+        try:
+            # shutdown() wakes a reader blocked on the socket, close() alone doesn't
+            self._connection.sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, AttributeError):
+            pass
+        self._connection.close()
+
+    kill = terminate
+
+def check_worker(url):
+    """Fetch a worker's load report and update its status"""
+    connection = _worker_connection(url, WORKER_CONNECT_TIMEOUT)
+    try:
+        connection.request('GET', '/worker/health', headers=get_worker_headers())
+        response = connection.getresponse()
+        body = response.read()
+        if response.status != 200:
+            raise WorkerError(f"health check answered {response.status}")
+        stats = json.loads(body)
+        error = None if stats.get('ffmpeg') else 'FFmpeg is not installed'
+    except (OSError, ValueError, http.client.HTTPException, WorkerError) as e:
+        stats, error = None, str(e)
+    finally:
+        connection.close()
+
+    with _worker_lock:
+        status = WORKER_STATUS.setdefault(url, {'healthy': False, 'stats': None, 'failures': 0,
+                                                'assigned': 0, 'checked_at': None})
+        was_healthy = status['healthy']
+        status['checked_at'] = time.time()
+        if error is None:
+            # The report includes everything dispatched before it
+            status.update(healthy=True, stats=stats, failures=0, assigned=0)
+        else:
+            status['failures'] += 1
+            status['healthy'] = was_healthy and status['failures'] < WORKER_MAX_FAILURES
+        healthy = status['healthy']
+    if healthy != was_healthy:
+        if healthy:
+            logger.info(f"Worker {url} is up ({stats['budget_cores']} cores)")
+        else:
+            logger.warning(f"Worker {url} is down: {error}")
+    METRICS.set('letswatch_worker_healthy', int(healthy), worker=url)
+
+def mark_worker_failed(url, error, result='failed'):
+    """Take a worker out of rotation until its next successful health check"""
+    with _worker_lock:
+        status = WORKER_STATUS.get(url)
+        if status:
+            status.update(healthy=False, failures=status['failures'] + 1)
+    logger.warning(f"Worker {url} {result}: {error}")
+    METRICS.inc('letswatch_worker_dispatches_total', worker=url, result=result)
+    METRICS.set('letswatch_worker_healthy', 0, worker=url)
+
+def record_worker_dispatch(url, cost):
+    """Count an encode against a worker until its next report includes it"""
+    with _worker_lock:
+        if url in WORKER_STATUS:
+            WORKER_STATUS[url]['assigned'] += cost
+    METRICS.inc('letswatch_worker_dispatches_total', worker=url, result='ok')
+
+def pick_workers(cost, kind='live'):
+    """Healthy workers with room for an encode of `cost` cores, least loaded first.
+
+    Like the local scheduler, live work only competes with live work (a worker pauses
+    its batch jobs for it), and a worker with nothing running always has room.
+    """
+    ranked = []
+    with _worker_lock:
+        for url in WORKER_NODES:
+            status = WORKER_STATUS.get(url)
+            if not status or not status['healthy']:
+                continue
+            stats = status['stats']
+            used = stats['live_cores'] + status['assigned'] + (stats['batch_cores'] if kind == 'batch' else 0)
+            if used and used + cost > stats['budget_cores']:
+                continue
+            ranked.append(((used + cost) / stats['budget_cores'], stats['cpu_percent'], url))
+    return [url for _, _, url in sorted(ranked)]
+
+def worker_health_checker():
+    """Poll every worker's /worker/health so dispatch can pick the least loaded one"""
+    while True:
+        for url in list(WORKER_NODES):
+            try:
+                check_worker(url)
+            except Exception as e:
+                logger.error(f"Error checking worker {url}: {e}")
+        time.sleep(WORKER_HEALTH_INTERVAL)
+
+def start_worker_health_checker():
+    """Start polling worker nodes (once per process, and only if there are any)"""
+    global _worker_health_thread
+    with _worker_lock:
+        if _worker_health_thread is not None or not WORKER_NODES:
+            return
+        _worker_health_thread = threading.Thread(target=worker_health_checker, daemon=True)
+    _worker_health_thread.start()
+
+def get_worker_source_url(input_path, base_url=None):
+    """URL a worker reads input_path from (this server's /videos/ route), or None if it has none"""
+    relpath = os.path.relpath(input_path, VIDEO_FOLDER)
+    if relpath.startswith(os.pardir):
+        return None  # Renditions and other cache files aren't served to workers
+    if base_url is None and has_request_context():
+        base_url = request.host_url
+    base_url = WORKER_SOURCE_URL or base_url
+    if not base_url:
+        return None
+    return f"{base_url.rstrip('/')}/videos/{urllib.parse.quote(relpath.replace(os.sep, '/'))}"
+
+def should_offload(plan):
+    """Only video encodes are worth a network hop; copies stay on this node"""
+    return bool(WORKER_NODES) and plan['video'] == 'transcode'
+
+class RemoteTranscodeBroadcast(TranscodeBroadcast):
+    """A broadcast whose encode runs on a worker node instead of a local FFmpeg process.
+
+    It holds no local ticket while the worker encodes. If the worker fails before
+    the init segment arrives, the broadcast takes a ticket and encodes locally.
+    """
+
+    def __init__(self, key, cmd, settings, filename, plan, worker, payload):
+        super().__init__(key, cmd, settings, filename, plan['mode'], fallback_cmd=cmd)
+        self.plan = plan
+        self.worker = worker
+        self.payload = payload
+
+    def _spawn(self):
+        if self.worker is None:
+            super()._spawn()
+            return
+        self.process = WorkerProcess(self.worker, self.payload)
+        logger.info(f"[Broadcast {self.short_id}] Encoding {self.filename} on worker {self.worker}")
+
+    def _fall_back(self):
+        mark_worker_failed(self.worker, f"stopped before sending any video for {self.filename}")
+        self.ticket = SCHEDULER.acquire('live', get_live_cost(self.plan, self.settings),
+                                        f"stream:{self.filename}", LIVE_ADMISSION_TIMEOUT)
+        self.worker, self.fallback_cmd = None, None
+        if self.refs <= 0:
+            return  # Everyone left while we waited; _read_output releases the ticket
+        logger.warning(f"[Broadcast {self.short_id}] Encoding {self.filename} locally instead")
+        self._spawn()
+
+def build_worker_payload(kind, input_path, plan, start_time=None, settings=None, base_url=None):
+    """Request body for /worker/transcode, or None if workers can't read the input"""
+    source = get_worker_source_url(input_path, base_url)
+    if source is None:
+        return None
+    payload = {'kind': kind, 'source': source, 'plan': plan}
+    if kind == 'stream':
+        payload.update(start_time=start_time, settings=settings)
+    return payload
+
+def start_remote_broadcast(key, input_path, start_time, settings, plan, filename):
+    """Start a broadcast on the least loaded worker that accepts it; None if none does"""
+    payload = build_worker_payload('stream', input_path, plan, start_time, settings)
+    if payload is None:
+        return None
+    cost = get_live_cost(plan, settings)
+    cmd = build_stream_command(input_path, start_time, settings, plan)  # Used if the worker fails
+    for worker in pick_workers(cost):
+        broadcast = RemoteTranscodeBroadcast(key, cmd, settings, filename, plan, worker, payload)
+        broadcast.refs += 1
+        try:
+            broadcast.start()  # Connects without holding _broadcast_lock
+        except WorkerError as e:
+            mark_worker_failed(worker, e)
+            continue
+        record_worker_dispatch(worker, cost)
+        with _broadcast_lock:
+            running = _attach_running_broadcast(key, filename)
+            if running is None:
+                BROADCASTS[key] = broadcast
+                return broadcast
+        broadcast.stop()  # Someone else started it meanwhile
+        return running
+    return None
+
+def release_broadcast(broadcast, session_id):
+    """Drop one viewer from a broadcast and stop its FFmpeg process after the last one leaves"""
+    broadcast.detach(session_id)
+    with _broadcast_lock:
+        broadcast.refs -= 1
+        if broadcast.refs > 0:
+            return
+        if BROADCASTS.get(broadcast.key) is broadcast:
+            del BROADCASTS[broadcast.key]
+    broadcast.stop()
+
 def cleanup_stream(session_id):
     """Clean up resources for a completed stream"""
-    if session_id in ACTIVE_STREAMS:
-        stream_info = ACTIVE_STREAMS.pop(session_id)
+    stream_info = ACTIVE_STREAMS.close(session_id)
+    if stream_info:
+        if stream_info.get('on_cleanup'):
+            # Sessions served outside Flask (see asgi.py) release their own resources
+            stream_info['on_cleanup']()
+            return
+        broadcast = stream_info.get('broadcast')
+        if broadcast:
+            release_broadcast(broadcast, session_id)
+            return
         process = stream_info.get('process')
         
         try:
@@ -338,206 +2920,1782 @@ def cleanup_stream(session_id):
         except Exception as e:
             logger.warning(f"Error during cleanup for session {session_id[:8]}: {e}")
 
-@app.route('/stream/<path:filename>')
-def stream_mkv(filename):
-    """Stream MKV files with on-the-fly transcoding"""
+def prepare_stream(filename, start_time='0', optimized=False, audio_track=None):
+    """Validate a stream request and work out where and how to start it.
+
+    Returns (input_path, start_time, settings, plan); aborts with 404/500 if the file
+    or FFmpeg is missing, and 400 for an audio track the file doesn't have.
+    """
+    input_path = safe_join(VIDEO_FOLDER, filename)
+    
+    # Check if file exists (paths escaping the videos folder count as missing)
+    if input_path is None or not os.path.isfile(input_path):
+        logger.error(f"File not found: {os.path.join(VIDEO_FOLDER, filename)}")
+        abort(404)
+    
+    # Check if FFmpeg is available
+    if not check_ffmpeg():
+        logger.error("FFmpeg not available for streaming")
+        abort(500)
+    
+    # The start time comes from the query string (for seeking)
+    if not re.match(r'^\d+(\.\d+)?$', start_time):
+        start_time = '0'  # Default to 0 if invalid format
+    
+    # Start on a keyframe so FFmpeg doesn't decode frames it would throw away
+    start_time = snap_to_keyframe(input_path, start_time)
+    
+    # Get optimal settings based on file and system
+    settings = get_optimal_streaming_settings(filename, optimized)
+    # Remux instead of re-encoding when the source codecs already play in browsers
+    metadata = get_media_metadata(input_path)
+    if audio_track is not None:
+        audio_tracks, _ = get_media_tracks(metadata)
+        if not audio_track.isdigit() or int(audio_track) >= len(audio_tracks):
+            abort(400)
+        audio_track = int(audio_track)
+    plan = get_transcode_plan(metadata, audio_track)
+    return input_path, start_time, settings, plan
+
+def get_rendition_plan(input_path, plan):
+    """Plan for streaming from a cached rendition of input_path.
+
+    The rendition's video is always copied. A chosen audio track is remuxed in from
+    the source (or re-encoded on its own if browsers can't play it), so switching
+    language never encodes the video again.
+    """
+    if plan.get('audio_track') is None:
+        return REMUX_PLAN
+    return {
+        'video': 'copy',
+        'audio': plan['audio'],
+        'mode': 'remux' if plan['audio'] == 'copy' else 'copy-video',
+        'audio_track': plan['audio_track'],
+        'audio_input': input_path
+    }
+
+@app.route('/stream/<path:filename>')
+def stream_mkv(filename):
+    """Stream MKV files with on-the-fly transcoding, sharing one FFmpeg process per transcode"""
+    request_started = time.time()
+    input_path, start_time, settings, plan = prepare_stream(
+        filename, request.args.get('start', '0'), request.args.get('optimized', '0') == '1',
+        request.args.get('audio'))
+    
+    # A pre-transcoded rendition is served as a plain file, or remuxed when seeking into it.
+    # Range requests for later parts of a file already being played aren't new hits.
+    first_request = not request.range or request.range.ranges[0][0] == 0
+    rendition = None
+    if plan['mode'] != 'remux':  # Remuxing is already cheap, so these never get renditions
+        rendition = get_cached_rendition(input_path, settings, count_hit=first_request)
+    if rendition:
+        if float(start_time) == 0 and plan.get('audio_track') is None:
+            if first_request:
+                record_watch(input_path, 0)
+            return serve_rendition(rendition, start_time)
+        input_path, plan = rendition, get_rendition_plan(input_path, plan)
+        # Copying the rendition's video can only start on one of its own keyframes
+        start_time = snap_to_keyframe(rendition, start_time)
+    
+    # Generate a unique session ID for this stream
+    session_id = create_stream_session_id()
+    
+    try:
+        # Register the viewer first, so sessions it displaces free their encode capacity
+        open_stream_session(session_id, request.remote_addr, filename=filename)
+        broadcast = acquire_broadcast(input_path, start_time, settings, plan, filename)
+    except AdmissionError as e:
+        ACTIVE_STREAMS.close(session_id)
+        return admission_rejected_response(e)
+    except Exception as e:
+        ACTIVE_STREAMS.close(session_id)
+        logger.error(f"[Session {session_id[:8]}] Error starting FFmpeg: {e}")
+        abort(500)
+    
+    # Track this viewer for management
+    ACTIVE_STREAMS.update(session_id, process=broadcast.process, broadcast=broadcast)
+    logger.info(f"[Session {session_id[:8]}] Attached to broadcast {broadcast.short_id} "
+                f"({broadcast.refs} viewer(s)): {' '.join(broadcast.cmd)}")
+    
+    METRICS.inc('letswatch_stream_sessions_total')
+    
+    # Create a generator function that yields the shared fMP4 output
+    def generate():
+        first_chunk = True
+        try:
+            for chunk in broadcast.subscribe(session_id):
+                if first_chunk:
+                    METRICS.observe('letswatch_stream_ttfb_seconds', time.time() - request_started)
+                    first_chunk = False
+                yield chunk
+                # The server asks for the next chunk only once this one has been written
+                ACTIVE_STREAMS.touch(session_id, len(chunk))
+                METRICS.inc('letswatch_stream_bytes_sent_total', len(chunk))
+        except Exception as e:
+            logger.error(f"[Session {session_id[:8]}] Error during streaming: {e}")
+            logger.error(traceback.format_exc())
+        finally:
+            cleanup_stream(session_id)
+            logger.info(f"[Session {session_id[:8]}] Finished streaming {filename}")
+    
+    # Return a streaming response
+    response = Response(
+        generate(), 
+        mimetype='video/mp4',
+        headers={
+            'Accept-Ranges': 'none',  # A live pipe can't serve byte ranges; use /hls/ for seeking
+            'Cache-Control': 'no-cache, no-store, must-revalidate',
+            'Pragma': 'no-cache',
+            'Expires': '0',
+            'X-Stream-Session': session_id,
+            'X-Stream-Start': start_time  # Actual start after snapping to a keyframe
+        }
+    )
+    # Release the viewer even if the client disconnects before the body starts
+    response.call_on_close(lambda: cleanup_stream(session_id))
+    return response
+
+@app.route('/stream-start/<path:filename>')
+def get_stream_start(filename):
+    """Where /stream/ would really start for these query parameters.
+
+    The player can't read X-Stream-Start, so it asks here first and puts the snapped
+    start in the stream URL; its timeline (subtitles, track switches) then matches.
+    """
+    input_path, start_time, settings, plan = prepare_stream(
+        filename, request.args.get('start', '0'), request.args.get('optimized', '0') == '1',
+        request.args.get('audio'))
+    if plan['mode'] != 'remux' and rendition_exists(input_path, settings):
+        start_time = snap_to_keyframe(get_rendition_path(input_path, settings), start_time)
+    return {'success': True, 'start': start_time}
+
+WORKER_SETTINGS_KEYS = ('video_bitrate', 'audio_bitrate', 'preset', 'buf_size', 'scale', 'crf', 'threads')
+WORKER_PLAN_VALUES = {
+    'video': ('copy', 'transcode'),
+    'audio': ('copy', 'transcode', 'none'),
+    'mode': ('remux', 'copy-video', 'copy-audio', 'transcode')
+}
+
+def build_worker_command(payload):
+    """FFmpeg command for a /worker/transcode request; raises ValueError if it is malformed.
+
+    Workers build the command themselves from the same settings /stream/ and
+    conversions use, so front ends never send raw FFmpeg arguments.
+    """
+    source = payload.get('source')
+    if not isinstance(source, str) or urllib.parse.urlsplit(source).scheme not in ('http', 'https'):
+        raise ValueError('source must be an http(s) URL')
+    plan = payload.get('plan')
+    if (not isinstance(plan, dict) or any(plan.get(k) not in values for k, values in WORKER_PLAN_VALUES.items())
+            or not set(plan) <= {*WORKER_PLAN_VALUES, 'audio_track'}  # No local paths (audio_input)
+            or not isinstance(plan.get('audio_track', 0), int)):
+        raise ValueError('invalid plan')
+    if payload.get('kind') == 'convert':
+        return build_convert_command(source, '-', plan, fragmented=True)
+    if payload.get('kind') != 'stream':
+        raise ValueError("kind must be 'stream' or 'convert'")
+
+    start_time = payload.get('start_time')
+    if not isinstance(start_time, str) or not re.match(r'^\d+(\.\d+)?$', start_time):
+        raise ValueError('invalid start_time')
+    settings = payload.get('settings')
+    if (not isinstance(settings, dict) or not set(settings) <= set(WORKER_SETTINGS_KEYS)
+            or not set(WORKER_SETTINGS_KEYS[:5]) <= set(settings)
+            or not all(v is None or isinstance(v, (str, int)) for v in settings.values())
+            or not isinstance(settings['buf_size'], int)):
+        raise ValueError('invalid settings')
+    return build_stream_command(source, start_time, settings, plan)
+
+def check_worker_request():
+    """404 unless this process runs as a worker, 403 without the shared token"""
+    if not WORKER_MODE:
+        abort(404)
+    if WORKER_TOKEN and not hmac.compare_digest(request.headers.get('X-Worker-Token', ''), WORKER_TOKEN):
+        abort(403)
+
+@app.route('/worker/health')
+def worker_health():
+    """Load report polled by front-end nodes"""
+    check_worker_request()
+    start_metrics_sampler()
+    return {
+        'ffmpeg': check_ffmpeg(),
+        'cpu_percent': _system_cpu_percent,
+        'cpu_count': psutil.cpu_count(),
+        'load_average': os.getloadavg()[0],
+        **SCHEDULER.status()
+    }
+
+@app.route('/worker/transcode', methods=['POST'])
+def worker_transcode():
+    """Run one encode for a front-end node and stream FFmpeg's output back as the response body"""
+    check_worker_request()
+    payload = request.get_json(silent=True) or {}
+    try:
+        cmd = build_worker_command(payload)
+    except ValueError as e:
+        return {'success': False, 'error': str(e)}, 400
+
+    source_name = urllib.parse.unquote(urllib.parse.urlsplit(payload['source']).path.rsplit('/', 1)[-1])
+    if payload['kind'] == 'stream':
+        kind, cost = 'live', get_live_cost(payload['plan'], payload['settings'])
+    else:
+        kind, cost = 'batch', CONVERT_THREADS
+    try:
+        ticket = SCHEDULER.acquire(kind, cost, f"worker-{payload['kind']}:{source_name}", LIVE_ADMISSION_TIMEOUT)
+    except AdmissionError as e:
+        return admission_rejected_response(e)
+    try:
+        process = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError:
+        SCHEDULER.release(ticket)
+        raise
+    SCHEDULER.attach_process(ticket, process)
+    stderr_tail = collections.deque(maxlen=20)
+    STDERR_READER.register(process.stderr, lambda line: split_progress_line(line.strip()) or stderr_tail.append(line))
+    logger.info(f"[Worker] Started {payload['kind']} of {source_name} for {request.remote_addr}")
+
+    def finish():
+        if process.poll() is None:
+            process.kill()  # The front end went away
+        process.wait()
+        SCHEDULER.release(ticket)
+
+    def generate():
+        try:
+            yield b''  # Sends the headers now, so the front end knows the encode was accepted
+            while True:
+                data = process.stdout.read1(FILE_CHUNK_SIZE)
+                if not data:
+                    break
+                yield data
+            if process.wait() != 0:
+                # Raising leaves the chunked body unterminated, which the front end reads as a failure
+                stderr = b' | '.join(line.strip() for line in stderr_tail).decode('utf-8', errors='replace')
+                raise WorkerError(f"FFmpeg exited with code {process.returncode}: {stderr}")
+        finally:
+            finish()
+
+    response = Response(generate(), mimetype='video/mp4')
+    response.call_on_close(finish)
+    return response
+
+def get_file_cache_key(file_path):
+    """Short key identifying a particular version (path + size + mtime) of a file"""
+    stat = os.stat(file_path)
+    identity = f"{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime}"
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()[:16]
+
+def get_profile_key(settings):
+    """Short key identifying an encoder settings profile in cache paths"""
+    return hashlib.sha1(repr(get_settings_profile(settings)).encode('utf-8')).hexdigest()[:12]
+
+def get_hls_segment_path(input_path, segment, settings):
+    """Location of a segment in the HLS cache (one directory per file version and profile)"""
+    return os.path.join(HLS_CACHE_FOLDER, get_file_cache_key(input_path), get_profile_key(settings), f'{segment}.ts')
+
+def build_hls_segment_command(input_path, segment, settings, output_path):
+    """Build the FFmpeg command that encodes one HLS segment to MPEG-TS"""
+    start = segment * HLS_SEGMENT_DURATION
+    cmd = [
+        'ffmpeg', '-nostdin', '-v', 'error',
+        '-ss', str(start),
+        '-i', input_path,
+        '-t', str(HLS_SEGMENT_DURATION),
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c:v', 'libx264',
+        '-preset', settings['preset'],
+        *get_video_rate_args(settings),
+        '-pix_fmt', 'yuv420p',
+        '-threads', str(settings.get('threads', STREAM_THREADS)),
+    ]
+    if settings['scale']:
+        cmd.extend(['-vf', f'scale={settings["scale"]}'])
+    cmd.extend([
+        '-c:a', 'aac', '-ac', '2',
+        '-b:a', settings['audio_bitrate'],
+        # Keep timestamps continuous across independently encoded segments
+        '-output_ts_offset', str(start),
+        '-muxdelay', '0',
+        '-f', 'mpegts',
+        '-y', output_path
+    ])
+    return cmd
+
+def enforce_hls_cache_limit(added_bytes=0):
+    """Evict least recently used segments once the HLS cache grows past HLS_CACHE_MAX_BYTES"""
+    global _hls_cache_bytes
+    with _hls_lock:
+        if _hls_cache_bytes is not None:
+            _hls_cache_bytes += added_bytes
+            if _hls_cache_bytes <= HLS_CACHE_MAX_BYTES:
+                return
+
+    segments = []
+    for root, _, files in os.walk(HLS_CACHE_FOLDER):
+        for file in files:
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            segments.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in segments)
+
+    if total > HLS_CACHE_MAX_BYTES:
+        # Served segments have their mtime refreshed, so the oldest mtime is least recently used
+        target = HLS_CACHE_MAX_BYTES * 0.9
+        for _, size, path in sorted(segments):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        logger.info(f"HLS cache trimmed to {total / (1024 * 1024):.0f} MB")
+
+    with _hls_lock:
+        _hls_cache_bytes = total
+
+def get_hls_segment(input_path, segment, settings, kind='live'):
+    """Return the path of a cached segment, encoding it first on a cache miss.
+
+    Player requests are 'live' and raise AdmissionError when the encode budget is full;
+    look-ahead encodes are 'batch' and are skipped (returning None) instead.
+    """
+    output_path = get_hls_segment_path(input_path, segment, settings)
+    try:
+        os.utime(output_path)  # Mark as recently used
+    except FileNotFoundError:
+        pass  # Never encoded, or evicted since; encode it below
+    else:
+        if kind == 'live':
+            METRICS.inc('letswatch_cache_requests_total', cache='hls', result='hit')
+        return output_path
+    if kind == 'live':
+        METRICS.inc('letswatch_cache_requests_total', cache='hls', result='miss')
+
+    with _hls_lock:
+        event = _hls_inflight.get(output_path)
+        is_owner = event is None
+        if is_owner:
+            event = _hls_inflight[output_path] = threading.Event()
+    if not is_owner:
+        # Another request or the look-ahead worker is already encoding this segment
+        event.wait(HLS_SEGMENT_TIMEOUT)
+        return output_path if os.path.exists(output_path) else None
+
+    ticket = None
+    try:
+        if kind == 'live':
+            ticket = SCHEDULER.acquire('live', get_live_cost(TRANSCODE_PLAN, settings), f"hls:{segment}", LIVE_ADMISSION_TIMEOUT)
+        else:
+            try:
+                ticket = SCHEDULER.acquire('batch', get_live_cost(TRANSCODE_PLAN, settings), f"hls-lookahead:{segment}", 0)
+            except AdmissionError:
+                return None  # No spare capacity for speculative work right now
+        
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        temp_path = f"{output_path}.part"
+        cmd = build_hls_segment_command(input_path, segment, settings, temp_path)
+        started = time.time()
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        SCHEDULER.attach_process(ticket, process)
+        try:
+            _, stderr = process.communicate(timeout=HLS_SEGMENT_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd, stderr=stderr)
+        os.replace(temp_path, output_path)
+        logger.debug(f"Encoded HLS segment {segment} of {input_path} in {time.time() - started:.2f}s")
+        enforce_hls_cache_limit(os.path.getsize(output_path))
+        return output_path
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error encoding HLS segment {segment} of {input_path}: "
+                     f"{e.stderr.decode('utf-8', errors='replace').strip()}")
+    except AdmissionError:
+        raise
+    except Exception as e:
+        logger.error(f"Error encoding HLS segment {segment} of {input_path}: {e}")
+    finally:
+        if ticket:
+            SCHEDULER.release(ticket)
+        with _hls_lock:
+            _hls_inflight.pop(output_path, None)
+        event.set()
+    return None
+
+def hls_lookahead_worker():
+    """Encode upcoming segments before the player requests them"""
+    while True:
+        input_path, segment, settings = _hls_lookahead_queue.get()
+        try:
+            if not os.path.exists(get_hls_segment_path(input_path, segment, settings)):
+                get_hls_segment(input_path, segment, settings, kind='batch')
+        except Exception as e:
+            logger.error(f"Error in HLS look-ahead worker: {e}")
+
+def start_hls_lookahead_worker():
+    """Start the HLS look-ahead thread (once per process)"""
+    global _hls_lookahead_thread
+    with _hls_lock:
+        if _hls_lookahead_thread is not None:
+            return
+        _hls_lookahead_thread = threading.Thread(target=hls_lookahead_worker, daemon=True)
+    _hls_lookahead_thread.start()
+
+def schedule_hls_lookahead(input_path, segment, settings, segment_count):
+    for upcoming in range(segment + 1, min(segment + 1 + HLS_LOOKAHEAD, segment_count)):
+        try:
+            _hls_lookahead_queue.put_nowait((input_path, upcoming, settings))
+        except queue.Full:
+            break  # Stale look-ahead from earlier seeks is still queued; don't pile on
+
+def get_hls_segment_count(duration):
+    return max(1, math.ceil(duration / HLS_SEGMENT_DURATION))
+
+@app.route('/hls/<path:filename>/index.m3u8')
+def hls_playlist(filename):
+    """Serve an HLS playlist whose segments are transcoded on demand"""
+    input_path = os.path.join(VIDEO_FOLDER, filename)
+    if not os.path.exists(input_path):
+        logger.error(f"File not found: {input_path}")
+        abort(404)
+    
+    duration = get_video_duration(input_path)
+    if duration <= 0:
+        logger.error(f"Cannot build HLS playlist without a duration: {input_path}")
+        abort(500)
+    
+    query = '?optimized=1' if request.args.get('optimized', '0') == '1' else ''
+    lines = [
+        '#EXTM3U',
+        '#EXT-X-VERSION:3',
+        f'#EXT-X-TARGETDURATION:{HLS_SEGMENT_DURATION}',
+        '#EXT-X-MEDIA-SEQUENCE:0',
+        '#EXT-X-PLAYLIST-TYPE:VOD',
+    ]
+    for segment in range(get_hls_segment_count(duration)):
+        segment_duration = min(HLS_SEGMENT_DURATION, duration - segment * HLS_SEGMENT_DURATION)
+        lines.append(f'#EXTINF:{segment_duration:.3f},')
+        lines.append(f'{segment}.ts{query}')
+    lines.append('#EXT-X-ENDLIST')
+    
+    return Response('\n'.join(lines) + '\n', mimetype='application/vnd.apple.mpegurl',
+                    headers={'Cache-Control': 'no-cache'})
+
+@app.route('/hls/<path:filename>/<int:segment>.ts')
+def hls_segment(filename, segment):
+    """Serve a single HLS segment from the cache, transcoding it on a miss"""
+    input_path = os.path.join(VIDEO_FOLDER, filename)
+    if not os.path.exists(input_path):
+        logger.error(f"File not found: {input_path}")
+        abort(404)
+    
+    segment_count = get_hls_segment_count(get_video_duration(input_path))
+    if segment >= segment_count:
+        abort(404)
+    
+    if not check_ffmpeg():
+        logger.error("FFmpeg not available for HLS streaming")
+        abort(500)
+    
+    optimized = request.args.get('optimized', '0') == '1'
+    settings = get_optimal_streaming_settings(filename, optimized)
+    
+    start_hls_lookahead_worker()
+    try:
+        segment_path = get_hls_segment(input_path, segment, settings)
+    except AdmissionError as e:
+        return admission_rejected_response(e)
+    if not segment_path:
+        abort(500)
+    schedule_hls_lookahead(input_path, segment, settings, segment_count)
+    
+    return send_file(segment_path, mimetype='video/mp2t', max_age=3600)
+
+def get_abr_ladder(metadata):
+    """Ladder rungs that don't upscale the source (at least one rung is always returned)"""
+    video = get_stream_of_type(metadata, 'video') or {}
+    source_height = int(video.get('height') or 0)
+    ladder = [rung for rung in ABR_LADDER if not source_height or rung['height'] <= source_height]
+    if not ladder:
+        ladder = [dict(ABR_LADDER[-1], name=f'{source_height}p', height=source_height)]
+    return ladder
+
+def build_abr_command(input_path, ladder, has_audio, output_dir):
+    """Build one FFmpeg command that decodes once and encodes every rung of the ladder to HLS"""
+    outputs = ''.join(f'[v{i}]' for i in range(len(ladder)))
+    filters = [f'[0:v:0]split={len(ladder)}{outputs}']
+    for i, rung in enumerate(ladder):
+        filters.append(f'[v{i}]scale=-2:{rung["height"]}[v{i}out]')
+    
+    cmd = ['ffmpeg', '-nostdin', '-v', 'warning', '-i', input_path,
+           '-filter_complex', ';'.join(filters)]
+    for i in range(len(ladder)):
+        cmd.extend(['-map', f'[v{i}out]'])
+        if has_audio:
+            cmd.extend(['-map', '0:a:0'])
+    
+    cmd.extend(['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p', '-threads', str(STREAM_THREADS)])
+    # Identical keyframe positions in every rendition so players can switch at any segment
+    cmd.extend(['-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_DURATION})', '-sc_threshold', '0'])
+    for i, rung in enumerate(ladder):
+        cmd.extend([f'-b:v:{i}', rung['video_bitrate'], f'-maxrate:v:{i}', rung['video_bitrate'],
+                    f'-bufsize:v:{i}', rung['video_bitrate']])
+        if has_audio:
+            cmd.extend([f'-b:a:{i}', rung['audio_bitrate']])
+    if has_audio:
+        cmd.extend(['-c:a', 'aac', '-ac', '2'])
+    
+    if has_audio:
+        stream_map = ' '.join(f'v:{i},a:{i},name:{rung["name"]}' for i, rung in enumerate(ladder))
+    else:
+        stream_map = ' '.join(f'v:{i},name:{rung["name"]}' for i, rung in enumerate(ladder))
+    cmd.extend([
+        '-f', 'hls',
+        '-hls_time', str(HLS_SEGMENT_DURATION),
+        '-hls_playlist_type', 'event',
+        '-hls_flags', 'independent_segments+temp_file',
+        '-master_pl_name', 'master.m3u8',
+        '-var_stream_map', stream_map,
+        '-hls_segment_filename', os.path.join(output_dir, '%v', 'seg_%05d.ts'),
+        os.path.join(output_dir, '%v', 'index.m3u8')
+    ])
+    return cmd
+
+class AbrSession:
+    """A running multi-rendition encode of one file, stopped after ABR_IDLE_TIMEOUT without requests"""
+
+    def __init__(self, input_path, output_dir, ladder):
+        self.input_path = input_path
+        self.output_dir = output_dir
+        self.ladder = ladder
+        self.process = None
+        self.ticket = None
+        self.last_access = time.time()
+        self.started = threading.Event()  # set once start() has returned or raised
+        self.start_error = None
+
+    def start(self, has_audio):
+        # Decoding is shared, but each rung is its own encode
+        self.ticket = SCHEDULER.acquire('live', STREAM_THREADS * len(self.ladder),
+                                        f"abr:{os.path.basename(self.input_path)}", LIVE_ADMISSION_TIMEOUT)
+        try:
+            shutil.rmtree(self.output_dir, ignore_errors=True)  # Discard output of an interrupted run
+            for rung in self.ladder:
+                os.makedirs(os.path.join(self.output_dir, rung['name']), exist_ok=True)
+            cmd = build_abr_command(self.input_path, self.ladder, has_audio, self.output_dir)
+            logger.info(f"Starting ABR encode: {' '.join(cmd)}")
+            self.process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            SCHEDULER.attach_process(self.ticket, self.process)
+        except Exception:
+            SCHEDULER.release(self.ticket)
+            raise
+        threading.Thread(target=self._wait, daemon=True).start()
+
+    def _wait(self):
+        _, stderr = self.process.communicate()
+        SCHEDULER.release(self.ticket)
+        if self.process.returncode == 0:
+            # Mark the renditions complete so they are served from disk without an encoder
+            open(os.path.join(self.output_dir, ABR_COMPLETE_MARKER), 'w').close()
+            logger.info(f"ABR encode of {self.input_path} complete")
+        elif self.process.returncode > 0:
+            logger.error(f"ABR encode of {self.input_path} failed: "
+                         f"{stderr.decode('utf-8', errors='replace').strip()[-500:]}")
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def stop(self):
+        if self.running:
+            logger.info(f"Stopping idle ABR encode of {self.input_path}")
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+def get_abr_output_dir(input_path):
+    return os.path.join(ABR_CACHE_FOLDER, get_file_cache_key(input_path))
+
+def ensure_abr_session(input_path):
+    """Return the ABR output directory for a file, starting the encoder if it isn't complete.
+
+    The session is registered before it waits for admission, without holding _abr_lock,
+    so requests for other files aren't held up meanwhile. Requests for the same file
+    wait for that start instead of starting a second encoder.
+    """
+    output_dir = get_abr_output_dir(input_path)
+    if os.path.exists(os.path.join(output_dir, ABR_COMPLETE_MARKER)):
+        return output_dir
+    
+    with _abr_lock:
+        session = ABR_SESSIONS.get(output_dir)
+        if session and (not session.started.is_set() or session.running or session.process.returncode == 0):
+            session.last_access = time.time()
+            starter = False
+        else:
+            session = ABR_SESSIONS[output_dir] = AbrSession(input_path, output_dir, [])
+            starter = True
+    
+    if not starter:
+        session.started.wait()
+        if session.start_error:
+            raise session.start_error
+        return output_dir
+    
+    try:
+        metadata = get_media_metadata(input_path)
+        session.ladder = get_abr_ladder(metadata)
+        session.start(has_audio=get_stream_of_type(metadata, 'audio') is not None)
+    except Exception as e:
+        session.start_error = e
+        with _abr_lock:
+            if ABR_SESSIONS.get(output_dir) is session:
+                del ABR_SESSIONS[output_dir]
+        raise
+    finally:
+        session.started.set()
+    return output_dir
+
+def touch_abr_session(output_dir):
+    with _abr_lock:
+        session = ABR_SESSIONS.get(output_dir)
+        if session:
+            session.last_access = time.time()
+
+def reap_idle_abr_sessions():
+    """Stop ABR encoders nobody has requested anything from for ABR_IDLE_TIMEOUT seconds"""
+    now = time.time()
+    with _abr_lock:
+        idle = [key for key, session in ABR_SESSIONS.items()
+                if now - session.last_access > ABR_IDLE_TIMEOUT]
+        sessions = [ABR_SESSIONS.pop(key) for key in idle]
+    for session in sessions:
+        session.stop()
+
+def wait_for_file(path, timeout):
+    """Wait for an encoder to produce a file; returns whether it exists"""
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.2)
+    return True
+
+@app.route('/abr/<path:filename>/master.m3u8')
+def abr_master_playlist(filename):
+    """Serve the multi-variant playlist of the adaptive bitrate ladder"""
     input_path = os.path.join(VIDEO_FOLDER, filename)
-    
-    # Check if file exists
     if not os.path.exists(input_path):
         logger.error(f"File not found: {input_path}")
         abort(404)
     
-    # Check if FFmpeg is available
     if not check_ffmpeg():
-        logger.error("FFmpeg not available for streaming")
+        logger.error("FFmpeg not available for ABR streaming")
         abort(500)
     
-    # Generate a unique session ID for this stream
-    session_id = create_stream_session_id()
-    
-    # Get the start time from query parameters (for seeking)
-    start_time = request.args.get('start', '0')
-    if not re.match(r'^\d+(\.\d+)?$', start_time):
-        start_time = '0'  # Default to 0 if invalid format
-    
-    # Check if optimized mode is requested (for large files)
-    optimized = request.args.get('optimized', '0') == '1'
-    
-    # Get optimal settings based on file and system
-    settings = get_optimal_streaming_settings(filename, optimized)
-    
-    # Set up FFmpeg command for streaming
-    cmd = ['ffmpeg']
-    
-    # Input options
-    cmd.extend([
-        '-nostdin',          # Don't expect input from stdin to prevent freezes
-        '-ss', start_time,   # Start time for seeking
-    ])
+    try:
+        output_dir = ensure_abr_session(input_path)
+    except AdmissionError as e:
+        return admission_rejected_response(e)
     
-    # Add input file path
-    cmd.extend(['-i', input_path])
+    # Players fetch a variant playlist right after the master, so wait for the first segment too
+    master_path = os.path.join(output_dir, 'master.m3u8')
+    if not wait_for_file(master_path, ABR_START_TIMEOUT):
+        logger.error(f"ABR encoder produced no playlist for {filename}")
+        abort(504)
+    return send_file(master_path, mimetype='application/vnd.apple.mpegurl', max_age=0)
+
+@app.route('/abr/<path:filename>/<variant>/<name>')
+def abr_variant_file(filename, variant, name):
+    """Serve a rendition playlist or segment produced by the ABR encoder"""
+    if not re.match(r'^(index\.m3u8|seg_\d+\.ts)$', name) or not re.match(r'^\d+p$', variant):
+        abort(404)
+    input_path = os.path.join(VIDEO_FOLDER, filename)
+    if not os.path.exists(input_path):
+        abort(404)
     
-    # Video options
-    cmd.extend([
-        '-c:v', 'libx264',        # Video codec
-        '-preset', settings['preset'],
-        '-tune', 'zerolatency',   # Minimize latency
-        '-b:v', settings['video_bitrate'],  # Video bitrate
-    ])
+    output_dir = get_abr_output_dir(input_path)
+    touch_abr_session(output_dir)
+    file_path = os.path.join(output_dir, variant, name)
+    if not wait_for_file(file_path, ABR_START_TIMEOUT):
+        abort(404)
     
-    # Optionally scale down for large files
-    if settings['scale']:
-        cmd.extend(['-vf', f'scale={settings["scale"]}'])
+    if name.endswith('.m3u8'):
+        return send_file(file_path, mimetype='application/vnd.apple.mpegurl', max_age=0)
+    return send_file(file_path, mimetype='video/mp2t', max_age=3600)
+
+def get_thumbnail_root(file_path):
+    """Cache directory holding every generated version of a file's thumbnails"""
+    return os.path.join(THUMBNAIL_CACHE_FOLDER,
+                        hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()[:16])
+
+def get_thumbnail_dir(file_path):
+    """Thumbnail directory for the current version (size + mtime) of a file"""
+    stat = os.stat(file_path)
+    return os.path.join(get_thumbnail_root(file_path), f"{stat.st_size:x}-{stat.st_mtime_ns:x}")
+
+def thumbnails_ready(file_path):
+    try:
+        return os.path.isdir(get_thumbnail_dir(file_path))
+    except OSError:
+        return False
+
+def forget_thumbnails(file_path):
+    """Drop cached thumbnails of a file that left the library"""
+    shutil.rmtree(get_thumbnail_root(file_path), ignore_errors=True)
+
+def get_thumbnail_size(metadata):
+    """Tile size for a video, keeping its aspect ratio (even height, as encoders prefer)"""
+    video = get_stream_of_type(metadata, 'video') or {}
+    width, height = int(video.get('width') or 0), int(video.get('height') or 0)
+    if not width or not height:
+        return THUMBNAIL_WIDTH, THUMBNAIL_WIDTH * 9 // 16
+    return THUMBNAIL_WIDTH, max(2, round(THUMBNAIL_WIDTH * height / width / 2) * 2)
+
+def build_thumbnail_command(input_path, output_dir, poster_at, tile_width, tile_height):
+    """One FFmpeg pass producing the poster frame and all sprite sheets"""
+    filters = (
+        '[0:v:0]split=2[p][s];'
+        f"[p]select='gte(t,{poster_at:.3f})',scale={POSTER_WIDTH}:-2[poster];"
+        f'[s]fps=1/{THUMBNAIL_INTERVAL}:eof_action=pass,scale={tile_width}:{tile_height},'
+        f'tile={SPRITE_COLUMNS}x{SPRITE_ROWS}[sprites]'
+    )
+    return [
+        'ffmpeg', '-nostdin', '-v', 'error',
+        '-skip_frame', 'nokey',  # Decode keyframes only; a tile every few seconds doesn't need more
+        '-i', input_path,
+        '-filter_complex', filters,
+        '-threads', '1',
+        '-map', '[poster]', '-frames:v', '1', '-q:v', '3', os.path.join(output_dir, 'poster.jpg'),
+        '-map', '[sprites]', '-q:v', '5', os.path.join(output_dir, 'sprite_%03d.jpg')
+    ]
+
+def format_vtt_timestamp(seconds):
+    milliseconds = int(round(seconds * 1000))
+    hours, milliseconds = divmod(milliseconds, 3600 * 1000)
+    minutes, milliseconds = divmod(milliseconds, 60 * 1000)
+    return f"{hours:02d}:{minutes:02d}:{milliseconds / 1000:06.3f}"
+
+def build_thumbnail_vtt(duration, tile_width, tile_height, sheet_count):
+    """WebVTT mapping each THUMBNAIL_INTERVAL of the video to its tile in the sprite sheets"""
+    tiles_per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+    # A final sliver shorter than half a second doesn't get a tile of its own
+    tile_count = min(max(1, math.ceil((duration - 0.5) / THUMBNAIL_INTERVAL)), sheet_count * tiles_per_sheet)
+    lines = ['WEBVTT', '']
+    for tile in range(tile_count):
+        sheet, position = divmod(tile, tiles_per_sheet)
+        row, column = divmod(position, SPRITE_COLUMNS)
+        start = tile * THUMBNAIL_INTERVAL
+        end = duration if tile == tile_count - 1 else start + THUMBNAIL_INTERVAL
+        lines.append(f"{format_vtt_timestamp(start)} --> {format_vtt_timestamp(end)}")
+        lines.append(f"sprite_{sheet + 1:03d}.jpg#xywh={column * tile_width},{row * tile_height},"
+                     f"{tile_width},{tile_height}")
+        lines.append('')
+    return '\n'.join(lines)
+
+def generate_thumbnails(file_path, ticket):
+    """Build the poster, sprite sheets and WebVTT index for the current version of a file"""
+    output_dir = get_thumbnail_dir(file_path)
+    if os.path.isdir(output_dir):
+        return
+    metadata = get_media_metadata(file_path)
+    if get_stream_of_type(metadata, 'video') is None:
+        return
+    duration = get_video_duration(file_path)
+    if duration <= 0:
+        logger.warning(f"Skipping thumbnails for {file_path}: unknown duration")
+        return
     
-    # Audio options
+    tile_width, tile_height = get_thumbnail_size(metadata)
+    # Only keyframes are decoded, so the poster has to land on one
+    poster_at = duration * POSTER_POSITION
+    keyframes = get_keyframe_index(file_path)
+    if keyframes:
+        poster_at = keyframes[max(bisect.bisect_right(keyframes, poster_at) - 1, 0)]
+    temp_dir = f"{output_dir}.part"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    try:
+        cmd = build_thumbnail_command(file_path, temp_dir, max(poster_at - 0.01, 0), tile_width, tile_height)
+        started = time.time()
+        process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        SCHEDULER.attach_process(ticket, process)
+        try:
+            _, stderr = process.communicate(timeout=THUMBNAIL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        if process.returncode != 0:
+            raise RuntimeError(stderr.decode('utf-8', errors='replace').strip()[-500:])
+        poster_path = os.path.join(temp_dir, 'poster.jpg')
+        if not os.path.exists(poster_path):
+            # Short clip without a keyframe past the poster position: use the first frame
+            subprocess.run(['ffmpeg', '-nostdin', '-v', 'error', '-i', file_path, '-frames:v', '1',
+                            '-vf', f'scale={POSTER_WIDTH}:-2', '-q:v', '3', poster_path],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60)
+        
+        sheet_count = sum(1 for name in os.listdir(temp_dir) if name.startswith('sprite_'))
+        with open(os.path.join(temp_dir, 'thumbnails.vtt'), 'w') as f:
+            f.write(build_thumbnail_vtt(duration, tile_width, tile_height, sheet_count))
+        
+        # Older versions of the file's thumbnails are no longer reachable
+        root = get_thumbnail_root(file_path)
+        for name in os.listdir(root):
+            stale = os.path.join(root, name)
+            if stale != temp_dir:
+                shutil.rmtree(stale, ignore_errors=True)
+        os.replace(temp_dir, output_dir)
+        logger.info(f"Generated {sheet_count} thumbnail sprite(s) for {file_path} in {time.time() - started:.1f}s")
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+def _mark_thumbnails_ready(folder, file_path):
+    with _catalog_lock:
+        entry = LIBRARY_CATALOG.get((folder, _catalog_relpath(folder, file_path)))
+        if entry is not None:
+            entry['thumbnails'] = True
+            _bump_catalog_version()  # The entry now has a poster
+
+def thumbnail_worker():
+    """Generate thumbnails in batches, each under one low-priority scheduler ticket"""
+    while True:
+        batch = [_thumbnail_queue.get()]
+        # A new season is usually copied in file by file; pick it all up as one batch
+        time.sleep(THUMBNAIL_BATCH_DELAY)
+        while True:
+            try:
+                batch.append(_thumbnail_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        ticket = SCHEDULER.acquire('batch', THUMBNAIL_COST_CORES, f"thumbnails:{len(batch)} files")
+        try:
+            for folder, file_path in batch:
+                io_slot = DEVICE_IO.acquire(file_path, 'batch', f"thumbnails:{os.path.basename(file_path)}")
+                try:
+                    generate_thumbnails(file_path, ticket)
+                    if thumbnails_ready(file_path):
+                        _mark_thumbnails_ready(folder, file_path)
+                except Exception as e:
+                    logger.warning(f"Error generating thumbnails for {file_path}: {e}")
+                finally:
+                    end_batch_read(io_slot)
+                    with _thumbnail_lock:
+                        _thumbnail_pending.discard(file_path)
+        finally:
+            SCHEDULER.release(ticket)
+
+def request_thumbnails(folder, file_path):
+    """Return True if thumbnails are ready, otherwise queue the file and return False"""
+    global _thumbnail_thread
+    if thumbnails_ready(file_path):
+        return True
+    with _thumbnail_lock:
+        if file_path in _thumbnail_pending:
+            return False
+        _thumbnail_pending.add(file_path)
+        if _thumbnail_thread is None:
+            _thumbnail_thread = threading.Thread(target=thumbnail_worker, daemon=True)
+            _thumbnail_thread.start()
+    _thumbnail_queue.put((folder, file_path))
+    return False
+
+THUMBNAIL_FOLDERS = {'videos': VIDEO_FOLDER, 'converted': CONVERTED_FOLDER}
+
+def get_thumbnail_urls(entry):
+    """Poster and WebVTT URLs for a catalog entry, or (None, None) until they are generated"""
+    if not entry.get('thumbnails'):
+        return None, None
+    kind = 'videos' if entry['folder'] == VIDEO_FOLDER else 'converted'
+    base = f"/thumbnails/{kind}/{entry['filename']}"
+    return f"{base}/poster.jpg", f"{base}/thumbnails.vtt"
+
+@app.route('/thumbnails/<kind>/<path:filename>/<name>')
+def serve_thumbnail(kind, filename, name):
+    """Serve a generated poster, sprite sheet or thumbnail WebVTT; never waits for generation"""
+    folder = THUMBNAIL_FOLDERS.get(kind)
+    if folder is None or not re.match(r'^(poster\.jpg|thumbnails\.vtt|sprite_\d{3}\.jpg)$', name):
+        abort(404)
+    file_path = safe_join(folder, filename)
+    if not file_path or not os.path.isfile(file_path):
+        abort(404)
+    if not request_thumbnails(folder, file_path):
+        abort(404)
+    return serve_media_file(get_thumbnail_dir(file_path), name)
+
+def get_subtitle_path(input_path, track):
+    return os.path.join(SUBTITLE_CACHE_FOLDER, get_file_cache_key(input_path), f"{track}.vtt")
+
+def extract_subtitles(input_path, track):
+    """Convert a text subtitle track to WebVTT once and cache it; returns the path, or None on failure.
+
+    Only the subtitle stream is mapped, so FFmpeg reads through the file without
+    decoding any audio or video.
+    """
+    output_path = get_subtitle_path(input_path, track)
+    if os.path.exists(output_path):
+        METRICS.inc('letswatch_cache_requests_total', cache='subtitles', result='hit')
+        return output_path
+    METRICS.inc('letswatch_cache_requests_total', cache='subtitles', result='miss')
+
+    with _subtitle_lock:
+        event = _subtitle_inflight.get(output_path)
+        is_owner = event is None
+        if is_owner:
+            event = _subtitle_inflight[output_path] = threading.Event()
+    if not is_owner:
+        event.wait(SUBTITLE_TIMEOUT)
+        return output_path if os.path.exists(output_path) else None
+
+    temp_path = f"{output_path}.part"
+    try:
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        cmd = ['ffmpeg', '-nostdin', '-loglevel', 'error', '-i', input_path,
+               '-map', f'0:s:{track}', '-c:s', 'webvtt', '-f', 'webvtt', '-y', temp_path]
+        started = time.time()
+        subprocess.run(cmd, capture_output=True, check=True, timeout=SUBTITLE_TIMEOUT)
+        os.replace(temp_path, output_path)
+        logger.info(f"Extracted subtitle track {track} of {input_path} in {time.time() - started:.2f}s")
+        return output_path
+    except subprocess.CalledProcessError as e:
+        logger.error(f"Error extracting subtitle track {track} of {input_path}: "
+                     f"{e.stderr.decode('utf-8', errors='replace').strip()}")
+    except Exception as e:
+        logger.error(f"Error extracting subtitle track {track} of {input_path}: {e}")
+    finally:
+        with _subtitle_lock:
+            _subtitle_inflight.pop(output_path, None)
+        event.set()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return None
+
+@app.route('/subtitles/<path:filename>/<int:track>.vtt')
+def serve_subtitles(filename, track):
+    """A text subtitle track as WebVTT, extracted on the first request"""
+    input_path = safe_join(VIDEO_FOLDER, filename)
+    if not input_path or not os.path.isfile(input_path):
+        abort(404)
+    _, subtitles = get_media_tracks(get_media_metadata(input_path))
+    if track >= len(subtitles) or not subtitles[track]['text']:
+        abort(404)
+    if not check_ffmpeg():
+        abort(500)
+    path = extract_subtitles(input_path, track)
+    if path is None:
+        abort(500)
+    return serve_media_file(os.path.dirname(path), os.path.basename(path))
+
+def record_watch(file_path, seconds):
+    """Add a finished viewer session to the watch history used to rank pre-transcodes"""
+    try:
+        with _metadata_lock:
+            db = get_metadata_db()
+            db.execute(
+                'INSERT INTO watch_history (path, sessions, seconds, last_watched) VALUES (?, 1, ?, ?) '
+                'ON CONFLICT(path) DO UPDATE SET sessions = sessions + 1, '
+                'seconds = seconds + excluded.seconds, last_watched = excluded.last_watched',
+                (os.path.abspath(file_path), max(seconds, 0), time.time())
+            )
+            db.commit()
+    except sqlite3.Error as e:
+        logger.warning(f"Couldn't record watch history for {file_path}: {e}")
+
+def get_most_watched(limit):
+    """Paths of the most watched files, by total seconds streamed"""
+    with _metadata_lock:
+        rows = get_metadata_db().execute(
+            'SELECT path FROM watch_history WHERE sessions >= ? ORDER BY seconds DESC, sessions DESC LIMIT ?',
+            (RENDITION_MIN_SESSIONS, limit)
+        ).fetchall()
+    return [row[0] for row in rows]
+
+def get_rendition_path(input_path, settings):
+    return os.path.join(RENDITION_CACHE_FOLDER, get_file_cache_key(input_path), f"{get_profile_key(settings)}.mp4")
+
+def rendition_exists(input_path, settings):
+    try:
+        return os.path.exists(get_rendition_path(input_path, settings))
+    except OSError:
+        return False
+
+def get_cached_rendition(input_path, settings, count_hit=True):
+    """Path of a pre-transcoded rendition for these settings, or None; counts cache hits and misses"""
+    path = get_rendition_path(input_path, settings)
+    if not os.path.exists(path):
+        METRICS.inc('letswatch_cache_requests_total', cache='rendition', result='miss')
+        return None
+    if count_hit:
+        METRICS.inc('letswatch_cache_requests_total', cache='rendition', result='hit')
+        with _metadata_lock:
+            db = get_metadata_db()
+            db.execute('UPDATE renditions SET hits = hits + 1, last_used = ? WHERE path = ?',
+                       (time.time(), os.path.abspath(path)))
+            db.commit()
+    return path
+
+def build_rendition_command(input_path, output_path, settings, plan):
+    """Encode a whole file with its live-stream settings into a seekable (faststart) MP4"""
+    cmd = ['ffmpeg', '-nostdin', '-loglevel', 'warning', '-i', input_path]
+    if plan['video'] == 'copy':
+        cmd.extend(['-c:v', 'copy'])
+    else:
+        cmd.extend([
+            '-c:v', 'libx264',
+            '-preset', settings['preset'],
+            *get_video_rate_args(settings),
+            '-pix_fmt', 'yuv420p',
+            '-threads', str(CONVERT_THREADS),
+            # Regular keyframes keep seeks into the rendition cheap
+            '-force_key_frames', f'expr:gte(t,n_forced*{STREAM_KEYFRAME_INTERVAL})',
+        ])
+        if settings['scale']:
+            cmd.extend(['-vf', f'scale={settings["scale"]}'])
+    if plan['audio'] == 'copy':
+        cmd.extend(['-c:a', 'copy'])
+    else:
+        cmd.extend(['-c:a', 'aac', '-b:a', settings['audio_bitrate']])
     cmd.extend([
-        '-c:a', 'aac',            # Audio codec
-        '-b:a', settings['audio_bitrate'],  # Audio bitrate
+        '-progress', 'pipe:1', '-nostats',
+        '-movflags', '+faststart',  # Index up front so players can seek with range requests
+        '-f', 'mp4', '-y', output_path
     ])
+    return cmd
+
+def enforce_rendition_quota():
+    """Drop stale renditions, then evict the coldest until the cache fits RENDITION_CACHE_MAX_BYTES.
+
+    Renditions are ranked by hits divided by days since last use, so a file that was
+    popular months ago goes before one watched a little this week (LFU with LRU aging).
+    """
+    now = time.time()
+    with _metadata_lock:
+        rows = get_metadata_db().execute('SELECT path, source, size, last_used, hits FROM renditions').fetchall()
     
-    # Output options
-    cmd.extend([
-        '-f', 'mp4',              # Output format
-        '-movflags', 'frag_keyframe+empty_moov+faststart',  # Optimize for streaming
-        '-max_muxing_queue_size', '1024',  # Increase muxing queue for complex files
-    ])
+    stale, live = [], []
+    for path, source, size, last_used, hits in rows:
+        try:
+            current = get_rendition_path(source, get_source_streaming_settings(source))
+        except OSError:
+            current = None  # Source is gone
+        if current is None or os.path.abspath(current) != path or not os.path.exists(path):
+            stale.append(path)
+        else:
+            live.append(((hits / (1 + (now - last_used) / 86400), last_used), path, size))
     
-    # Output to pipe
-    cmd.append('-')
+    total = sum(size for _, _, size in live)
+    for _, path, size in sorted(live):
+        if total <= RENDITION_CACHE_MAX_BYTES:
+            break
+        stale.append(path)
+        total -= size
     
-    logger.info(f"[Session {session_id[:8]}] Starting stream: {' '.join(cmd)}")
+    for path in stale:
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+        with _metadata_lock:
+            db = get_metadata_db()
+            db.execute('DELETE FROM renditions WHERE path = ?', (path,))
+            db.commit()
+        logger.info(f"Evicted rendition {path}")
+
+def create_rendition(input_path, ticket):
+    """Pre-transcode one file with the settings /stream/ would use for it; returns the rendition's path"""
+    settings = get_source_streaming_settings(input_path)
+    output_path = get_rendition_path(input_path, settings)
+    plan = get_transcode_plan(get_media_metadata(input_path))
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    temp_path = f"{output_path}.part"
+    started = time.time()
+    try:
+        cmd = build_rendition_command(input_path, temp_path, settings, plan)
+        logger.info(f"Pre-transcoding {input_path}: {' '.join(cmd)}")
+        run_ffmpeg_with_progress(cmd, get_video_duration(input_path), ticket=ticket)
+        os.replace(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    # Seeks into the rendition snap to its own keyframes, so have them ready
+    request_keyframe_index(output_path)
     
-    # Create a generator function that yields chunks of the transcoded video
-    def generate():
+    now = time.time()
+    with _metadata_lock:
+        db = get_metadata_db()
+        db.execute('INSERT OR REPLACE INTO renditions (path, source, size, created, last_used, hits) '
+                   'VALUES (?, ?, ?, ?, ?, 0)',
+                   (os.path.abspath(output_path), input_path, os.path.getsize(output_path), now, now))
+        db.commit()
+    logger.info(f"Pre-transcoded {input_path} in {time.time() - started:.0f}s")
+    return output_path
+
+def server_is_idle():
+    """No viewers and little CPU use, per the metrics sampler"""
+    return (len(ACTIVE_STREAMS) == 0 and SCHEDULER.status()['live_sessions'] == 0
+            and _system_cpu_percent < RENDITION_IDLE_CPU_PERCENT)
+
+def pretranscoder():
+    """While the server is idle, encode renditions of the most watched files that need transcoding"""
+    while True:
+        time.sleep(RENDITION_CHECK_INTERVAL)
         try:
-            # Create process to run ffmpeg command
-            process = subprocess.Popen(
-                cmd, 
-                stdout=subprocess.PIPE, 
-                stderr=subprocess.PIPE, 
-                bufsize=settings['buf_size']  # Use optimized buffer size
-            )
-            
-            # Track this process for management
-            ACTIVE_STREAMS[session_id] = {
-                'process': process,
-                'filename': filename,
-                'started_at': time.time()
-            }
-            
-            logger.info(f"[Session {session_id[:8]}] Started FFmpeg process for {filename}")
-            
-            # Capture stderr in a separate thread for logging
-            def log_errors():
-                for line in process.stderr:
-                    if not line:
-                        continue
-                    line_str = line.decode('utf-8', errors='replace').strip()
-                    # Only log important messages, not progress updates
-                    if line_str and not line_str.startswith('frame='):
-                        if 'error' in line_str.lower() or 'warning' in line_str.lower():
-                            logger.warning(f"[Session {session_id[:8]}] FFmpeg: {line_str}")
-                        else:
-                            logger.debug(f"[Session {session_id[:8]}] FFmpeg: {line_str}")
-            
-            error_thread = threading.Thread(target=log_errors)
-            error_thread.daemon = True
-            error_thread.start()
-            
-            # Stream the output
-            try:
-                # Use a larger chunk size for large files
-                chunk_size = 64 * 1024 if optimized else 16 * 1024  # 64KB vs 16KB
-                
-                while True:
-                    chunk = process.stdout.read(chunk_size)
-                    if not chunk:
+            enforce_rendition_quota()
+            for input_path in get_most_watched(RENDITION_CANDIDATES):
+                if not server_is_idle():
+                    break
+                if not os.path.exists(input_path) or rendition_exists(input_path, get_source_streaming_settings(input_path)):
+                    continue
+                if get_transcode_plan(get_media_metadata(input_path))['mode'] == 'remux':
+                    continue  # Streaming these is already just a remux
+                # A batch ticket, so a viewer arriving mid-encode pauses it
+                label = f"pretranscode:{os.path.basename(input_path)}"
+                io_slot = DEVICE_IO.acquire(input_path, 'batch', label)
+                ticket = SCHEDULER.acquire('batch', CONVERT_THREADS, label)
+                outputs = []
+                try:
+                    outputs.append(create_rendition(input_path, ticket))
+                except Exception as e:
+                    logger.error(f"Error pre-transcoding {input_path}: {e}")
+                finally:
+                    SCHEDULER.release(ticket)
+                    end_batch_read(io_slot, *outputs)
+                enforce_rendition_quota()
+        except Exception as e:
+            logger.error(f"Error in pre-transcoder: {e}")
+
+def start_pretranscoder():
+    """Start the idle-time pre-transcoder thread (once per process)"""
+    global _pretranscoder_thread
+    with _rendition_lock:
+        if _pretranscoder_thread is not None:
+            return
+        _pretranscoder_thread = threading.Thread(target=pretranscoder, daemon=True)
+    _pretranscoder_thread.start()
+
+def serve_rendition(rendition, start_time):
+    """Answer a /stream/ request from the start of a pre-transcoded rendition, with range support"""
+    response = serve_media_file(os.path.dirname(rendition), os.path.basename(rendition))
+    response.headers['X-Stream-Start'] = start_time
+    response.headers['X-Stream-Source'] = 'rendition'
+    return response
+
+def parse_bitrate(value):
+    """Bits per second from an FFmpeg bitrate string such as '4M', '128k' or '800000'"""
+    value = str(value).strip()
+    multiplier = {'k': 1000, 'm': 1000000}.get(value[-1:].lower(), 1)
+    return int(float(value.rstrip('kKmM')) * multiplier)
+
+def get_encoder_profile(file_path):
+    """Tuned encoder settings for this version of a file, or None if it hasn't been tuned"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    with _metadata_lock:
+        row = get_metadata_db().execute(
+            'SELECT profile FROM encoder_profiles WHERE path = ? AND size = ? AND mtime = ?',
+            (os.path.abspath(file_path), stat.st_size, stat.st_mtime)
+        ).fetchone()
+    return json.loads(row[0]) if row else None
+
+def save_encoder_profile(file_path, profile, trials):
+    stat = os.stat(file_path)
+    with _metadata_lock:
+        db = get_metadata_db()
+        db.execute(
+            'INSERT OR REPLACE INTO encoder_profiles (path, size, mtime, profile, trials, tuned_at) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            (os.path.abspath(file_path), stat.st_size, stat.st_mtime, json.dumps(profile), json.dumps(trials), time.time())
+        )
+        db.commit()
+
+def run_encoder_trial(input_path, start_time, settings, plan, ticket=None):
+    """Encode a TUNE_SAMPLE_SECONDS sample with the live stream command and measure it.
+
+    Returns the realtime factor, output bitrate and cores used (the child's CPU time
+    from wait4 over wall time). An encode that can no longer reach TUNE_MIN_SPEED is
+    stopped early. Returns None if the scheduler paused the encode, since its timing
+    is then meaningless.
+    """
+    output_path = os.path.join('temp', f"tune_{uuid.uuid4().hex}.mp4")
+    cmd = build_stream_command(input_path, start_time, settings, plan)
+    cmd[-1:] = ['-t', str(TUNE_SAMPLE_SECONDS), '-y', output_path]
+    pauses = ticket.pauses if ticket else 0
+
+    started = time.perf_counter()
+    # build_stream_command() already sends -progress blocks to stderr
+    process = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if ticket:
+        SCHEDULER.attach_process(ticket, process)
+    killer = threading.Timer(TUNE_SAMPLE_SECONDS / TUNE_MIN_SPEED, process.kill)
+    killer.start()
+    encoded = 0.0
+    try:
+        for line in process.stderr:
+            key, _, value = line.strip().partition('=')
+            if key == 'out_time_us':
+                try:
+                    encoded = int(value) / 1000000
+                except ValueError:
+                    pass  # "N/A" before the first frame is written
+    except BaseException:
+        process.kill()
+        raise
+    finally:
+        killer.cancel()
+        # wait4 instead of wait() to get the child's resource usage along with its exit status
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        process.stderr.close()
+        elapsed = time.perf_counter() - started
+        try:
+            size = os.path.getsize(output_path)
+            os.remove(output_path)
+        except OSError:
+            size = 0
+
+    if ticket and ticket.pauses != pauses:
+        METRICS.inc('letswatch_encoder_tune_trials_total', result='interrupted')
+        return None
+    speed = encoded / elapsed if elapsed > 0 else 0.0
+    keeps_up = process.returncode == 0 and speed >= TUNE_MIN_SPEED
+    failed = encoded <= 0  # FFmpeg wrote nothing, so the trial says nothing about its speed
+    METRICS.inc('letswatch_encoder_tune_trials_total', result='failed' if failed else 'ok' if keeps_up else 'slow')
+    return {
+        'preset': settings['preset'],
+        'crf': settings.get('crf'),
+        'threads': settings.get('threads', STREAM_THREADS),
+        'scale': settings['scale'],
+        'speed': round(speed, 3),
+        'bitrate': int(size * 8 / encoded) if encoded > 0 else None,
+        'cores': round((usage.ru_utime + usage.ru_stime) / elapsed, 2) if elapsed > 0 else None,
+        'keeps_up': keeps_up,
+        'failed': failed
+    }
+
+def _scale_width(scale):
+    return int(scale.split(':')[0]) if scale else 0
+
+def _profile_from_trial(trial):
+    return {key: trial[key] for key in ('preset', 'crf', 'threads', 'scale')}
+
+def tune_encoder_settings(input_path, ticket=None):
+    """Find the cheapest live settings that keep a file above TUNE_MIN_SPEED on this machine.
+
+    Tries the fewest threads first and, at each thread count, the slowest preset (best
+    compression) that keeps up, with the lowest CRF whose output fits the default
+    profile bitrate. Smaller scales are only tried if nothing keeps up at the source
+    size. Returns (profile, trials); the profile is None if a trial was interrupted or
+    every trial failed.
+    """
+    metadata = get_media_metadata(input_path)
+    plan = get_transcode_plan(metadata)
+    # Named relative to the videos folder, as /stream/ names it, so large files get the large-file defaults
+    base = get_default_streaming_settings(os.path.relpath(input_path, VIDEO_FOLDER))
+    duration = get_video_duration(input_path)
+    start_time = f"{max(0.0, min(duration * TUNE_SAMPLE_POSITION, duration - TUNE_SAMPLE_SECONDS)):.3f}"
+
+    base_width = _scale_width(base['scale']) or int((get_stream_of_type(metadata, 'video') or {}).get('width') or 0)
+    scales = [base['scale']] + [scale for scale in TUNE_SCALES if base_width and _scale_width(scale) < base_width]
+    cap = parse_bitrate(base['video_bitrate']) + parse_bitrate(base['audio_bitrate'])
+
+    trials = []
+    for scale in scales:
+        for threads in TUNE_THREADS:
+            for preset in TUNE_PRESETS:
+                chosen = None
+                for crf in TUNE_CRFS:
+                    if ticket:
+                        SCHEDULER.resize(ticket, threads)
+                    settings = dict(base, preset=preset, crf=crf, threads=threads, scale=scale)
+                    trial = run_encoder_trial(input_path, start_time, settings, plan, ticket)
+                    if trial is None:
+                        return None, trials
+                    trials.append(trial)
+                    if not trial['keeps_up']:
+                        break  # A higher CRF barely speeds the encoder up; try a faster preset
+                    chosen = trial
+                    if trial['bitrate'] is None or trial['bitrate'] <= cap:
                         break
-                    yield chunk
+                if chosen:
+                    return _profile_from_trial(chosen), trials
+
+    # Nothing keeps up: the fastest setting is still the best this machine can do. Ties go to
+    # later trials, which use cheaper presets, more threads or smaller scales.
+    measured = [(i, trial) for i, trial in enumerate(trials) if not trial['failed']]
+    if not measured:
+        return None, trials
+    _, fastest = max(measured, key=lambda item: (item[1]['speed'], item[0]))
+    return _profile_from_trial(fastest), trials
+
+def encoder_tuner():
+    """Tune queued files one at a time, only while the server is idle so the timings mean something"""
+    while True:
+        file_path = _tune_queue.get()
+        requeue = False
+        try:
+            while not server_is_idle() or SCHEDULER.status()['batch_running']:
+                time.sleep(TUNE_IDLE_WAIT)
+            if not os.path.exists(file_path) or get_encoder_profile(file_path) is not None:
+                continue
+            if get_transcode_plan(get_media_metadata(file_path))['video'] == 'copy':
+                continue  # The video is only remuxed, so there is no encoder to tune
+
+            started = time.time()
+            ticket = SCHEDULER.acquire('batch', TUNE_THREADS[0], f"tune:{os.path.basename(file_path)}")
+            try:
+                profile, trials = tune_encoder_settings(file_path, ticket)
             finally:
-                cleanup_stream(session_id)
-                logger.info(f"[Session {session_id[:8]}] Finished streaming {filename}")
-                
+                SCHEDULER.release(ticket)
+            if profile is None:
+                if trials and all(trial['failed'] for trial in trials):
+                    # Left untuned, so it is queued again the next time the library scanner indexes it
+                    logger.warning(f"Every encoder trial failed for {file_path}; not saving a profile")
+                else:
+                    requeue = True  # A viewer arrived mid-trial; try again once the server is idle
+                continue
+
+            save_encoder_profile(file_path, profile, trials)
+            if not any(trial['keeps_up'] for trial in trials):
+                logger.warning(f"No encoder settings keep {file_path} above {TUNE_MIN_SPEED}x realtime, "
+                               f"using the fastest: {profile}")
+            else:
+                logger.info(f"Tuned {file_path} in {time.time() - started:.0f}s ({len(trials)} trials): {profile}")
         except Exception as e:
-            logger.error(f"[Session {session_id[:8]}] Error during streaming: {e}")
-            logger.error(traceback.format_exc())
-            cleanup_stream(session_id)
-            yield b''  # Send empty response to trigger error handling in browser
+            logger.warning(f"Error tuning encoder settings for {file_path}: {e}")
+        finally:
+            if requeue:
+                _tune_queue.put(file_path)
+            else:
+                with _tune_lock:
+                    _tune_pending.discard(file_path)
+
+def request_encoder_tuning(file_path):
+    """Queue a file for encoder tuning unless it is already tuned or queued"""
+    global _tune_thread
+    if get_encoder_profile(file_path) is not None:
+        return
+    with _tune_lock:
+        if file_path in _tune_pending:
+            return
+        _tune_pending.add(file_path)
+        if _tune_thread is None:
+            _tune_thread = threading.Thread(target=encoder_tuner, daemon=True)
+            _tune_thread.start()
+    _tune_queue.put(file_path)
+
+def sample_ffmpeg_processes():
+    """Collect CPU and RSS for every FFmpeg child process into PROCESS_SAMPLES"""
+    global _system_cpu_percent
+    seen = set()
+    for child in psutil.Process().children(recursive=True):
+        try:
+            if 'ffmpeg' not in child.name():
+                continue
+            proc = _sampled_processes.setdefault(child.pid, child)
+            PROCESS_SAMPLES[child.pid] = {
+                'cpu_percent': proc.cpu_percent(interval=None),  # Usage since the previous sample
+                'rss': proc.memory_info().rss
+            }
+            seen.add(child.pid)
+        except psutil.Error:
+            continue
+    for pid in set(PROCESS_SAMPLES) - seen:
+        PROCESS_SAMPLES.pop(pid, None)
+        _sampled_processes.pop(pid, None)
+    _system_cpu_percent = psutil.cpu_percent(interval=None)
+
+def sample_device_io():
+    """Collect each library disk's kernel read counters, and its throughput since the last sample, into DEVICE_IO_SAMPLES"""
+    for folder in (VIDEO_FOLDER, CONVERTED_FOLDER, CACHE_FOLDER):
+        get_block_device(folder)  # So the library's disks are reported before anything reads from them
+    counters = psutil.disk_io_counters(perdisk=True) or {}
+    now = time.monotonic()
+    for device in {name for name, _ in list(_block_devices.values()) if name}:
+        current = counters.get(device)
+        if current is None:
+            continue
+        sample = {'read_bytes': current.read_bytes}
+        previous = _device_io_counters.get(device)
+        if previous:
+            elapsed = now - previous[0]
+            sample['read_bytes_per_second'] = round((current.read_bytes - previous[1].read_bytes) / elapsed, 1)
+            if hasattr(current, 'busy_time'):  # Linux and FreeBSD, in milliseconds
+                sample['busy_percent'] = round(min(100.0, (current.busy_time - previous[1].busy_time) / elapsed / 10), 1)
+        _device_io_counters[device] = (now, current)
+        DEVICE_IO_SAMPLES[device] = sample
+
+def metrics_sampler():
+    """Sample FFmpeg processes periodically so no request has to wait on psutil"""
+    while True:
+        try:
+            sample_ffmpeg_processes()
+            sample_device_io()
+        except Exception as e:
+            logger.error(f"Error in metrics sampler: {e}")
+        time.sleep(METRICS_SAMPLE_INTERVAL)
+
+def start_metrics_sampler():
+    """Start the process sampler thread (once per process)"""
+    global _sampler_thread
+    with _sampler_lock:
+        if _sampler_thread is not None:
+            return
+        _sampler_thread = threading.Thread(target=metrics_sampler, daemon=True)
+    _sampler_thread.start()
+
+def _process_labels():
+    """Map FFmpeg PIDs to the scheduler label of the work they are doing"""
+    labels = {}
+    with SCHEDULER.cond:
+        for ticket in SCHEDULER.live + SCHEDULER.batch:
+            for process in ticket.processes:
+                labels[process.pid] = ticket.label
+    return labels
+
+def collect_scrape_samples():
+    """Gauges computed from live state at scrape time"""
+    now = time.time()
+    samples = [('letswatch_system_cpu_percent', {}, _system_cpu_percent)]
     
-    # Return a streaming response
-    return Response(
-        generate(), 
-        mimetype='video/mp4',
-        headers={
-            'Accept-Ranges': 'bytes',
-            'Cache-Control': 'no-cache, no-store, must-revalidate',
-            'Pragma': 'no-cache',
-            'Expires': '0',
-            'X-Stream-Session': session_id
-        }
-    )
+    sessions = list(ACTIVE_STREAMS.items())
+    samples.append(('letswatch_active_sessions', {}, len(sessions)))
+    for session_id, stream_info in sessions:
+        labels = {'session': session_id[:8], 'filename': stream_info.get('filename', '')}
+        bytes_sent = stream_info.get('bytes_sent', 0)
+        uptime = max(now - stream_info.get('started_at', now), 1e-3)
+        samples.append(('letswatch_session_bytes_sent', labels, bytes_sent))
+        samples.append(('letswatch_session_throughput_bytes_per_second', labels, round(bytes_sent / uptime, 1)))
+    
+    with _broadcast_lock:
+        broadcasts = list(BROADCASTS.values())
+    samples.append(('letswatch_active_broadcasts', {}, len(broadcasts)))
+    for broadcast in broadcasts:
+        labels = {'broadcast': broadcast.short_id, 'filename': broadcast.filename, 'mode': broadcast.mode}
+        samples.append(('letswatch_ffmpeg_speed', labels, broadcast.encode_speed))
+        samples.append(('letswatch_ffmpeg_fps', labels, broadcast.encode_fps))
+    
+    process_labels = _process_labels()
+    for pid, sample in list(PROCESS_SAMPLES.items()):
+        labels = {'pid': pid, 'work': process_labels.get(pid, 'other')}
+        samples.append(('letswatch_ffmpeg_cpu_percent', labels, sample['cpu_percent']))
+        samples.append(('letswatch_ffmpeg_rss_bytes', labels, sample['rss']))
+    
+    with _jobs_lock:
+        statuses = collections.Counter(job['status'] for job in CONVERSION_JOBS.values())
+    for status in ('queued', 'running', 'done', 'failed'):
+        samples.append(('letswatch_conversion_jobs', {'status': status}, statuses.get(status, 0)))
+    
+    scheduler = SCHEDULER.status()
+    for kind in ('budget', 'live', 'batch'):
+        samples.append(('letswatch_scheduler_cores', {'kind': kind}, scheduler[f'{kind}_cores']))
+    
+    device_readers = DEVICE_IO.status()
+    for device, sample in list(DEVICE_IO_SAMPLES.items()):
+        labels = {'device': device}
+        samples.append(('letswatch_device_read_bytes_total', labels, sample['read_bytes']))
+        if 'read_bytes_per_second' in sample:
+            samples.append(('letswatch_device_read_bytes_per_second', labels, sample['read_bytes_per_second']))
+        if 'busy_percent' in sample:
+            samples.append(('letswatch_device_busy_percent', labels, sample['busy_percent']))
+    for device in set(DEVICE_IO_SAMPLES) | set(device_readers):
+        readers = device_readers.get(device, {})
+        for kind in ('live', 'batch'):
+            labels = {'device': device, 'kind': kind}
+            samples.append(('letswatch_device_readers', labels, readers.get(kind, 0)))
+            samples.append(('letswatch_device_queued_readers', labels, readers.get(f'queued_{kind}', 0)))
+    return samples
+
+@app.route('/metrics')
+def metrics():
+    """Expose server metrics in the Prometheus text format"""
+    start_metrics_sampler()
+    return Response(METRICS.render(collect_scrape_samples()), mimetype='text/plain; version=0.0.4')
+
+def is_process_running(process):
+    """Whether a subprocess.Popen or asyncio subprocess is still running"""
+    if hasattr(process, 'poll'):
+        return process.poll() is None
+    return process.returncode is None
 
 @app.route('/stream-stats/<path:session_id>')
 def get_stream_stats(session_id):
     """Return status of a specific stream"""
-    if session_id in ACTIVE_STREAMS:
-        stream_info = ACTIVE_STREAMS[session_id]
-        process = stream_info.get('process')
+    stream_info = ACTIVE_STREAMS.get(session_id)
+    if stream_info:
+        broadcast = stream_info.get('broadcast')
+        process = broadcast.process if broadcast else stream_info.get('process')
         
         # Check if process is still running
-        is_running = process and process.poll() is None
+        is_running = process is not None and is_process_running(process)
         
-        # Get CPU usage of the process
-        cpu_percent = 0
-        try:
-            if is_running:
-                process_obj = psutil.Process(process.pid)
-                cpu_percent = process_obj.cpu_percent(interval=0.1)
-        except:
-            cpu_percent = 0
+        # CPU usage comes from the background sampler, so this never blocks on psutil
+        start_metrics_sampler()
+        sample = PROCESS_SAMPLES.get(process.pid, {}) if is_running else {}
         
         return {
             'running': is_running,
             'filename': stream_info.get('filename', ''),
             'uptime': int(time.time() - stream_info.get('started_at', time.time())),
-            'cpu_percent': cpu_percent
+            'mode': broadcast.mode if broadcast else 'transcode',
+            'cpu_percent': sample.get('cpu_percent', 0),
+            'bytes_sent': stream_info.get('bytes_sent', 0),
+            'encode_speed': broadcast.encode_speed if broadcast else 0,
+            'encoded_seconds': broadcast.encoded_seconds if broadcast else 0,
+            'worker': getattr(broadcast, 'worker', None)
         }
     
     return {'running': False, 'error': 'Stream not found'}, 404
 
-@app.route('/convert/<path:filename>')
-def convert_video_route(filename):
-    """API endpoint to convert a video"""
-    input_path = os.path.join(VIDEO_FOLDER, filename)
+def offload_conversion(input_file, output_file, progress_callback=None):
+    """Convert a file on a worker node; returns False if no worker did, so it converts here.
+
+    The worker streams fragmented MP4 back. It is written next to the output and then
+    remuxed with +faststart here, a stream copy that needs no encode capacity.
+    """
+    if not WORKER_NODES:
+        return False
+    plan = get_transcode_plan(get_media_metadata(input_file))
+    payload = build_worker_payload('convert', input_file, plan)
+    if not should_offload(plan) or payload is None:
+        return False
+    duration = get_video_duration(input_file)
+    fragmented_file = f"{output_file}.frag.part"
+    temp_file = f"{output_file}.part"
+    for worker in pick_workers(CONVERT_THREADS, kind='batch'):
+        try:
+            process = WorkerProcess(worker, payload)
+            logger.info(f"Converting {input_file} on worker {worker}")
+            splitter = Mp4FragmentSplitter()
+            try:
+                fragments = 0
+                with open(fragmented_file, 'wb') as f:
+                    while True:
+                        data = process.stdout.read1(FILE_CHUNK_SIZE)
+                        if not data:
+                            break
+                        f.write(data)
+                        fragments += len(splitter.feed(data))
+                        if progress_callback and duration > 0:
+                            progress_callback(min(fragments * WORKER_FRAGMENT_SECONDS / duration, 0.99))
+            finally:
+                process.terminate()
+                splitter.close()
+            if process.returncode != 0 or splitter.init_segment is None:
+                raise WorkerError("stopped before the conversion finished")
+            record_worker_dispatch(worker, CONVERT_THREADS)
+            subprocess.run(['ffmpeg', '-nostdin', '-loglevel', 'warning', '-i', fragmented_file,
+                            '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', '-y', temp_file],
+                           capture_output=True, check=True)
+            os.replace(temp_file, output_file)
+            logger.info(f"Worker {worker} converted {input_file} to {output_file}")
+            return True
+        except WorkerError as e:
+            mark_worker_failed(worker, e)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"Error remuxing the output of worker {worker}: {e.stderr}")
+            return False
+        finally:
+            for path in (fragmented_file, temp_file):
+                if os.path.exists(path):
+                    os.remove(path)
+    return False
+
+def _save_conversion_jobs():
+    """Persist job state so queued work survives a restart (caller holds _jobs_lock)"""
+    finished = [j for j in CONVERSION_JOBS.values() if j['status'] in ('done', 'failed')]
+    for job in sorted(finished, key=lambda j: j['created_at'])[:-MAX_FINISHED_JOBS]:
+        del CONVERSION_JOBS[job['id']]
+    try:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        temp_path = f"{JOBS_FILE}.part"
+        with open(temp_path, 'w') as f:
+            json.dump(list(CONVERSION_JOBS.values()), f)
+        os.replace(temp_path, JOBS_FILE)
+    except Exception as e:
+        logger.error(f"Error saving conversion jobs: {e}")
+
+def _load_conversion_jobs():
+    """Restore persisted jobs, re-queueing anything that was queued or running"""
+    if not os.path.exists(JOBS_FILE):
+        return
+    try:
+        with open(JOBS_FILE) as f:
+            jobs = json.load(f)
+    except Exception as e:
+        logger.error(f"Error loading conversion jobs: {e}")
+        return
+    with _jobs_lock:
+        for job in jobs:
+            if job['status'] in ('queued', 'running'):
+                job.update(status='queued', progress=0.0, started_at=None)
+                _job_queue.put((JOB_PRIORITIES[job['priority']], job['created_at'], job['id']))
+            CONVERSION_JOBS[job['id']] = job
+        _save_conversion_jobs()
+    logger.info(f"Restored {len(jobs)} conversion job(s)")
+
+def submit_conversion_job(filename, priority='normal'):
+    """Queue a conversion, returning the existing job if the same source is already queued or running"""
+    with _jobs_lock:
+        for job in CONVERSION_JOBS.values():
+            if job['filename'] == filename and job['status'] in ('queued', 'running'):
+                if job['status'] == 'queued' and JOB_PRIORITIES[priority] < JOB_PRIORITIES[job['priority']]:
+                    # Re-queue at the higher priority; the worker skips the stale entry
+                    job['priority'] = priority
+                    _job_queue.put((JOB_PRIORITIES[priority], job['created_at'], job['id']))
+                    _save_conversion_jobs()
+                return job
+
+        base_name = os.path.splitext(filename)[0]
+        output_filename = f"{base_name}_converted.mp4"
+        job = {
+            'id': create_stream_session_id(),
+            'filename': filename,
+            'output_filename': output_filename,
+            'priority': priority,
+            'status': 'queued',
+            'progress': 0.0,
+            'error': None,
+            'created_at': time.time(),
+            'started_at': None,
+            'finished_at': None
+        }
+        CONVERSION_JOBS[job['id']] = job
+        _job_queue.put((JOB_PRIORITIES[priority], job['created_at'], job['id']))
+        _save_conversion_jobs()
+    logger.info(f"[Job {job['id'][:8]}] Queued conversion of {filename} ({priority} priority)")
+    return job
+
+def _update_job(job, **changes):
+    with _jobs_lock:
+        job.update(changes)
+        _save_conversion_jobs()
+
+def conversion_worker():
+    """Take jobs off the priority queue and run them one at a time"""
+    while True:
+        _, _, job_id = _job_queue.get()
+        with _jobs_lock:
+            job = CONVERSION_JOBS.get(job_id)
+            if not job or job['status'] != 'queued':
+                continue  # Stale entry from a priority bump
+            job.update(status='running', started_at=time.time())
+            _save_conversion_jobs()
+
+        input_path = os.path.join(VIDEO_FOLDER, job['filename'])
+        output_path = os.path.join(CONVERTED_FOLDER, job['output_filename'])
+        logger.info(f"[Job {job_id[:8]}] Converting {job['filename']}")
+
+        def report_progress(fraction):
+            # Progress lives in memory; it is only persisted with the next state change
+            job['progress'] = round(fraction, 4)
+
+        ticket = io_slot = None
+        try:
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            if not os.path.exists(input_path):
+                _update_job(job, status='failed', error='Source file not found', finished_at=time.time())
+                continue
+            converted = offload_conversion(input_path, output_path, report_progress)
+            if not converted:
+                # Wait for the source's disk, then for room in the encode budget; live streams can pause us later on
+                io_slot = DEVICE_IO.acquire(input_path, 'batch', f"convert:{job['filename']}")
+                ticket = SCHEDULER.acquire('batch', CONVERT_THREADS, f"convert:{job['filename']}")
+                converted = convert_video(input_path, output_path, report_progress, ticket)
+            if converted:
+                _update_job(job, status='done', progress=1.0, finished_at=time.time())
+                logger.info(f"[Job {job_id[:8]}] Finished converting {job['filename']}")
+            else:
+                _update_job(job, status='failed', error='Conversion failed', finished_at=time.time())
+        except Exception as e:
+            logger.error(f"[Job {job_id[:8]}] Error in conversion worker: {e}")
+            _update_job(job, status='failed', error=str(e), finished_at=time.time())
+        finally:
+            if ticket:
+                SCHEDULER.release(ticket)
+            if io_slot:
+                end_batch_read(io_slot, output_path)
+
+def start_conversion_workers():
+    """Restore persisted jobs and start the conversion worker pool (once per process)"""
+    global _conversion_workers_started
+    with _jobs_lock:
+        if _conversion_workers_started:
+            return
+        _conversion_workers_started = True
+    shutil.rmtree(CHUNK_WORK_FOLDER, ignore_errors=True)  # left behind by an interrupted chunked conversion
+    _load_conversion_jobs()
+    for _ in range(CONVERSION_WORKERS):
+        threading.Thread(target=conversion_worker, daemon=True).start()
+
+def job_to_json(job):
+    data = dict(job)
+    if job['status'] == 'done':
+        data['url'] = f"/converted/{job['output_filename']}"
+    return data
+
+def _queue_conversion_response(filename, priority):
+    # Paths escaping the videos folder are as good as missing; the output name is built from the checked path
+    input_path = safe_join(VIDEO_FOLDER, filename)
     
     # Check if input file exists
-    if not os.path.exists(input_path):
-        logger.error(f"Source file not found for conversion: {input_path}")
+    if input_path is None or not os.path.isfile(input_path):
+        logger.error(f"Source file not found for conversion: {os.path.join(VIDEO_FOLDER, filename)}")
         return {'success': False, 'error': 'Source file not found'}, 404
-        
-    # Create output filename and path
-    base_name = os.path.splitext(filename)[0]
-    output_filename = f"{base_name}_converted.mp4"
-    output_path = os.path.join(CONVERTED_FOLDER, output_filename)
+    filename = _catalog_relpath(VIDEO_FOLDER, input_path)
+    
+    if not isinstance(priority, str) or priority not in JOB_PRIORITIES:
+        return {'success': False, 'error': f"Unknown priority '{priority}'"}, 400
     
     # Check if FFmpeg is available
     if not check_ffmpeg():
         logger.error("FFmpeg not installed, cannot convert video")
         return {'success': False, 'error': 'FFmpeg not installed'}, 500
     
-    # Convert the video
-    if convert_video(input_path, output_path):
-        # Return the URL to the converted video
-        logger.info(f"Successfully converted {filename} to {output_filename}")
-        return {
-            'success': True, 
-            'message': 'Video converted successfully', 
-            'url': f'/converted/{output_filename}'
-        }
-    else:
-        return {'success': False, 'error': 'Conversion failed'}, 500
+    start_conversion_workers()
+    job = submit_conversion_job(filename, priority)
+    return {
+        'success': True,
+        'job_id': job['id'],
+        'status': job['status'],
+        'status_url': f"/jobs/{job['id']}"
+    }, 202
+
+@app.route('/convert', methods=['POST'])
+def submit_conversion():
+    """Queue a conversion job: {"filename": ..., "priority": "high" | "normal" | "low"}"""
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return {'success': False, 'error': 'Expected a JSON object'}, 400
+    filename = data.get('filename')
+    if not filename or not isinstance(filename, str):
+        return {'success': False, 'error': 'filename is required and must be a string'}, 400
+    return _queue_conversion_response(filename, data.get('priority', 'normal'))
+
+@app.route('/convert/<path:filename>')
+def convert_video_route(filename):
+    """API endpoint to queue a video conversion (kept for existing clients)"""
+    return _queue_conversion_response(filename, request.args.get('priority', 'normal'))
+
+@app.route('/jobs/<job_id>')
+def get_conversion_job(job_id):
+    """Return state and progress of a conversion job"""
+    with _jobs_lock:
+        job = CONVERSION_JOBS.get(job_id)
+        if job:
+            return job_to_json(job)
+    return {'success': False, 'error': 'Job not found'}, 404
 
 @app.route('/static/<path:filename>')
 def serve_static(filename):
@@ -545,33 +4703,47 @@ def serve_static(filename):
 
 # Clean up old streams periodically
 def cleanup_old_streams():
-    """Check for and clean up stale stream processes"""
+    """Tear down stream sessions whose client stopped reading, and other idle encoders"""
     while True:
-        time.sleep(60)  # Check every minute
+        time.sleep(STREAM_REAP_INTERVAL)
         try:
-            now = time.time()
             sessions_to_remove = []
             
+            # A paused viewer is held back by the socket; only sockets idle far longer than any pause are dropped
+            for session_id in ACTIVE_STREAMS.idle():
+                logger.info(f"[Session {session_id[:8]}] Nothing written for over "
+                            f"{STREAM_IDLE_TIMEOUT}s, cleaning up")
+                METRICS.inc('letswatch_stream_sessions_reaped_total', reason='idle')
+                sessions_to_remove.append(session_id)
+            
             for session_id, stream_info in ACTIVE_STREAMS.items():
-                # Check if stream has been running for over 3 hours (unusual)
-                if (now - stream_info.get('started_at', now)) > 3 * 60 * 60:
-                    logger.warning(f"Stream {session_id[:8]} has been running for over 3 hours, cleaning up")
-                    sessions_to_remove.append(session_id)
-                    
                 # Check if process is dead but not removed
+                # Shared broadcasts end their viewers themselves once the buffered output is drained
                 process = stream_info.get('process')
-                if process and process.poll() is not None:
+                if process and not stream_info.get('broadcast') and not is_process_running(process):
                     logger.info(f"Stream {session_id[:8]} process has ended, cleaning up")
                     sessions_to_remove.append(session_id)
             
             # Clean up identified sessions
             for session_id in sessions_to_remove:
                 cleanup_stream(session_id)
+            
+            reap_idle_abr_sessions()
                 
         except Exception as e:
             logger.error(f"Error in cleanup thread: {e}")
 
-if __name__ == '__main__':
+def start_cleanup_thread():
+    """Start the stale stream cleanup thread (once per process)"""
+    global _cleanup_thread
+    with _cleanup_lock:
+        if _cleanup_thread is not None:
+            return
+        _cleanup_thread = threading.Thread(target=cleanup_old_streams, daemon=True)
+    _cleanup_thread.start()
+
+def start_background_services():
+    """Create folders and start every background thread; used by both app.run and asgi.py"""
     create_directories()
     
     # Ensure CSS file exists in static folder
@@ -586,8 +4758,98 @@ if __name__ == '__main__':
             logger.error(f"Error copying CSS file: {e}")
     
     # Start background cleanup thread
-    cleanup_thread = threading.Thread(target=cleanup_old_streams, daemon=True)
-    cleanup_thread.start()
+    start_cleanup_thread()
+    
+    # Start background library scanner and HLS look-ahead encoder
+    start_library_scanner()
+    start_hls_lookahead_worker()
+    
+    # Start conversion workers (resumes jobs queued before a restart)
+    start_conversion_workers()
+    
+    # Start sampling FFmpeg CPU/RSS for /metrics (also tells the pre-transcoder when the server is idle)
+    start_metrics_sampler()
+    start_pretranscoder()
+    start_worker_health_checker()
+
+def is_loopback_host(host):
+    """Whether every address host resolves to is a loopback address"""
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(host, None)}
+    except (socket.gaierror, UnicodeError):
+        return False
+    return bool(addresses) and all(ipaddress.ip_address(address.split('%')[0]).is_loopback for address in addresses)
+
+def run_worker(host, port):
+    """Serve as a worker node only: /worker/ encodes for front ends, no library or background work"""
+    global WORKER_MODE
+    # Workers fetch any http(s) URL they are sent, so an open one reachable from the network is a proxy for anyone
+    if not WORKER_TOKEN and not is_loopback_host(host):
+        sys.exit(f"Refusing to run a worker on {host} without LETSWATCH_WORKER_TOKEN; "
+                 "set a token or bind to 127.0.0.1")
+    WORKER_MODE = True
+    if not WORKER_TOKEN:
+        logger.warning("Worker running without a token; any local process can start encodes")
+    start_metrics_sampler()
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)  # Health checks every few seconds would drown the log
+    logger.info(f"Worker listening on {host}:{port} (FFmpeg installed: {check_ffmpeg()})")
+    app.run(host=host, port=port, threaded=True)
+
+def start_loopback_workers(count, port):
+    """Start `count` workers as local processes and offload to them, to try a cluster on one box.
+
+    Each runs in its own directory under the cache, so it can only read videos through
+    this server's /videos/ route, just like a worker on another machine.
+    """
+    global WORKER_TOKEN, WORKER_SOURCE_URL
+    WORKER_TOKEN = WORKER_TOKEN or uuid.uuid4().hex
+    WORKER_SOURCE_URL = WORKER_SOURCE_URL or f"http://127.0.0.1:{port}"
+    env = dict(os.environ, LETSWATCH_WORKER_TOKEN=WORKER_TOKEN)
+    for i in range(count):
+        worker_port = WORKER_LOOPBACK_BASE_PORT + i
+        workdir = os.path.abspath(os.path.join(CACHE_FOLDER, 'workers', str(worker_port)))
+        os.makedirs(workdir, exist_ok=True)
+        _loopback_workers.append(subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--worker', '--port', str(worker_port)], cwd=workdir, env=env))
+        WORKER_NODES.append(f"http://127.0.0.1:{worker_port}")
+    atexit.register(stop_loopback_workers)
+    logger.info(f"Started {count} loopback worker(s) on ports {WORKER_LOOPBACK_BASE_PORT}-{WORKER_LOOPBACK_BASE_PORT + count - 1}")
+
+def stop_loopback_workers():
+    for process in _loopback_workers:
+        if process.poll() is None:
+            process.terminate()
+    for process in _loopback_workers:
+        try:
+            process.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+def parse_server_args(description):
+    """Command-line options shared by app.py and asgi.py"""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--worker-nodes', default='', help='comma-separated worker base URLs to offload encodes to')
+    parser.add_argument('--loopback-workers', type=int, default=0, metavar='N',
+                        help='start N workers as local processes and offload to them (testing)')
+    return parser
+
+def configure_workers(args):
+    WORKER_NODES.extend(url.strip().rstrip('/') for url in args.worker_nodes.split(',') if url.strip())
+    if args.loopback_workers:
+        start_loopback_workers(args.loopback_workers, args.port)
+
+if __name__ == '__main__':
+    parser = parse_server_args('Run the video server')
+    parser.add_argument('--worker', action='store_true',
+                        help='run as a worker node encoding for other servers (token: LETSWATCH_WORKER_TOKEN)')
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.host, args.port)
+        sys.exit()
+    configure_workers(args)
+    start_background_services()
     
     # Print instructions for the user
     print("\n" + "="*80)
@@ -606,8 +4868,9 @@ if __name__ == '__main__':
         print("- Ubuntu/Debian: sudo apt install ffmpeg")
         print("- macOS: brew install ffmpeg")
         print("- Windows: Download from https://ffmpeg.org/download.html")
-    print("\nAccess the player at http://127.0.0.1:5000")
+    print(f"\nAccess the player at http://{args.host}:{args.port}")
+    print("For many concurrent viewers, run the production server instead: python asgi.py")
     print("="*80 + "\n")
     
-    # Create a log file handler for debugging
-    app.run(debug=True)
\ No newline at end of file
+    # The reloader would run __main__ twice and start every loopback worker twice
+    app.run(host=args.host, port=args.port, debug=True, use_reloader=not args.loopback_workers)
\ No newline at end of file
@@ -0,0 +1,691 @@
+"""Production entry point: serves the app from an asyncio event loop.
+
+/stream/ is handled natively on the loop. FFmpeg runs as an asyncio subprocess,
+each viewer is a coroutine rather than a pair of blocked threads, a slow client
+holds back the encoder through the pipe, and a disconnect stops the encoder at
+once. Every other route is the Flask app, run on a bounded thread pool.
+
+    python asgi.py --host 0.0.0.0 --port 5000
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+    python asgi.py --worker-nodes http://10.0.0.5:5001,http://10.0.0.6:5001
+    python asgi.py --loopback-workers 2  # two worker processes on this box, for testing
+
+Workers are app.py processes started with --worker on other machines.
+
+uvicorn is only needed for this mode: pip install uvicorn
+"""
+import asyncio
+import concurrent.futures
+import io
+import json
+import sys
+import threading
+import time
+import traceback
+import urllib.parse
+
+from werkzeug.exceptions import HTTPException
+
+from app import (
+    app as flask_app, logger, METRICS, SCHEDULER, ACTIVE_STREAMS, BROADCASTS, _broadcast_lock,
+    BROADCAST_LAG_TIMEOUT, BROADCAST_RING_SIZE, LIVE_ADMISSION_TIMEOUT, ADMISSION_RETRY_AFTER,
+    RELAY_MAX_READ, TRANSCODE_PLAN, WORKER_CONNECT_TIMEOUT, WORKER_READ_TIMEOUT, AdmissionError,
+    Mp4FragmentSplitter, RelayReadSizer, TranscodeBroadcast, WorkerError, _attach_running_broadcast,
+    acquire_stream_source, build_stream_command, build_worker_payload, configure_workers, create_stream_session_id, get_broadcast_key,
+    get_cached_rendition, get_live_cost, get_rendition_plan, get_worker_headers, mark_worker_failed, open_stream_session,
+    parse_server_args, pick_workers, prepare_stream, record_worker_dispatch, rendition_exists, should_offload,
+    snap_to_keyframe, start_background_services
+)
+
+WSGI_THREADS = 32  # Flask requests handled at once (segments, playlists, static files, API)
+STREAM_PREFIX = '/stream/'
+_pending_starts = {}  # broadcast key -> future resolved once that broadcast is registered (loop only)
+
+
+class AsyncTranscodeBroadcast(TranscodeBroadcast):
+    """TranscodeBroadcast driven by the event loop instead of reader threads.
+
+    The ring buffer, lag timeout and copy-to-transcode fallback behave exactly as in
+    the threaded version. While the pump waits for a lagging viewer it stops reading
+    stdout, so the pipe fills and FFmpeg blocks until the client catches up.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cond = asyncio.Condition()
+
+    async def start(self):
+        await self._spawn()
+        self._reader = asyncio.create_task(self._read_output())
+
+    async def _spawn(self):
+        self.process = await asyncio.create_subprocess_exec(
+            *self.cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            limit=RELAY_MAX_READ  # Lets the transport buffer a whole read before pausing the pipe
+        )
+        if self.ticket:
+            SCHEDULER.attach_process(self.ticket, self.process)
+        logger.info(f"[Broadcast {self.short_id}] Started FFmpeg process ({self.mode}) for {self.filename}")
+        self._stderr_reader = asyncio.create_task(self._log_errors(self.process))
+
+    async def _log_errors(self, process):
+        """Feed stderr to the shared progress parser; the loop's selector multiplexes every pipe"""
+        pending = b''
+        while True:
+            data = await process.stderr.read(4096)
+            if not data:
+                break
+            lines = (pending + data).replace(b'\r', b'\n').split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                self._handle_log_line(line)
+
+    async def _read_output(self):
+        try:
+            await self._pump_output()
+            if self.init_segment is None and self.fallback_cmd and self.refs > 0:
+                await self._fall_back()
+                await self._pump_output()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"[Broadcast {self.short_id}] Error reading FFmpeg output: {e}")
+        finally:
+            async with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+            self._release_capacity()
+            logger.info(f"[Broadcast {self.short_id}] FFmpeg output ended for {self.filename}")
+
+    async def _fall_back(self):
+        """The copy path produced nothing usable; retry as a full transcode"""
+        logger.warning(f"[Broadcast {self.short_id}] {self.mode} failed for {self.filename} "
+                       f"(exit code {await self.process.wait()}), falling back to transcode")
+        self.cmd, self.mode, self.fallback_cmd = self.fallback_cmd, 'transcode', None
+        if self.ticket:
+            SCHEDULER.resize(self.ticket, get_live_cost(TRANSCODE_PLAN, self.settings))
+        await self._spawn()
+
+    async def _pump_output(self):
+        # The event loop's pipe transport hands over bytes, so this feed()s the pooled buffer
+        splitter = Mp4FragmentSplitter()
+        sizer = RelayReadSizer(self.settings['buf_size'])
+        try:
+            while True:
+                data = await self.process.stdout.read(sizer.size)
+                if not data:
+                    break
+                fragments = splitter.feed(data)
+                async with self.cond:
+                    if splitter.init_segment is not None and self.init_segment is None:
+                        self.init_segment = splitter.init_segment
+                        self.cond.notify_all()
+                    for fragment in fragments:
+                        await self._append_fragment(fragment)
+                sizer.record(len(data))
+        finally:
+            splitter.close()
+
+    async def _append_fragment(self, fragment):
+        """Add a fragment to the ring buffer (caller holds self.cond)"""
+        if len(self.fragments) >= BROADCAST_RING_SIZE:
+            # Give lagging viewers a chance to catch up before dropping the oldest fragment
+            deadline = time.time() + BROADCAST_LAG_TIMEOUT
+            while (self.viewers and min(self.viewers.values()) <= self._oldest_seq()
+                   and time.time() < deadline and self.refs > 0):
+                try:
+                    await asyncio.wait_for(self.cond.wait(), deadline - time.time())
+                except asyncio.TimeoutError:
+                    break
+            self.fragments.popleft()
+        self.fragments.append((self.next_seq, fragment))
+        self.next_seq += 1
+        self.cond.notify_all()
+
+    async def subscribe(self, session_id):
+        """Yield the init segment followed by fragments for a single viewer"""
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.init_segment is not None or self.finished)
+            if self.init_segment is None:
+                return
+            init_segment = self.init_segment
+            self.viewers[session_id] = self._oldest_seq()
+        yield init_segment
+
+        while True:
+            async with self.cond:
+                while True:
+                    if session_id not in self.viewers:
+                        return  # Detached
+                    position = max(self.viewers[session_id], self._oldest_seq())
+                    if position < self.next_seq:
+                        fragment = self.fragments[position - self._oldest_seq()][1]
+                        self.viewers[session_id] = position + 1
+                        self.cond.notify_all()
+                        break
+                    if self.finished:
+                        return
+                    await self.cond.wait()
+            yield fragment
+
+    async def detach(self, session_id):
+        async with self.cond:
+            self.viewers.pop(session_id, None)
+            self.cond.notify_all()
+
+    async def stop(self):
+        async with self.cond:
+            self.refs = 0
+            self.cond.notify_all()
+        try:
+            if self.process and self.process.returncode is None:
+                logger.info(f"[Broadcast {self.short_id}] Last viewer left, stopping FFmpeg")
+                self.process.terminate()
+                try:
+                    await asyncio.wait_for(self.process.wait(), 1)
+                except asyncio.TimeoutError:
+                    # FFmpeg keeps flushing its encoder on SIGTERM; nobody wants that output
+                    self.process.kill()
+                    await self.process.wait()
+        except ProcessLookupError:
+            pass
+        except Exception as e:
+            logger.warning(f"[Broadcast {self.short_id}] Error stopping FFmpeg: {e}")
+        self._release_capacity()
+
+
+class AsyncWorkerProcess:
+    """asyncio counterpart of app.WorkerProcess: a worker's response body as FFmpeg's stdout.
+
+    Worker responses have no length, so HTTP/1.1 servers send them chunked; a body
+    that stops without the last chunk means the worker failed.
+    """
+    pid = None
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.returncode = None
+        self.stdout = self
+        self._reader = self._writer = None
+        self._chunked = False
+        self._chunk_left = 0
+
+    async def connect(self, payload):
+        parsed = urllib.parse.urlsplit(self.worker)
+        body = json.dumps(payload).encode('utf-8')
+        headers = {'Host': parsed.netloc, 'Content-Type': 'application/json', 'Content-Length': str(len(body)),
+                   'Connection': 'close', **get_worker_headers()}
+        head = 'POST /worker/transcode HTTP/1.1\r\n' + ''.join(f"{k}: {v}\r\n" for k, v in headers.items()) + '\r\n'
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(parsed.hostname, parsed.port or 80), WORKER_CONNECT_TIMEOUT)
+            self._writer.write(head.encode('latin-1') + body)
+            # The worker may queue for admission before it answers
+            status, response_headers = await asyncio.wait_for(self._read_head(), WORKER_READ_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, ValueError) as e:
+            self.terminate()
+            raise WorkerError(f"{self.worker}: {e!r}") from e
+        if status != 200:
+            self.terminate()
+            raise WorkerError(f"{self.worker} answered {status}")
+        self._chunked = response_headers.get('transfer-encoding', '').lower() == 'chunked'
+
+    async def _read_head(self):
+        parts = (await self._reader.readline()).split()
+        if len(parts) < 2:
+            raise ValueError('no HTTP response')
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                return int(parts[1]), headers
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+    async def read(self, size):
+        try:
+            data = await asyncio.wait_for(self._read_body(size), WORKER_READ_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+            if self.returncode is None:
+                logger.warning(f"Lost the stream from worker {self.worker}: {e!r}")
+                self.returncode = 1
+            return b''
+        if not data and self.returncode is None:
+            self.returncode = 0
+        return data
+
+    async def _read_body(self, size):
+        if self.returncode is not None:
+            return b''
+        if not self._chunked:
+            return await self._reader.read(size)
+        if self._chunk_left == 0:
+            line = await self._reader.readline()
+            if not line.endswith(b'\n'):
+                raise asyncio.IncompleteReadError(line, None)
+            self._chunk_left = int(line.split(b';')[0], 16)
+            if self._chunk_left == 0:
+                return b''  # The last chunk: FFmpeg on the worker exited cleanly
+        data = await self._reader.read(min(size, self._chunk_left))
+        if not data:
+            raise asyncio.IncompleteReadError(data, self._chunk_left)
+        self._chunk_left -= len(data)
+        if self._chunk_left == 0:
+            await self._reader.readexactly(2)  # CRLF closing the chunk
+        return data
+
+    async def wait(self):
+        return self.returncode
+
+    def terminate(self):
+        """Drop the connection; the worker kills its FFmpeg once it notices"""
+        if self.returncode is None:
+            self.returncode = -15
+        if self._writer:
+            self._writer.close()
+
+    kill = terminate
+
+
+class AsyncRemoteTranscodeBroadcast(AsyncTranscodeBroadcast):
+    """AsyncTranscodeBroadcast fed by a worker node, encoding locally if the worker fails before
+    the init segment (see app.RemoteTranscodeBroadcast)"""
+
+    def __init__(self, key, cmd, settings, filename, plan, worker, payload):
+        super().__init__(key, cmd, settings, filename, plan['mode'], fallback_cmd=cmd)
+        self.plan = plan
+        self.worker = worker
+        self.payload = payload
+
+    async def _spawn(self):
+        if self.worker is None:
+            await super()._spawn()
+            return
+        process = AsyncWorkerProcess(self.worker)
+        await process.connect(self.payload)
+        self.process = process
+        logger.info(f"[Broadcast {self.short_id}] Encoding {self.filename} on worker {self.worker}")
+
+    async def _fall_back(self):
+        mark_worker_failed(self.worker, f"stopped before sending any video for {self.filename}")
+        self.ticket = await asyncio.to_thread(SCHEDULER.acquire, 'live', get_live_cost(self.plan, self.settings),
+                                              f"stream:{self.filename}", LIVE_ADMISSION_TIMEOUT)
+        self.worker, self.fallback_cmd = None, None
+        if self.refs <= 0:
+            return  # Everyone left while we waited; _read_output releases the ticket
+        logger.warning(f"[Broadcast {self.short_id}] Encoding {self.filename} locally instead")
+        await self._spawn()
+
+
+async def start_async_remote_broadcast(key, input_path, start_time, settings, plan, filename, base_url):
+    """Start a broadcast on the least loaded worker that accepts it; None if none does"""
+    payload = build_worker_payload('stream', input_path, plan, start_time, settings, base_url)
+    if payload is None:
+        return None
+    cost = get_live_cost(plan, settings)
+    cmd = build_stream_command(input_path, start_time, settings, plan)  # Used if the worker fails
+    for worker in pick_workers(cost):
+        broadcast = AsyncRemoteTranscodeBroadcast(key, cmd, settings, filename, plan, worker, payload)
+        broadcast.refs += 1
+        try:
+            await broadcast.start()
+        except WorkerError as e:
+            broadcast.finished = True
+            mark_worker_failed(worker, e)
+            continue
+        record_worker_dispatch(worker, cost)
+        return broadcast
+    return None
+
+
+async def start_async_local_broadcast(key, input_path, start_time, settings, plan, filename):
+    # Admission blocks on a threading.Condition, so wait for it off the loop
+    ticket = await asyncio.to_thread(SCHEDULER.acquire, 'live', get_live_cost(plan, settings),
+                                     f"stream:{filename}", LIVE_ADMISSION_TIMEOUT)
+    io_slot = await asyncio.to_thread(acquire_stream_source, input_path, start_time, filename)
+    cmd = build_stream_command(input_path, start_time, settings, plan)
+    fallback_cmd = None
+    if plan['mode'] != 'transcode':
+        fallback_cmd = build_stream_command(input_path, start_time, settings, dict(plan, **TRANSCODE_PLAN))
+    broadcast = AsyncTranscodeBroadcast(key, cmd, settings, filename, plan['mode'], fallback_cmd, ticket, io_slot)
+    broadcast.refs += 1
+    try:
+        await broadcast.start()
+    except Exception:
+        broadcast.finished = True
+        broadcast._release_capacity()
+        raise
+    return broadcast
+
+
+async def acquire_async_broadcast(input_path, start_time, settings, plan, filename, base_url=None):
+    """Async counterpart of app.acquire_broadcast; broadcasts share the same registry.
+
+    Viewers arriving while the same transcode is waiting for admission wait for that
+    start instead of asking the scheduler for a second slot.
+    """
+    key = get_broadcast_key(input_path, start_time, settings, plan)
+    while key in _pending_starts:
+        await asyncio.shield(_pending_starts[key])  # Raises the starter's AdmissionError too
+    with _broadcast_lock:
+        broadcast = _attach_running_broadcast(key, filename)
+    if broadcast:
+        return broadcast
+
+    pending = _pending_starts[key] = asyncio.get_running_loop().create_future()
+    try:
+        broadcast = None
+        if should_offload(plan):
+            broadcast = await start_async_remote_broadcast(key, input_path, start_time, settings, plan,
+                                                           filename, base_url)
+        if broadcast is None:
+            broadcast = await start_async_local_broadcast(key, input_path, start_time, settings, plan, filename)
+        with _broadcast_lock:
+            BROADCASTS[key] = broadcast
+    except Exception as e:
+        pending.set_exception(e)
+        pending.exception()  # Retrieved here, so it isn't reported when nobody else was waiting
+        raise
+    finally:
+        if not pending.done():
+            pending.set_result(None)  # Registered, or cancelled: waiters look again either way
+        del _pending_starts[key]
+    return broadcast
+
+
+async def release_async_broadcast(broadcast, session_id):
+    """Drop one viewer and stop the encoder once the last one has gone"""
+    await broadcast.detach(session_id)
+    with _broadcast_lock:
+        broadcast.refs -= 1
+        if broadcast.refs > 0:
+            return
+        if BROADCASTS.get(broadcast.key) is broadcast:
+            del BROADCASTS[broadcast.key]
+    await broadcast.stop()
+
+
+def get_base_url(scope):
+    """scheme://host the client used, which workers fetch videos from unless WORKER_SOURCE_URL is set"""
+    host = dict(scope['headers']).get(b'host', b'').decode('latin-1')
+    if not host:
+        server = scope.get('server') or ('localhost', 80)
+        host = f"{server[0]}:{server[1]}"
+    return f"{scope.get('scheme', 'http')}://{host}"
+
+
+async def send_simple_response(send, status, body=b'', headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [(b'content-type', b'text/plain; charset=utf-8'),
+                    (b'content-length', str(len(body)).encode('latin-1'))] + list(headers)
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def stream_endpoint(scope, receive, send, wsgi):
+    """/stream/<filename> served on the event loop (file responses for cached renditions go to wsgi)"""
+    request_started = time.time()
+    filename = scope['path'][len(STREAM_PREFIX):]
+    args = urllib.parse.parse_qs(scope['query_string'].decode('latin-1'))
+    try:
+        # Probing and keyframe lookups touch SQLite and may run ffprobe
+        input_path, start_time, settings, plan = await asyncio.to_thread(
+            prepare_stream, filename, args.get('start', ['0'])[0], args.get('optimized', ['0'])[0] == '1',
+            args.get('audio', [None])[0])
+    except HTTPException as e:
+        await send_simple_response(send, e.code, e.name.encode('utf-8'))
+        return
+
+    if plan['mode'] != 'remux':
+        if (float(start_time) == 0 and plan.get('audio_track') is None
+                and await asyncio.to_thread(rendition_exists, input_path, settings)):
+            # A plain file with range support: nothing to gain from serving it on the loop
+            await wsgi(scope, receive, send)
+            return
+        rendition = await asyncio.to_thread(get_cached_rendition, input_path, settings)
+        if rendition:
+            input_path, plan = rendition, get_rendition_plan(input_path, plan)
+            # Copying the rendition's video can only start on one of its own keyframes
+            start_time = await asyncio.to_thread(snap_to_keyframe, rendition, start_time)
+
+    session_id = create_stream_session_id()
+    loop = asyncio.get_running_loop()
+    torn_down = asyncio.Event()
+    try:
+        # Register the viewer first, so sessions it displaces free their encode capacity
+        open_stream_session(session_id, (scope.get('client') or ('',))[0], filename=filename,
+                            # app.cleanup_stream runs on other threads; hand the teardown back to the loop
+                            on_cleanup=lambda: loop.call_soon_threadsafe(torn_down.set))
+        broadcast = await acquire_async_broadcast(input_path, start_time, settings, plan, filename,
+                                                  get_base_url(scope))
+    except AdmissionError as e:
+        ACTIVE_STREAMS.close(session_id)
+        logger.warning(f"Rejecting session: {e}")
+        METRICS.inc('letswatch_admission_rejections_total')
+        await send_simple_response(send, 503, str(e).encode('utf-8'),
+                                   [(b'retry-after', str(ADMISSION_RETRY_AFTER).encode('latin-1'))])
+        return
+    except Exception as e:
+        ACTIVE_STREAMS.close(session_id)
+        logger.error(f"[Session {session_id[:8]}] Error starting FFmpeg: {e}")
+        await send_simple_response(send, 500, b'Internal Server Error')
+        return
+
+    ACTIVE_STREAMS.update(session_id, process=broadcast.process, broadcast=broadcast)
+    logger.info(f"[Session {session_id[:8]}] Attached to broadcast {broadcast.short_id} "
+                f"({broadcast.refs} viewer(s)): {' '.join(broadcast.cmd)}")
+    METRICS.inc('letswatch_stream_sessions_total')
+
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', b'video/mp4'),
+            (b'accept-ranges', b'none'),  # A live pipe can't serve byte ranges; use /hls/ for seeking
+            (b'cache-control', b'no-cache, no-store, must-revalidate'),
+            (b'pragma', b'no-cache'),
+            (b'expires', b'0'),
+            (b'x-stream-session', session_id.encode('latin-1')),
+            (b'x-stream-start', start_time.encode('latin-1'))  # Actual start after snapping to a keyframe
+        ]
+    })
+    streaming = asyncio.create_task(_send_broadcast(send, broadcast, session_id, request_started))
+    disconnected = asyncio.create_task(wait_for_disconnect(receive))
+    reaped = asyncio.create_task(torn_down.wait())
+    try:
+        await asyncio.wait({streaming, disconnected, reaped}, return_when=asyncio.FIRST_COMPLETED)
+        if disconnected.done():
+            logger.info(f"[Session {session_id[:8]}] Client disconnected")
+    finally:
+        for task in (streaming, disconnected, reaped):
+            task.cancel()
+        ACTIVE_STREAMS.close(session_id)
+        await release_async_broadcast(broadcast, session_id)
+        logger.info(f"[Session {session_id[:8]}] Finished streaming {filename}")
+
+
+async def _send_broadcast(send, broadcast, session_id, request_started):
+    """Relay a broadcast to one client; send() waits while the client's socket buffer is full"""
+    bytes_sent = 0
+    try:
+        async for chunk in broadcast.subscribe(session_id):
+            if not bytes_sent:
+                METRICS.observe('letswatch_stream_ttfb_seconds', time.time() - request_started)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            bytes_sent += len(chunk)
+            ACTIVE_STREAMS.touch(session_id, len(chunk))
+            METRICS.inc('letswatch_stream_bytes_sent_total', len(chunk))
+        await send({'type': 'http.response.body', 'body': b''})
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"[Session {session_id[:8]}] Error during streaming: {e}")
+        logger.error(traceback.format_exc())
+
+
+def build_environ(scope, body):
+    """WSGI environ for an ASGI HTTP scope"""
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-length':
+            continue
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = f"{environ[key]},{value}" if key in environ else value
+    return environ
+
+
+class WsgiBridge:
+    """Run a WSGI app for ASGI HTTP requests on a bounded thread pool.
+
+    Body chunks are handed to the loop one at a time and the worker waits for each
+    send to complete, so slow clients throttle the iterator instead of buffering it.
+    """
+
+    def __init__(self, wsgi_app, max_workers=WSGI_THREADS):
+        self.wsgi_app = wsgi_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers, thread_name_prefix='wsgi')
+
+    async def __call__(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        loop = asyncio.get_running_loop()
+        disconnected = threading.Event()
+
+        async def watch_disconnect():
+            await wait_for_disconnect(receive)
+            disconnected.set()
+
+        watcher = asyncio.create_task(watch_disconnect())
+        try:
+            await loop.run_in_executor(self.executor, self._run, build_environ(scope, bytes(body)),
+                                       loop, send, disconnected)
+        finally:
+            watcher.cancel()
+
+    def _run(self, environ, loop, send, disconnected):
+        status_and_headers = []
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and status_and_headers:
+                raise exc_info[1].with_traceback(exc_info[2])
+            status_and_headers[:] = [
+                int(status.split(' ', 1)[0]),
+                [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+            ]
+
+        def send_sync(message):
+            asyncio.run_coroutine_threadsafe(send(message), loop).result()
+
+        result = self.wsgi_app(environ, start_response)
+        started = False
+        try:
+            for chunk in result:
+                if disconnected.is_set():
+                    return
+                if not chunk:
+                    continue
+                if not started:
+                    send_sync({'type': 'http.response.start', 'status': status_and_headers[0],
+                               'headers': status_and_headers[1]})
+                    started = True
+                send_sync({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+            if not started:
+                send_sync({'type': 'http.response.start', 'status': status_and_headers[0],
+                           'headers': status_and_headers[1]})
+            send_sync({'type': 'http.response.body', 'body': b''})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+
+
+class LetsWatchASGI:
+    """ASGI application: /stream/ on the event loop, everything else through Flask"""
+
+    def __init__(self, wsgi_app):
+        self.wsgi = WsgiBridge(wsgi_app)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            if scope['method'] == 'GET' and scope['path'].startswith(STREAM_PREFIX):
+                await stream_endpoint(scope, receive, send, self.wsgi)
+            else:
+                await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await asyncio.to_thread(start_background_services)
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.wsgi.executor.shutdown(wait=False, cancel_futures=True)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = LetsWatchASGI(flask_app)
+
+
+def main():
+    args = parse_server_args('Run the production (ASGI) server').parse_args()
+
+    try:
+        import uvicorn
+    except ImportError:
+        sys.exit("The production server needs uvicorn: pip install uvicorn")
+
+    configure_workers(args)
+    # One worker process: sessions, broadcasts and the encode budget live in this process
+    uvicorn.run(application, host=args.host, port=args.port, workers=1, log_level='info')
+
+
+if __name__ == '__main__':
+    main()
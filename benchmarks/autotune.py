@@ -0,0 +1,70 @@
+"""Benchmark live encoder settings for one file and show which profile the tuner would pick.
+
+Runs from the repository root against the local videos folder (no server needed):
+
+    python benchmarks/autotune.py --file movie.mkv
+    python benchmarks/autotune.py --file movie.mkv --grid --save
+
+Each trial encodes a short sample with the same command /stream/ uses and reports
+its realtime factor, output bitrate and the cores it used. By default the search
+stops at the first setting that keeps up, like the server's background tuner;
+--grid measures every preset/CRF/thread combination instead.
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+import app  # noqa: E402
+
+
+def run_grid(input_path):
+    """Measure every combination at the default scale, without stopping early"""
+    metadata = app.get_media_metadata(input_path)
+    plan = app.get_transcode_plan(metadata)
+    base = app.get_default_streaming_settings(os.path.relpath(input_path, app.VIDEO_FOLDER))
+    duration = app.get_video_duration(input_path)
+    start_time = f"{max(0.0, min(duration * app.TUNE_SAMPLE_POSITION, duration - app.TUNE_SAMPLE_SECONDS)):.3f}"
+    trials = []
+    for threads, preset, crf in itertools.product(app.TUNE_THREADS, app.TUNE_PRESETS, app.TUNE_CRFS):
+        settings = dict(base, preset=preset, crf=crf, threads=threads)
+        trials.append(app.run_encoder_trial(input_path, start_time, settings, plan))
+        print(json.dumps(trials[-1]), file=sys.stderr)
+    return trials
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file', required=True, help='MKV path relative to the videos folder')
+    parser.add_argument('--sample', type=float, default=app.TUNE_SAMPLE_SECONDS, help='seconds encoded per trial')
+    parser.add_argument('--min-speed', type=float, default=app.TUNE_MIN_SPEED,
+                        help='realtime factor a setting has to sustain')
+    parser.add_argument('--grid', action='store_true', help='measure every combination instead of searching')
+    parser.add_argument('--save', action='store_true', help='store the chosen profile for the server to use (search mode)')
+    args = parser.parse_args()
+
+    app.TUNE_SAMPLE_SECONDS = args.sample
+    app.TUNE_MIN_SPEED = args.min_speed
+    app.create_directories()
+    input_path = os.path.join(app.VIDEO_FOLDER, args.file)
+    if not os.path.exists(input_path):
+        parser.error(f"{input_path} does not exist")
+
+    report = {'file': args.file, 'defaults': app.get_default_streaming_settings(args.file)}
+    if args.grid:
+        report['trials'] = run_grid(input_path)
+    else:
+        profile, trials = app.tune_encoder_settings(input_path)
+        report.update(profile=profile, trials=trials)
+        if args.save and profile:
+            app.save_encoder_profile(input_path, profile, trials)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
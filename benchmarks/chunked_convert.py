@@ -0,0 +1,97 @@
+"""Compare single-process convert_video() with the chunked parallel conversion on one file.
+
+Runs from the repository root against the local videos folder (no server needed):
+
+    python benchmarks/chunked_convert.py --file movie.mkv
+    python benchmarks/chunked_convert.py --file movie.mkv --processes 8 --chunk-seconds 20
+
+Both modes transcode the video whatever the file's codecs are, write to a scratch
+folder that is removed afterwards, and are reported with their wall-clock time,
+output size and the frame count and duration ffprobe sees in the result, so a
+chunked output that dropped or duplicated frames at a boundary shows up.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+import app  # noqa: E402
+
+
+def probe_output(path):
+    result = subprocess.run([
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+        '-show_entries', 'stream=nb_read_packets,codec_name,profile,pix_fmt:format=duration',
+        '-of', 'json', path
+    ], capture_output=True, text=True, check=True)
+    info = json.loads(result.stdout)
+    stream = info['streams'][0]
+    return {
+        'frames': int(stream.get('nb_read_packets', 0)) or None,
+        'duration': round(float(info['format']['duration']), 3),
+        'codec': f"{stream['codec_name']} {stream.get('profile', '')} {stream.get('pix_fmt', '')}".strip()
+    }
+
+
+def run_mode(mode, input_path, output_dir):
+    """Time one convert_video() call with chunking forced on or off"""
+    app.CHUNKED_CONVERT_MIN_DURATION = 0 if mode == 'chunked' else float('inf')
+    output_path = os.path.join(output_dir, f"{mode}.mp4")
+    started = time.perf_counter()
+    ok = app.convert_video(input_path, output_path)
+    elapsed = time.perf_counter() - started
+    result = {'ok': ok, 'seconds': round(elapsed, 2)}
+    if ok:
+        result['bytes'] = os.path.getsize(output_path)
+        result.update(probe_output(output_path))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file', required=True, help='MKV path relative to the videos folder')
+    parser.add_argument('--mode', choices=['single', 'chunked', 'both'], default='both')
+    parser.add_argument('--processes', type=int, default=app.MAX_CHUNK_PROCESSES,
+                        help='FFmpeg processes encoding chunks at once')
+    parser.add_argument('--chunk-seconds', type=float, default=app.CHUNK_MIN_SECONDS,
+                        help='shortest chunk the source is split into')
+    args = parser.parse_args()
+
+    app.MAX_CHUNK_PROCESSES = args.processes
+    app.CHUNK_MIN_SECONDS = args.chunk_seconds
+    app.create_directories()
+    input_path = os.path.join(app.VIDEO_FOLDER, args.file)
+    if not os.path.exists(input_path):
+        parser.error(f"{input_path} does not exist")
+    if args.mode != 'single' and args.processes < 2:
+        parser.error('chunked conversion needs --processes of at least 2')
+
+    # Force a video transcode so both modes do the same work even for browser-ready sources
+    plan = dict(app.get_transcode_plan(app.get_media_metadata(input_path)), video='transcode', mode='transcode')
+    app.get_transcode_plan = lambda metadata, audio_track=None: plan
+
+    report = {'file': args.file, 'duration': app.get_video_duration(input_path),
+              'processes': args.processes, 'convert_threads': app.CONVERT_THREADS}
+    output_dir = tempfile.mkdtemp(prefix='chunked-convert-')
+    try:
+        modes = ['single', 'chunked'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            report[mode] = run_mode(mode, input_path, output_dir)
+            print(json.dumps({mode: report[mode]}), file=sys.stderr)
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    if report.get('single', {}).get('ok') and report.get('chunked', {}).get('ok'):
+        report['speedup'] = round(report['single']['seconds'] / report['chunked']['seconds'], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
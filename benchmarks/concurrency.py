@@ -0,0 +1,151 @@
+"""Compare the threaded Flask server with the ASGI server under many concurrent /stream/ viewers.
+
+Starts each server in turn from the repository root, opens --clients concurrent
+streams, and samples the server process (threads, RSS, CPU) while they play:
+
+    python benchmarks/concurrency.py --file movie.mkv --clients 100 --duration 30
+
+By default every client requests the same start time, so they share one FFmpeg
+process and the numbers reflect per-viewer server overhead rather than encoding.
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.parse
+
+import psutil
+
+from ttfb import percentile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SERVER_COMMANDS = {
+    'threaded': lambda host, port: [
+        sys.executable, '-c',
+        f"import app; app.start_background_services(); app.app.run(host={host!r}, port={port}, threaded=True)"
+    ],
+    'asgi': lambda host, port: [sys.executable, 'asgi.py', '--host', host, '--port', str(port)],
+}
+
+
+async def wait_for_server(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            _, writer = await asyncio.open_connection(host, port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"Server on {host}:{port} did not start within {timeout}s")
+
+
+async def stream_client(host, port, path, duration, rate):
+    """Read one stream for `duration` seconds, optionally throttled to `rate` bytes/s like a player"""
+    result = {'ttfb': None, 'bytes': 0, 'status': None}
+    started = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode('latin-1'))
+        await writer.drain()
+        status_line = await reader.readline()
+        result['status'] = int(status_line.split()[1]) if status_line else None
+        while (await reader.readline()) not in (b'\r\n', b''):
+            pass
+        while time.perf_counter() - started < duration:
+            data = await reader.read(64 * 1024)
+            if not data:
+                break
+            if result['ttfb'] is None:
+                result['ttfb'] = time.perf_counter() - started
+            result['bytes'] += len(data)
+            if rate:
+                # Sleep until this many bytes would have been consumed at the playback rate
+                ahead = result['bytes'] / rate - (time.perf_counter() - started)
+                if ahead > 0:
+                    await asyncio.sleep(min(ahead, duration))
+    finally:
+        writer.close()
+    return result
+
+
+async def sample_process(pid, stop, samples):
+    process = psutil.Process(pid)
+    process.cpu_percent(interval=None)
+    while not stop.is_set():
+        await asyncio.sleep(0.5)
+        try:
+            with process.oneshot():
+                samples.append({'threads': process.num_threads(), 'rss': process.memory_info().rss,
+                                'cpu_percent': process.cpu_percent(interval=None)})
+        except psutil.Error:
+            break
+
+
+async def run_mode(mode, args):
+    host, port = '127.0.0.1', args.port
+    server = subprocess.Popen(SERVER_COMMANDS[mode](host, port), cwd=REPO_ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_for_server(host, port)
+        # Warm the metadata and keyframe caches so the first viewers aren't penalised
+        await stream_client(host, port, f"/stream/{urllib.parse.quote(args.file)}", 2, 0)
+        await asyncio.sleep(2)
+
+        samples, stop = [], asyncio.Event()
+        sampler = asyncio.create_task(sample_process(server.pid, stop, samples))
+        clients = []
+        for i in range(args.clients):
+            start = f"?start={i * args.start_step:.2f}" if args.start_step else ''
+            path = f"/stream/{urllib.parse.quote(args.file)}{start}"
+            clients.append(stream_client(host, port, path, args.duration, args.rate))
+        results = await asyncio.gather(*clients, return_exceptions=True)
+        stop.set()
+        await sampler
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+    ok = [r for r in results if isinstance(r, dict) and r['status'] == 200 and r['ttfb'] is not None]
+    ttfbs = [r['ttfb'] for r in ok]
+    total_bytes = sum(r['bytes'] for r in ok)
+    return {
+        'clients': args.clients,
+        'ok': len(ok),
+        'failed': len(results) - len(ok),
+        'ttfb_p50': percentile(ttfbs, 50),
+        'ttfb_p95': percentile(ttfbs, 95),
+        'throughput_bytes_per_second': round(total_bytes / args.duration),
+        'server_peak_threads': max((s['threads'] for s in samples), default=None),
+        'server_peak_rss': max((s['rss'] for s in samples), default=None),
+        'server_mean_cpu_percent': round(sum(s['cpu_percent'] for s in samples) / len(samples), 1) if samples else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--file', required=True, help='MKV path relative to the videos folder')
+    parser.add_argument('--mode', choices=['threaded', 'asgi', 'both'], default='both')
+    parser.add_argument('--clients', type=int, default=50, help='concurrent viewers')
+    parser.add_argument('--duration', type=float, default=20, help='seconds each viewer plays')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='per-viewer read rate in bytes/s (0 reads as fast as the server sends)')
+    parser.add_argument('--start-step', type=float, default=0,
+                        help='give viewer i start=i*STEP so each needs its own encode (0 shares one)')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    modes = ['threaded', 'asgi'] if args.mode == 'both' else [args.mode]
+    report = {mode: asyncio.run(run_mode(mode, args)) for mode in modes}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Generate synthetic test media with FFmpeg's lavfi sources, for benchmarks that run offline.
+
+Writes into videos/loadtest in the repository by default:
+
+    python benchmarks/fixtures.py
+    python benchmarks/fixtures.py --resolutions 1920x1080 --codecs hevc-aac --durations 600
+
+Every file is a testsrc2 picture with a sine tone, named after its parameters
+(e.g. 1280x720-hevc-aac-120s.mkv) and skipped if it already exists, so repeated
+runs reuse the same inputs. The codec mixes cover the server's conversion plans:
+direct play, remux with an audio transcode, and a full video transcode.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FIXTURE_FPS = 25
+FIXTURE_KEYFRAME_SECONDS = 2
+X264_ARGS = ['-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p']
+FIXTURE_CODECS = {
+    # name: (container, encoders it needs, video args, audio args)
+    'h264-aac': ('mp4', ('libx264', 'aac'), X264_ARGS, ['-c:a', 'aac', '-b:a', '128k']),
+    'h264-ac3': ('mkv', ('libx264', 'ac3'), X264_ARGS, ['-c:a', 'ac3', '-ac', '6', '-b:a', '384k']),
+    'hevc-aac': ('mkv', ('libx265', 'aac'),
+                 ['-c:v', 'libx265', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-x265-params', 'log-level=error'],
+                 ['-c:a', 'aac', '-b:a', '128k']),
+}
+DEFAULT_RESOLUTIONS = ['640x360', '1280x720', '1920x1080']
+DEFAULT_DURATIONS = [30, 120]
+
+
+def available_encoders():
+    result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, check=True)
+    return {line.split()[1] for line in result.stdout.splitlines() if len(line.split()) > 1}
+
+
+def generate_fixture(output_dir, resolution, codec, duration):
+    """Encode one fixture unless it exists; returns its description"""
+    container, _, video_args, audio_args = FIXTURE_CODECS[codec]
+    name = f"{resolution}-{codec}-{duration}s.{container}"
+    path = os.path.join(output_dir, name)
+    if not os.path.exists(path):
+        temp_path = f"{path}.part"
+        subprocess.run([
+            'ffmpeg', '-nostdin', '-v', 'error',
+            '-f', 'lavfi', '-i', f"testsrc2=size={resolution}:rate={FIXTURE_FPS}:duration={duration}",
+            '-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={duration}",
+            *video_args, '-g', str(FIXTURE_FPS * FIXTURE_KEYFRAME_SECONDS), *audio_args,
+            '-shortest', '-f', 'mp4' if container == 'mp4' else 'matroska', '-y', temp_path
+        ], check=True)
+        os.replace(temp_path, path)
+    return {'name': name, 'resolution': resolution, 'codec': codec, 'duration': duration,
+            'bytes': os.path.getsize(path)}
+
+
+def generate_fixtures(output_dir, resolutions=DEFAULT_RESOLUTIONS, codecs=tuple(FIXTURE_CODECS),
+                      durations=DEFAULT_DURATIONS):
+    """Generate every resolution/codec/duration combination FFmpeg has encoders for"""
+    os.makedirs(output_dir, exist_ok=True)
+    encoders = available_encoders()
+    fixtures = []
+    for codec in codecs:
+        missing = [e for e in FIXTURE_CODECS[codec][1] if e not in encoders]
+        if missing:
+            print(f"Skipping {codec} fixtures: FFmpeg has no {', '.join(missing)} encoder", file=sys.stderr)
+            continue
+        for resolution in resolutions:
+            for duration in durations:
+                fixtures.append(generate_fixture(output_dir, resolution, codec, duration))
+    return fixtures
+
+
+def add_fixture_arguments(parser):
+    parser.add_argument('--resolutions', nargs='+', default=DEFAULT_RESOLUTIONS, metavar='WxH')
+    parser.add_argument('--codecs', nargs='+', default=list(FIXTURE_CODECS), choices=list(FIXTURE_CODECS))
+    parser.add_argument('--durations', nargs='+', type=int, default=DEFAULT_DURATIONS, metavar='SECONDS')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--output', default=os.path.join(REPO_ROOT, 'videos', 'loadtest'),
+                        help='folder to write the fixtures to')
+    add_fixture_arguments(parser)
+    args = parser.parse_args()
+    fixtures = generate_fixtures(args.output, args.resolutions, args.codecs, args.durations)
+    print(json.dumps(fixtures, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+"""Load-test the server with synthetic media at one or more concurrency levels.
+
+Generates the fixtures (see fixtures.py) if needed, starts the server from the
+repository root and runs each scenario with --concurrency clients for --duration
+seconds, for every concurrency level given:
+
+    python benchmarks/loadtest.py --concurrency 1 8 32 --output results.json
+    python benchmarks/loadtest.py --scenarios stream --concurrency 4 16 --baseline results.json
+
+Scenarios:
+    index   GET / (catalog page)
+    scrub   GET /videos/<file> with random byte ranges, like dragging the seek bar
+    stream  GET /stream/<file>?start=<random> for --stream-seconds, then
+            /stream-stats/<session> for the encoder's realtime factor
+    convert GET /convert/<file> and poll /jobs/<id> until the job finishes
+
+Each result has throughput, TTFB and latency percentiles, the FFmpeg realtime
+factor where one applies, and CPU/RSS of the server process and of its FFmpeg
+children sampled with psutil. With --baseline, results are matched by scenario
+and concurrency against an earlier run and the relative changes are added.
+Use --server none --url ... (and --pid for process stats) for a server that is
+already running.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+import psutil
+
+from concurrency import SERVER_COMMANDS
+from fixtures import REPO_ROOT, add_fixture_arguments, generate_fixtures
+from ttfb import percentile
+
+SCRUB_BYTES = 256 * 1024
+JOB_POLL_INTERVAL = 0.5  # seconds between /jobs/ polls
+REQUEST_TIMEOUT = 60
+
+
+def wait_for_server(host, port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection(host, port, timeout=5)
+            connection.request('GET', '/metrics')
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Server on {host}:{port} did not start within {timeout}s")
+
+
+def timed_request(host, port, path, headers=None, read_seconds=None, before_close=None):
+    """Issue one GET and return a sample of its status, TTFB, latency and size.
+
+    The body is read to the end, or for read_seconds when streaming;
+    before_close(response, sample) runs while the connection is still open.
+    """
+    sample = {'status': None, 'ttfb': None, 'latency': None, 'bytes': 0}
+    connection = http.client.HTTPConnection(host, port, timeout=REQUEST_TIMEOUT)
+    started = time.perf_counter()
+    try:
+        connection.request('GET', path, headers=headers or {})
+        response = connection.getresponse()
+        sample['status'] = response.status
+        while read_seconds is None or time.perf_counter() - started < read_seconds:
+            data = response.read1(64 * 1024)
+            if not data:
+                break
+            if sample['ttfb'] is None:
+                sample['ttfb'] = time.perf_counter() - started
+            sample['bytes'] += len(data)
+        sample['latency'] = time.perf_counter() - started
+        if before_close:
+            before_close(response, sample)
+        return sample
+    finally:
+        connection.close()
+
+
+def get_json(host, port, path):
+    connection = http.client.HTTPConnection(host, port, timeout=REQUEST_TIMEOUT)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'null')
+    finally:
+        connection.close()
+
+
+def quote(name):
+    return urllib.parse.quote(name)
+
+
+class Scenario:
+    """One kind of client request loop; run() keeps issuing requests until the deadline"""
+
+    def __init__(self, host, port, fixtures, args, rng):
+        self.host, self.port = host, port
+        self.fixtures = fixtures
+        self.args = args
+        self.rng = rng
+
+    def pick(self):
+        return self.rng.choice(self.fixtures)
+
+    def path(self, fixture):
+        return f"{self.args.fixture_folder}/{fixture['name']}"
+
+
+class IndexScenario(Scenario):
+    def run(self, deadline, samples):
+        while time.monotonic() < deadline:
+            samples.append(timed_request(self.host, self.port, '/'))
+
+
+class ScrubScenario(Scenario):
+    def run(self, deadline, samples):
+        while time.monotonic() < deadline:
+            fixture = self.pick()
+            start = self.rng.randrange(0, max(1, fixture['bytes'] - SCRUB_BYTES))
+            headers = {'Range': f"bytes={start}-{start + SCRUB_BYTES - 1}"}
+            samples.append(timed_request(self.host, self.port, f"/videos/{quote(self.path(fixture))}", headers))
+
+
+class StreamScenario(Scenario):
+    def run(self, deadline, samples):
+        while time.monotonic() < deadline:
+            fixture = self.pick()
+            start = self.rng.uniform(0, max(0, fixture['duration'] - self.args.stream_seconds))
+            path = f"/stream/{quote(self.path(fixture))}?start={start:.2f}"
+            read_seconds = min(self.args.stream_seconds, max(1.0, deadline - time.monotonic()))
+            samples.append(timed_request(self.host, self.port, path, read_seconds=read_seconds,
+                                         before_close=self.stats_reader(samples)))
+
+    def stats_reader(self, samples):
+        return lambda response, sample: self.read_stats(response, sample, samples)
+
+    def read_stats(self, response, sample, samples):
+        """Ask for the encoder's speed while the stream is still open"""
+        sample['source'] = response.getheader('X-Stream-Source', 'ffmpeg')
+        session_id = response.getheader('X-Stream-Session')
+        if not session_id:
+            return
+        started = time.perf_counter()
+        status, stats = get_json(self.host, self.port, f"/stream-stats/{session_id}")
+        samples.append({'kind': 'stream-stats', 'status': status, 'latency': time.perf_counter() - started})
+        if status == 200 and stats.get('encode_speed'):
+            sample['realtime_factor'] = stats['encode_speed']
+
+
+class ConvertScenario(Scenario):
+    def run(self, deadline, samples):
+        while time.monotonic() < deadline:
+            fixture = self.pick()
+            started = time.perf_counter()
+            status, job = get_json(self.host, self.port, f"/convert/{quote(self.path(fixture))}")
+            # TTFB here is how long queueing the job took; latency runs until it finished
+            sample = {'status': status, 'ttfb': time.perf_counter() - started, 'bytes': 0}
+            status_url = job.get('status_url')
+            while status == 202 and job.get('status') in ('queued', 'running'):
+                if time.monotonic() > deadline + self.args.convert_timeout:
+                    sample['status'] = 'timeout'
+                    break
+                time.sleep(JOB_POLL_INTERVAL)
+                _, job = get_json(self.host, self.port, status_url)
+            sample['latency'] = time.perf_counter() - started
+            if job.get('status') == 'failed':
+                sample['status'] = 'failed'
+            elif job.get('status') == 'done' and job.get('started_at') and job.get('finished_at'):
+                sample['bytes'] = fixture['bytes']
+                sample['queue_seconds'] = job['started_at'] - job['created_at']
+                sample['realtime_factor'] = fixture['duration'] / max(job['finished_at'] - job['started_at'], 1e-6)
+            samples.append(sample)
+
+
+SCENARIOS = {'index': IndexScenario, 'scrub': ScrubScenario, 'stream': StreamScenario, 'convert': ConvertScenario}
+OK_STATUSES = (200, 202, 206)
+
+
+class ProcessSampler(threading.Thread):
+    """Sample CPU and RSS of the server and of its FFmpeg children twice a second"""
+
+    def __init__(self, pid):
+        super().__init__(daemon=True)
+        self.server = psutil.Process(pid) if pid else None
+        self.children = {}
+        self.samples = []
+        self.stop = threading.Event()
+
+    def cpu(self, process):
+        try:
+            return process.cpu_percent(interval=None)
+        except psutil.Error:
+            return 0.0
+
+    def run(self):
+        if not self.server:
+            return
+        self.cpu(self.server)
+        psutil.cpu_percent(interval=None)
+        while not self.stop.wait(0.5):
+            try:
+                with self.server.oneshot():
+                    sample = {'server_cpu': self.cpu(self.server), 'server_rss': self.server.memory_info().rss,
+                              'server_threads': self.server.num_threads()}
+                children = self.server.children(recursive=True)
+            except psutil.Error:
+                break
+            ffmpeg_cpu, ffmpeg_rss, ffmpeg_processes = 0.0, 0, 0
+            for child in children:
+                # A child's first cpu_percent() call only primes the counter
+                known = self.children.setdefault(child.pid, child)
+                ffmpeg_cpu += self.cpu(known)
+                try:
+                    ffmpeg_rss += known.memory_info().rss
+                    ffmpeg_processes += 1
+                except psutil.Error:
+                    continue
+            sample.update(ffmpeg_cpu=ffmpeg_cpu, ffmpeg_rss=ffmpeg_rss, ffmpeg_processes=ffmpeg_processes,
+                          system_cpu=psutil.cpu_percent(interval=None))
+            self.samples.append(sample)
+
+    def summary(self):
+        if not self.samples:
+            return None
+
+        def column(key):
+            return [s[key] for s in self.samples]
+        return {
+            'server_cpu_percent_mean': round(statistics.mean(column('server_cpu')), 1),
+            'server_cpu_percent_peak': max(column('server_cpu')),
+            'server_rss_peak': max(column('server_rss')),
+            'server_threads_peak': max(column('server_threads')),
+            'ffmpeg_cpu_percent_mean': round(statistics.mean(column('ffmpeg_cpu')), 1),
+            'ffmpeg_cpu_percent_peak': round(max(column('ffmpeg_cpu')), 1),
+            'ffmpeg_rss_peak': max(column('ffmpeg_rss')),
+            'ffmpeg_processes_peak': max(column('ffmpeg_processes')),
+            'system_cpu_percent_mean': round(statistics.mean(column('system_cpu')), 1)
+        }
+
+
+def distribution(values, digits=4):
+    if not values:
+        return None
+    return {
+        'p50': round(percentile(values, 50), digits),
+        'p95': round(percentile(values, 95), digits),
+        'p99': round(percentile(values, 99), digits),
+        'mean': round(statistics.mean(values), digits),
+        'min': round(min(values), digits),
+        'max': round(max(values), digits)
+    }
+
+
+def summarize(name, concurrency, samples, elapsed, sampler):
+    requests = [s for s in samples if s.get('kind') is None]
+    ok = [s for s in requests if s['status'] in OK_STATUSES]
+    result = {
+        'scenario': name,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 2),
+        'requests': len(requests),
+        'errors': len(requests) - len(ok),
+        'requests_per_second': round(len(ok) / elapsed, 2),
+        'bytes_per_second': round(sum(s['bytes'] for s in ok) / elapsed),
+        'ttfb': distribution([s['ttfb'] for s in ok if s['ttfb'] is not None]),
+        'latency': distribution([s['latency'] for s in ok if s['latency'] is not None]),
+        'realtime_factor': distribution([s['realtime_factor'] for s in ok if s.get('realtime_factor')], 2),
+        'process': sampler.summary()
+    }
+    stats = [s for s in samples if s.get('kind') == 'stream-stats']
+    if stats:
+        result['stream_stats'] = {'requests': len(stats), 'errors': sum(1 for s in stats if s['status'] != 200),
+                                  'latency': distribution([s['latency'] for s in stats])}
+    if name == 'stream':
+        result['sources'] = {source: sum(1 for s in ok if s.get('source') == source)
+                             for source in {s.get('source') for s in ok}}
+    if name == 'convert':
+        result['queue_seconds'] = distribution([s['queue_seconds'] for s in ok if 'queue_seconds' in s], 2)
+    return result
+
+
+def run_scenario(name, concurrency, host, port, fixtures, args, pid):
+    """Run concurrency clients of one scenario and summarize what they measured"""
+    samples = []
+    sampler = ProcessSampler(pid)
+    sampler.start()
+    deadline = time.monotonic() + args.duration
+    clients = []
+    for i in range(concurrency):
+        scenario = SCENARIOS[name](host, port, fixtures, args, random.Random(f"{args.seed}-{name}-{i}"))
+        clients.append(threading.Thread(target=run_client, args=(scenario, deadline, samples), daemon=True))
+    started = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - started
+    sampler.stop.set()
+    sampler.join()
+    return summarize(name, concurrency, samples, elapsed, sampler)
+
+
+def run_client(scenario, deadline, samples):
+    try:
+        scenario.run(deadline, samples)
+    except (OSError, http.client.HTTPException, ValueError) as e:
+        samples.append({'status': f"error: {e}", 'ttfb': None, 'latency': None, 'bytes': 0})
+
+
+def compare(results, baseline):
+    """Relative change of the headline numbers against a baseline report (0.1 = 10% higher)"""
+    previous = {(r['scenario'], r['concurrency']): r for r in baseline.get('results', [])}
+    changes = []
+    for result in results:
+        old = previous.get((result['scenario'], result['concurrency']))
+        if not old:
+            continue
+        change = {'scenario': result['scenario'], 'concurrency': result['concurrency']}
+        for key, new_value, old_value in [
+            ('requests_per_second', result['requests_per_second'], old['requests_per_second']),
+            ('bytes_per_second', result['bytes_per_second'], old['bytes_per_second']),
+            ('ttfb_p95', (result['ttfb'] or {}).get('p95'), (old['ttfb'] or {}).get('p95')),
+            ('realtime_factor_p50', (result['realtime_factor'] or {}).get('p50'),
+             (old['realtime_factor'] or {}).get('p50')),
+        ]:
+            if new_value is not None and old_value:
+                change[key] = round(new_value / old_value - 1, 3)
+        changes.append(change)
+    return changes
+
+
+def describe_machine():
+    version = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True).stdout.splitlines()
+    return {
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpu_count': psutil.cpu_count(logical=True),
+        'memory_bytes': psutil.virtual_memory().total,
+        'ffmpeg': version[0] if version else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--server', choices=['threaded', 'asgi', 'none'], default='threaded',
+                        help='server to start from the repository root (none uses --url)')
+    parser.add_argument('--url', default=None, help='base URL of a running server (with --server none)')
+    parser.add_argument('--pid', type=int, default=None, help='PID of a running server, for process stats')
+    parser.add_argument('--port', type=int, default=5098, help='port for the server this script starts')
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 4, 16], help='client counts to run')
+    parser.add_argument('--duration', type=float, default=20, help='seconds each scenario runs per level')
+    parser.add_argument('--stream-seconds', type=float, default=8,
+                        help='seconds a stream client reads before seeking somewhere else')
+    parser.add_argument('--convert-timeout', type=float, default=600,
+                        help='seconds past --duration to wait for running conversions')
+    parser.add_argument('--fixture-folder', default='loadtest', help='fixture folder inside the videos folder')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the JSON report here as well as to stdout')
+    parser.add_argument('--baseline', help='earlier JSON report to compare against')
+    add_fixture_arguments(parser)
+    args = parser.parse_args()
+    if args.server == 'none' and not args.url:
+        parser.error('--server none needs --url')
+
+    fixture_dir = os.path.join(REPO_ROOT, 'videos', args.fixture_folder)
+    fixtures = generate_fixtures(fixture_dir, args.resolutions, args.codecs, args.durations)
+    if not fixtures:
+        parser.error('no fixtures could be generated')
+
+    server = None
+    if args.server == 'none':
+        url = urllib.parse.urlsplit(args.url)
+        host, port, pid = url.hostname, url.port or 80, args.pid
+    else:
+        host, port = '127.0.0.1', args.port
+        server = subprocess.Popen(SERVER_COMMANDS[args.server](host, port), cwd=REPO_ROOT,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pid = server.pid
+    results = []
+    try:
+        wait_for_server(host, port)
+        # Let the catalog scan and probe the fixtures before anything is timed
+        get_json(host, port, '/api/videos')
+        for name in args.scenarios:
+            for concurrency in args.concurrency:
+                result = run_scenario(name, concurrency, host, port, fixtures, args, pid)
+                results.append(result)
+                print(json.dumps({k: result[k] for k in ('scenario', 'concurrency', 'requests', 'errors',
+                                                        'requests_per_second', 'ttfb')}), file=sys.stderr)
+    finally:
+        if server:
+            server.terminate()
+            try:
+                server.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                server.kill()
+        if 'convert' in args.scenarios:
+            shutil.rmtree(os.path.join(REPO_ROOT, 'converted_videos', args.fixture_folder), ignore_errors=True)
+
+    report = {
+        'generated_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'machine': describe_machine(),
+        'config': vars(args),
+        'fixtures': fixtures,
+        'results': results
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['baseline'] = {'file': args.baseline, 'changes': compare(results, json.load(f))}
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+"""Microbenchmark the live relay (FFmpeg pipe -> shared fMP4 fragments), before and after pooled readinto().
+
+Runs from the repository root, without FFmpeg or a server:
+
+    python benchmarks/relay.py
+    python benchmarks/relay.py --fragment-kb 2048 --megabytes 4000 --rate 2000000
+
+A child process writes a synthetic fragmented MP4 stream (ftyp and moov, then
+moof+mdat fragments) into a pipe, optionally throttled to --rate bytes/s like an
+encoder, and this process splits it into fragments the way a broadcast does.
+'before' is the previous relay: read1() of a fixed buf_size chunk into a new bytes
+object, then a splitter that grows and slices bytearrays. 'after' is the loop in
+TranscodeBroadcast._pump_output. Throughput is reported per CPU-second of this
+process, i.e. bytes/s per core; the writer's CPU is not counted.
+"""
+import argparse
+import json
+import os
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(REPO_ROOT)
+
+import app  # noqa: E402
+
+WRITER = '''
+import os, sys, time
+data = open(sys.argv[1], 'rb').read()
+repeats, rate = int(sys.argv[2]), float(sys.argv[3])
+out = os.fdopen(1, 'wb', buffering=0)
+header, body = data[:int(sys.argv[4])], memoryview(data)[int(sys.argv[4]):]
+out.write(header)
+started, sent = time.monotonic(), 0
+for _ in range(repeats):
+    view = body
+    while view:
+        written = out.write(view[:256 * 1024])
+        view, sent = view[written:], sent + written
+        if rate:
+            ahead = sent / rate - (time.monotonic() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+'''
+
+
+class LegacyMp4FragmentSplitter:
+    """The splitter as it was before the pooled buffer, kept here as the baseline"""
+
+    def __init__(self):
+        self.init_segment = None
+        self._buffer = bytearray()
+        self._pending = bytearray()
+
+    def feed(self, data):
+        self._buffer += data
+        fragments = []
+        while len(self._buffer) >= 8:
+            size, box_type = struct.unpack_from('>I4s', self._buffer, 0)
+            if size == 1:
+                if len(self._buffer) < 16:
+                    break
+                size = struct.unpack_from('>Q', self._buffer, 8)[0]
+            if size < 8 or len(self._buffer) < size:
+                break
+            self._pending += self._buffer[:size]
+            del self._buffer[:size]
+            if self.init_segment is None:
+                if box_type == b'moov':
+                    self.init_segment = bytes(self._pending)
+                    self._pending = bytearray()
+            elif box_type == b'mdat':
+                fragments.append(bytes(self._pending))
+                self._pending = bytearray()
+        return fragments
+
+
+def box(box_type, payload_size):
+    return struct.pack('>I4s', payload_size + 8, box_type) + os.urandom(payload_size)
+
+
+def build_stream(fragment_size):
+    """(init segment, one moof+mdat fragment) of a synthetic fMP4 stream"""
+    init_segment = box(b'ftyp', 16) + box(b'moov', 1024)
+    fragment = box(b'moof', 1024) + box(b'mdat', fragment_size - 1024 - 16)
+    return init_segment, fragment
+
+
+def relay_before(stream, buf_size):
+    splitter = LegacyMp4FragmentSplitter()
+    chunk_size = max(buf_size, 16 * 1024)
+    fragments = reads = received = 0
+    while True:
+        data = stream.read1(chunk_size)
+        if not data:
+            break
+        reads += 1
+        received += len(data)
+        fragments += len(splitter.feed(data))
+    return fragments, reads, received
+
+
+def relay_after(stream, buf_size):
+    splitter = app.Mp4FragmentSplitter()
+    sizer = app.RelayReadSizer(buf_size)
+    fragments = reads = received = 0
+    try:
+        while True:
+            count = stream.readinto(splitter.writable(sizer.size))
+            if not count:
+                break
+            reads += 1
+            received += count
+            fragments += len(splitter.commit(count))
+            if sizer.record(count):
+                app.grow_pipe(stream, sizer.size)
+    finally:
+        splitter.close()
+    return fragments, reads, received
+
+
+def run_mode(mode, stream_file, header_size, repeats, args):
+    writer = subprocess.Popen(
+        [sys.executable, '-c', WRITER, stream_file, str(repeats), str(args.rate), str(header_size)],
+        stdout=subprocess.PIPE, bufsize=args.buf_size if mode == 'before' else 0
+    )
+    wall, cpu = time.perf_counter(), time.process_time()
+    relay = relay_before if mode == 'before' else relay_after
+    fragments, reads, total = relay(writer.stdout, args.buf_size)
+    wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    if writer.wait() != 0:
+        raise RuntimeError(f"The stream writer exited with code {writer.returncode}")
+    return {
+        'fragments': fragments,
+        'reads': reads,
+        'bytes': total,
+        'wall_seconds': round(wall, 3),
+        'cpu_seconds': round(cpu, 3),
+        'bytes_per_second': round(total / wall),
+        'bytes_per_cpu_second': round(total / cpu) if cpu else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fragment-kb', type=int, default=512, help='size of each moof+mdat fragment')
+    parser.add_argument('--megabytes', type=int, default=1000, help='stream length')
+    parser.add_argument('--rate', type=float, default=0, help='writer rate in bytes/s (0 writes as fast as it can)')
+    parser.add_argument('--buf-size', type=int, default=65536,
+                        help="the streaming settings' buf_size (the old fixed read size)")
+    parser.add_argument('--mode', choices=['before', 'after', 'both'], default='both')
+    args = parser.parse_args()
+
+    init_segment, fragment = build_stream(args.fragment_kb * 1024)
+    repeats = max(1, args.megabytes * 1024 * 1024 // len(fragment))
+    with tempfile.NamedTemporaryFile(suffix='.mp4') as f:
+        f.write(init_segment + fragment)
+        f.flush()
+        modes = ['before', 'after'] if args.mode == 'both' else [args.mode]
+        report = {'fragment_bytes': len(fragment), 'fragments': repeats, 'rate': args.rate}
+        for mode in modes:
+            report[mode] = run_mode(mode, f.name, len(init_segment), repeats, args)
+            print(json.dumps({mode: report[mode]}), file=sys.stderr)
+    if 'before' in report and 'after' in report and report['before']['bytes_per_cpu_second']:
+        report['per_core_speedup'] = round(report['after']['bytes_per_cpu_second']
+                                           / report['before']['bytes_per_cpu_second'], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
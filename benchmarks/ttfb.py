@@ -0,0 +1,79 @@
+"""Measure time-to-first-byte of /stream/ for play and seek requests.
+
+Run against a running server, e.g.:
+
+    python benchmarks/ttfb.py --file movie.mkv --duration 5400 --runs 20
+"""
+import argparse
+import http.client
+import json
+import math
+import random
+import statistics
+import time
+import urllib.parse
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure_ttfb(host, port, path, timeout=60):
+    """Seconds from sending the request until the first body byte arrives"""
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    started = time.perf_counter()
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        if response.status != 200:
+            raise RuntimeError(f"{path} returned HTTP {response.status}")
+        if not response.read(1):
+            raise RuntimeError(f"{path} returned an empty body")
+        return time.perf_counter() - started
+    finally:
+        connection.close()
+
+
+def summarize(samples):
+    return {
+        'runs': len(samples),
+        'p50': percentile(samples, 50),
+        'p95': percentile(samples, 95),
+        'mean': statistics.mean(samples) if samples else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--url', default='http://127.0.0.1:5000', help='server base URL')
+    parser.add_argument('--file', required=True, help='MKV path relative to the videos folder')
+    parser.add_argument('--duration', type=float, required=True, help='file duration in seconds (seek range)')
+    parser.add_argument('--runs', type=int, default=10, help='requests per scenario')
+    parser.add_argument('--pause', type=float, default=2.0,
+                        help='seconds between requests, so the previous encoder is torn down')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    base = urllib.parse.urlsplit(args.url)
+    stream_path = f"/stream/{urllib.parse.quote(args.file)}"
+    rng = random.Random(args.seed)
+    results = {'play': [], 'seek': []}
+
+    for _ in range(args.runs):
+        results['play'].append(measure_ttfb(base.hostname, base.port or 80, stream_path))
+        time.sleep(args.pause)
+        start = rng.uniform(0, max(args.duration - 30, 0))
+        results['seek'].append(measure_ttfb(base.hostname, base.port or 80, f"{stream_path}?start={start:.2f}"))
+        time.sleep(args.pause)
+
+    report = {scenario: summarize(samples) for scenario, samples in results.items()}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
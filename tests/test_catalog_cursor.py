@@ -0,0 +1,59 @@
+"""Cursor validation for /api/videos keyset pagination."""
+import os
+import sys
+import tempfile
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+os.chdir(tempfile.mkdtemp(prefix='letswatch-tests-'))  # app logs and creates its folders in the working directory
+
+import app  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def catalog():
+    entries = {}
+    for i, (name, size) in enumerate([('alpha.mp4', 300), ('beta.mp4', 100), ('gamma.mp4', 200)]):
+        entries[(app.VIDEO_FOLDER, name)] = {
+            'folder': app.VIDEO_FOLDER, 'filename': name, 'ext': '.mp4', 'size': size,
+            'mtime': 1000.0 + i, 'duration': 60.0 * (i + 1), 'info': None, 'codec': 'h264',
+            'title': name[:-4], 'thumbnails': False, 'audio_tracks': [], 'subtitle_tracks': []
+        }
+    with app._catalog_lock:
+        app.LIBRARY_CATALOG.clear()
+        app.LIBRARY_CATALOG.update(entries)
+        app._rebuild_catalog_view()
+    yield
+    with app._catalog_lock:
+        app.LIBRARY_CATALOG.clear()
+        app._rebuild_catalog_view()
+
+
+@pytest.mark.parametrize('sort', list(app.CATALOG_SORTS))
+def test_pages_follow_cursor(sort):
+    first, cursor, total = app.get_catalog_page(sort, limit=2)
+    rest, next_cursor, _ = app.get_catalog_page(sort, cursor=cursor, limit=2)
+    assert total == 3 and next_cursor is None
+    assert len({e['filename'] for e in first + rest}) == 3
+
+
+def test_cursor_from_another_sort_is_rejected():
+    _, cursor, _ = app.get_catalog_page('name', limit=1)
+    with pytest.raises(ValueError):
+        app.get_catalog_page('size', cursor=cursor, limit=1)
+    with pytest.raises(ValueError):
+        app.get_catalog_page('size', descending=True, cursor=cursor, limit=1)
+
+
+@pytest.mark.parametrize('key', [
+    ['alpha', 'videos'],  # too short
+    [100, 'videos', 'beta.mp4', 'extra'],  # too long
+    ['100', 'videos', 'beta.mp4'],  # wrong type
+    [True, 'videos', 'beta.mp4'],
+])
+def test_malformed_cursor_key_is_rejected(key):
+    cursor = app.encode_catalog_cursor('size', key)
+    with pytest.raises(ValueError):
+        app.get_catalog_page('size', cursor=cursor, limit=1)